@@ -0,0 +1,82 @@
+import email.utils
+import re
+
+
+# Fast path for the common address forms. Anything these patterns do not match in full goes
+# to email.utils, so the results always agree with it. The patterns only accept input that
+# email.utils parses in the obvious way: dot-atom addresses without whitespace or comments, a
+# display name that is either one quoted string or plain words, and simple comma lists.
+_WS = r'[ \t\r\n]*'
+_LOCAL = r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+_DOMAIN = r'[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*'
+_ADDRESS = '(%s@%s)' % (_LOCAL, _DOMAIN)
+_NAME_WORD = r'[^()<>@,:;"\[\]\\ \t\r\n]+'
+_NAME = r'(?:"([^"\\\r\n]*)"|(%s(?:[ \t\r\n]+%s)*))?' % (_NAME_WORD, _NAME_WORD)
+# Groups: bare address | quoted name, unquoted name, angle address
+_ELEMENT = r'%s(?:%s|%s%s<%s>)%s' % (_WS, _ADDRESS, _NAME, _WS, _ADDRESS, _WS)
+
+_SINGLE = re.compile(_ELEMENT + '$')
+_LIST_ELEMENT = re.compile(_ELEMENT + '(,|$)')
+_WHITESPACE = re.compile(r'[ \t\r\n]+')
+
+
+def _name_address(match):
+    (bare, quoted, unquoted, address) = match.group(1, 2, 3, 4)
+    if bare is not None:
+        return '', bare
+    if quoted is not None:
+        return quoted, address
+    if unquoted is not None:
+        return _WHITESPACE.sub(' ', unquoted), address
+    return '', address
+
+
+def parse_address(s):
+    """
+    Same as email.utils.parseaddr(s): the (display name, address) of the first address in s.
+    None (a missing header) gives ('', '').
+    """
+    if s is None:
+        return email.utils.parseaddr(s)
+    match = _SINGLE.match(s)
+    if match is None:
+        return email.utils.parseaddr(s)
+    return _name_address(match)
+
+
+def parse_address_list(s):
+    """
+    Same as email.utils.getaddresses([s]): the (display name, address) of every address in a
+    header. None (a missing header) gives [], as email.utils.getaddresses([]) does.
+    """
+    if s is None:
+        return email.utils.getaddresses([])
+    result = list()
+    position = 0
+    length = len(s)
+    while position < length:
+        match = _LIST_ELEMENT.match(s, position)
+        # An empty element or a comma followed by only whitespace is parsed as ('', '') by
+        # email.utils. Leave those to it.
+        if match is None or (match.group(5) == ',' and match.end() == length):
+            return email.utils.getaddresses([s])
+        result.append(_name_address(match))
+        position = match.end()
+    if length == 0:
+        return email.utils.getaddresses([s])
+    return result
+
+
+def normalize_address(address):
+    """
+    Canonical form of an address for matching: lowercased, with the +tag of the local part
+    removed (bob+lists@x.com -> bob@x.com). Quoted local parts are only lowercased.
+    """
+    (local, at, domain) = address.rpartition('@')
+    if len(at) == 0:
+        return address.lower()
+    if '"' not in local:
+        tagless = local.split('+', 1)[0]
+        if len(tagless) > 0:
+            local = tagless
+    return (local + '@' + domain).lower()
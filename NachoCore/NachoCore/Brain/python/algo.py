@@ -1,44 +1,406 @@
 #!/usr/bin/env python
 
-import sys
+import argparse
+import csv
+import functools
+import os
 from model import Model
 from analyzer_relation import RelationAnalyzer
-from analyzer_content import ContentAnalyzer
-from analyzer_combined import LinearCombinedAnalyzer, ProductCombinedAnalyzer, MaxCombinedAnalyzer
-from evaluator import Evaluator
+from analyzer_relation_sql import SqlRelationAnalyzer, compare_backends
+from analyzer_relation_decayed import DecayedRelationAnalyzer
+from analyzer_content import ContentAnalyzer, HashingContentAnalyzer, FeatureContentAnalyzer
+from analyzer_combined import CombinedAnalyzer, COMBINERS
+from evaluator import Evaluator, ThresholdSweep
+from message_store import MessageStore
+from email_address import EmailAddress
+from shared_runner import SharedModelRunner
+from cross_validation import CrossValidator
+from feature_cache import SubjectFeatureCache
+from instrumentation import Instrumentation
+from score_export import ScoreExport
+from model_artifact import save_analyzer, load_analyzer
 
 
-def get_analyzer(name):
+RELATION_BACKENDS = {
+    'python': RelationAnalyzer,
+    'sql': SqlRelationAnalyzer,
+}
+
+
+def get_analyzer(name, relation_backend='python', half_life=None):
+    if half_life is not None:
+        relation_class = functools.partial(DecayedRelationAnalyzer, half_life_days=half_life)
+    else:
+        relation_class = RELATION_BACKENDS[relation_backend]
     if name == 'bayes1':
-        analyzer = RelationAnalyzer()
+        analyzer = relation_class()
         analyzer.analyze_to = False
         analyzer.analyze_cc = False
     elif name == 'bayes3':
-        analyzer = RelationAnalyzer()
+        analyzer = relation_class()
     elif name == 'logistic':
         analyzer = ContentAnalyzer()
-    elif name == 'linear':
-        analyzer = LinearCombinedAnalyzer()
-    elif name == 'product':
-        analyzer = ProductCombinedAnalyzer()
-    elif name == 'max':
-        analyzer = MaxCombinedAnalyzer()
+    elif name == 'hashing':
+        analyzer = HashingContentAnalyzer()
+    elif name == 'features':
+        analyzer = FeatureContentAnalyzer()
+    elif name in COMBINERS:
+        analyzer = COMBINERS[name](relation_analyzer=relation_class())
     else:
         raise ValueError('unknown analyzer type %s' % name)
     return analyzer
 
 
+def set_feature_cache(analyzer, feature_cache):
+    if isinstance(analyzer, ContentAnalyzer):
+        analyzer.feature_cache = feature_cache
+    elif isinstance(analyzer, CombinedAnalyzer):
+        analyzer.content_analyzer.feature_cache = feature_cache
+
+
+def model_path(model_dir, name, half_life=None):
+    """
+    Path of the saved model of an analyzer trained with the given options, e.g.
+    DIR/bayes3.brain or DIR/bayes3-hl30.brain.
+    """
+    if half_life is not None:
+        name = '%s-hl%g' % (name, half_life)
+    return os.path.join(model_dir, '%s.brain' % name)
+
+
+def load_model(name, model_dir, half_life=None):
+    """
+    Return the analyzer saved in model_dir by save_model() with the same options or None if
+    there is none.
+    """
+    path = model_path(model_dir, name, half_life)
+    if not os.path.exists(path):
+        return None
+    with Instrumentation.stage('load model'):
+        (saved_name, analyzer, parameters) = load_analyzer(path)
+    if saved_name != name:
+        raise ValueError('%s holds a %s model, not %s' % (path, saved_name, name))
+    relation = parameters.get('relation', None)
+    if relation is not None:
+        saved_half_life = relation.get('half_life_days', None)
+        if saved_half_life != half_life:
+            raise ValueError('%s holds a model with half life %s, not %s' % (path, saved_half_life, half_life))
+    return analyzer
+
+
+def save_model(name, analyzer, model_dir, db_file, half_life=None):
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    with Instrumentation.stage('save model'):
+        save_analyzer(analyzer, name, model_path(model_dir, name, half_life), db_file=db_file)
+
+
+def run(name, email_messages, evaluator, relation_state=None, relation_snapshot=None, feature_cache=None,
+        relation_backend='python', half_life=None, score_export=None, model_dir=None, db_file=None):
+    analyzer = load_model(name, model_dir, half_life) if model_dir is not None else None
+    if analyzer is None:
+        analyzer = get_analyzer(name, relation_backend, half_life)
+        set_feature_cache(analyzer, feature_cache)
+        with Instrumentation.stage('analyze'):
+            if relation_snapshot is not None and isinstance(analyzer, RelationAnalyzer):
+                if os.path.exists(relation_snapshot):
+                    analyzer.load_snapshot(relation_snapshot)
+                else:
+                    analyzer.analyze(email_messages)
+                    analyzer.save_snapshot(relation_snapshot)
+            elif relation_state is not None and isinstance(analyzer, RelationAnalyzer):
+                # Warm start from the saved statistics and only fold in what changed since
+                if os.path.exists(relation_state):
+                    analyzer.load(relation_state)
+                analyzer.update(email_messages)
+                analyzer.save(relation_state)
+            else:
+                analyzer.analyze(email_messages)
+        if model_dir is not None:
+            save_model(name, analyzer, model_dir, db_file, half_life)
+    with Instrumentation.stage('classify'):
+        scores = analyzer.classify(email_messages)
+    Instrumentation.count('messages', len(email_messages))
+    if score_export is not None:
+        with Instrumentation.stage('export'):
+            score_export.write(name, email_messages, scores)
+    with Instrumentation.stage('evaluate'):
+        return evaluator.evaluate(email_messages, scores)
+
+
+def run_stream(name, stream, evaluator, feature_cache=None, relation_backend='python', half_life=None,
+               score_export=None, model_dir=None, db_file=None):
+    """
+    Same as run() but the messages are read chunk by chunk from an EmailMessageStream. One pass
+    trains the analyzer (unless it is loaded from model_dir) and a second pass classifies and
+    evaluates.
+    """
+    analyzer = load_model(name, model_dir, half_life) if model_dir is not None else None
+    if analyzer is None:
+        analyzer = get_analyzer(name, relation_backend, half_life)
+        set_feature_cache(analyzer, feature_cache)
+        with Instrumentation.stage('analyze'):
+            analyzer.analyze_chunks(stream)
+        if model_dir is not None:
+            save_model(name, analyzer, model_dir, db_file, half_life)
+    results = None
+    offset = 0
+    for chunk in stream:
+        with Instrumentation.stage('classify'):
+            scores = analyzer.classify(chunk)
+        if score_export is not None:
+            with Instrumentation.stage('export'):
+                score_export.write(name, chunk, scores)
+        with Instrumentation.stage('evaluate'):
+            results = evaluator.evaluate(chunk, scores, results=results, offset=offset)
+        offset += len(chunk)
+    Instrumentation.count('messages', offset)
+    if results is None:
+        results = evaluator.evaluate([], [])
+    return results
+
+
+def cache_counters(feature_cache):
+    counters = [('address header cache hits', EmailAddress.header_cache.hits),
+                ('address header cache misses', EmailAddress.header_cache.misses),
+                ('canonical address cache hits', EmailAddress.canonical_cache.hits),
+                ('canonical address cache misses', EmailAddress.canonical_cache.misses)]
+    if feature_cache is not None:
+        counters += [('feature cache hits', feature_cache.hits),
+                     ('feature cache misses', feature_cache.misses)]
+    return counters
+
+
+def count_cache_counters(before, after):
+    for ((name, old), (_, new)) in zip(before, after):
+        Instrumentation.count(name, new - old)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_file', help='SQLite database file')
+    parser.add_argument('analyzers', nargs='+',
+                        help='Analyzers to evaluate (bayes1, bayes3, logistic, hashing, features, %s)' % ', '.join(sorted(COMBINERS)))
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='Stream McEmailMessage in chunks of this many rows instead of loading'
+                             ' all of them into memory')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Load McEmailMessage into a columnar MessageStore and use the vectorized'
+                             ' analyzer code paths')
+    parser.add_argument('--shared', action='store_true',
+                        help='Train each base analyzer once, share the fitted models and scores across the'
+                             ' combined analyzers and run independent steps in a process pool')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of worker processes for --shared, --cv and --time-split'
+                             ' (default: # of CPUs)')
+    parser.add_argument('--cv', type=int, default=None, metavar='K',
+                        help='Evaluate with K-fold cross-validation instead of on the training messages')
+    parser.add_argument('--time-split', type=int, default=None, metavar='K',
+                        help='Evaluate with K chronological folds (train on older DateReceived, test on newer)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for --cv')
+    parser.add_argument('--hot-threshold', type=float, default=0.5,
+                        help='Score at or above which a message is hot')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Also sweep all thresholds and report ROC AUC, average precision and the'
+                             ' optimal threshold')
+    parser.add_argument('--sweep-output', default=None, metavar='FILE',
+                        help='With --sweep, write the ROC and precision-recall curves of every analyzer to FILE'
+                             ' as CSV (one row per threshold)')
+    parser.add_argument('--relation-state', default=None,
+                        help='File to persist RelationAnalyzer statistics in. If it exists, bayes1 / bayes3'
+                             ' only fold in new messages and read / reply state changes')
+    parser.add_argument('--relation-snapshot', default=None,
+                        help='Directory of a RelationAnalyzer statistics snapshot. If it exists, bayes1 / bayes3'
+                             ' load it instead of analyzing. Otherwise, it is saved after analyzing')
+    parser.add_argument('--feature-cache', default=None, metavar='DIR',
+                        help='Directory to cache the subject vocabulary and per-message features of the'
+                             ' content analyzer in')
+    parser.add_argument('--relation-backend', choices=sorted(RELATION_BACKENDS), default='python',
+                        help='How the relation statistics are computed. python parses the From / To / Cc'
+                             ' headers. sql aggregates McMapEmailAddressEntry with GROUP BY queries')
+    parser.add_argument('--check-relation-backend', action='store_true',
+                        help='Compare the statistics of the python and sql relation backends and print the'
+                             ' addresses that differ')
+    parser.add_argument('--half-life', type=float, default=None, metavar='DAYS',
+                        help='Decay the relation statistics exponentially with the age (DateReceived) of'
+                             ' the messages, halving every DAYS days')
+    parser.add_argument('--write-scores', action='store_true',
+                        help='Store the score of every message in the BrainScore side table, keyed by message'
+                             ' Id and analyzer')
+    parser.add_argument('--score-db', default=None, metavar='FILE',
+                        help='Database for the BrainScore table (default: the device database)')
+    parser.add_argument('--score-diff', action='store_true',
+                        help='Compare the stored scores of each analyzer with McEmailMessage.Score')
+    parser.add_argument('--model', default=None, metavar='DIR',
+                        help='Directory of trained models. If DIR/<analyzer>.brain (<analyzer>-hl<DAYS>.brain'
+                             ' with --half-life) exists, it is loaded instead of training. Otherwise, the'
+                             ' analyzer is trained and saved there')
+    parser.add_argument('--address-cache-size', type=int, default=None,
+                        help='Capacity of the address parsing caches')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='Print address parsing and feature cache statistics')
+    parser.add_argument('--timing', action='store_true',
+                        help='Print the wall / CPU time of every stage and per-analyzer counters after'
+                             ' each result')
+    parser.add_argument('--timing-json', default=None, metavar='FILE',
+                        help='Append the stage timings and counters of this run as a JSON line to FILE')
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='Run under cProfile and save the statistics (pstats format) to FILE')
+    options = parser.parse_args()
+    if options.cv is not None and options.time_split is not None:
+        parser.error('--cv and --time-split cannot be used together')
+    if (options.cv is not None or options.time_split is not None) and \
+            (options.shared or options.chunk_size is not None):
+        parser.error('--cv / --time-split cannot be combined with --shared or --chunk-size')
+    if options.feature_cache is not None and \
+            (options.shared or options.cv is not None or options.time_split is not None):
+        parser.error('--feature-cache cannot be combined with --shared, --cv or --time-split')
+    if options.sweep and options.chunk_size is not None:
+        parser.error('--sweep cannot be combined with --chunk-size')
+    if options.sweep_output is not None and \
+            (not options.sweep or options.cv is not None or options.time_split is not None):
+        parser.error('--sweep-output requires --sweep and cannot be combined with --cv or --time-split')
+    if options.shared and (options.chunk_size is not None or options.relation_state is not None or
+                           options.relation_snapshot is not None):
+        parser.error('--shared cannot be combined with --chunk-size, --relation-state or --relation-snapshot')
+    if options.shared and options.relation_backend != 'python':
+        parser.error('--shared only supports the python relation backend')
+    if options.half_life is not None and (options.relation_backend != 'python' or options.shared):
+        parser.error('--half-life cannot be combined with --relation-backend sql or --shared')
+    if options.half_life is not None and options.half_life <= 0.0:
+        parser.error('--half-life must be positive')
+    if (options.write_scores or options.score_diff) and \
+            (options.shared or options.cv is not None or options.time_split is not None):
+        parser.error('--write-scores / --score-diff cannot be combined with --shared, --cv or --time-split')
+    if options.score_diff and not options.write_scores:
+        parser.error('--score-diff requires --write-scores')
+    if options.model is not None and \
+            (options.shared or options.cv is not None or options.time_split is not None or
+             options.relation_state is not None or options.relation_snapshot is not None or
+             options.relation_backend != 'python'):
+        parser.error('--model cannot be combined with --shared, --cv, --time-split, --relation-state,'
+                     ' --relation-snapshot or --relation-backend sql')
+    if options.check_relation_backend and options.chunk_size is not None:
+        parser.error('--check-relation-backend cannot be combined with --chunk-size')
+    return options
+
+
 def main():
-    Model.load(sys.argv[1])
-
-    for name in sys.argv[2:]:
-        print '-' * 10, name, '-' * 10
-        analyzer = get_analyzer(name)
-        analyzer.analyze(Model.email_messages)
-        scores = analyzer.classify(Model.email_messages)
-        evaluator = Evaluator()
-        results = evaluator.evaluate(Model.email_messages, scores)
-        print results.summary()
+    options = parse_arguments()
+    if options.timing or options.timing_json is not None or options.profile is not None:
+        Instrumentation.enable(profile=options.profile is not None)
+    if options.address_cache_size is not None:
+        EmailAddress.set_cache_capacity(options.address_cache_size)
+    with Instrumentation.stage('load'):
+        if options.chunk_size is not None:
+            stream = Model.stream(options.db_file, chunk_size=options.chunk_size)
+        elif options.columnar:
+            email_messages = MessageStore.load(options.db_file)
+        else:
+            Model.load(options.db_file, columns=Model.ANALYZED_COLUMNS)
+            email_messages = Model.email_messages
+
+    feature_cache = None
+    if options.feature_cache is not None:
+        feature_cache = SubjectFeatureCache(options.feature_cache, options.db_file)
+        feature_cache.load()
+
+    if options.check_relation_backend:
+        mismatches = compare_backends(email_messages)
+        print '-' * 10, 'relation backend check', '-' * 10
+        for (canonical_address, python_counts, sql_counts) in mismatches:
+            print '%s: python %s  sql %s' % (canonical_address, python_counts, sql_counts)
+        print '%d addresses differ' % len(mismatches)
+
+    score_export = None
+    if options.write_scores:
+        score_export = ScoreExport(options.db_file, score_db_path=options.score_db)
+
+    evaluator = Evaluator()
+    evaluator.hot_threshold = options.hot_threshold
+    evaluator.sweep = options.sweep
+
+    sweep_file = None
+    sweep_writer = None
+    if options.sweep_output is not None:
+        sweep_file = open(options.sweep_output, 'wb')
+        sweep_writer = csv.writer(sweep_file)
+        sweep_writer.writerow(('analyzer',) + ThresholdSweep.CURVE_FIELDS)
+
+    if options.cv is not None or options.time_split is not None:
+        validator = CrossValidator(email_messages, processes=options.processes, evaluator=evaluator)
+        for name in options.analyzers:
+            print '-' * 10, name, '-' * 10
+            factory = functools.partial(get_analyzer, name, options.relation_backend, options.half_life)
+            with Instrumentation.stage(name):
+                if options.cv is not None:
+                    cv_results = validator.kfold(factory, options.cv, seed=options.seed)
+                else:
+                    cv_results = validator.time_split(factory, options.time_split)
+            print cv_results.summary()
+            if options.timing:
+                print Instrumentation.summary(name)
+    elif options.shared:
+        runner = SharedModelRunner(email_messages, processes=options.processes, evaluator=evaluator)
+        with Instrumentation.stage('shared'):
+            for (name, results) in runner.run(options.analyzers):
+                print '-' * 10, name, '-' * 10
+                print results.summary()
+                if sweep_writer is not None:
+                    results.sweep.write_curves(sweep_writer, (name,))
+    else:
+        for name in options.analyzers:
+            print '-' * 10, name, '-' * 10
+            with Instrumentation.stage(name):
+                before = cache_counters(feature_cache)
+                if options.chunk_size is None:
+                    results = run(name, email_messages, evaluator, relation_state=options.relation_state,
+                                  relation_snapshot=options.relation_snapshot, feature_cache=feature_cache,
+                                  relation_backend=options.relation_backend, half_life=options.half_life,
+                                  score_export=score_export, model_dir=options.model, db_file=options.db_file)
+                else:
+                    results = run_stream(name, stream, evaluator, feature_cache=feature_cache,
+                                         relation_backend=options.relation_backend, half_life=options.half_life,
+                                         score_export=score_export, model_dir=options.model,
+                                         db_file=options.db_file)
+                count_cache_counters(before, cache_counters(feature_cache))
+            print results.summary()
+            if sweep_writer is not None:
+                results.sweep.write_curves(sweep_writer, (name,))
+            if options.score_diff:
+                print 'score diff against McEmailMessage.Score:'
+                print score_export.diff(name, hot_threshold=options.hot_threshold).summary()
+            if options.timing:
+                print Instrumentation.summary(name)
+
+    if score_export is not None:
+        score_export.close()
+
+    if sweep_file is not None:
+        sweep_file.close()
+
+    if feature_cache is not None:
+        feature_cache.save()
+        if options.cache_stats:
+            print feature_cache.summary()
+
+    if options.cache_stats:
+        print '-' * 10, 'address cache', '-' * 10
+        print EmailAddress.cache_summary()
+
+    if Instrumentation.enabled:
+        Instrumentation.disable()
+        if options.timing:
+            print '-' * 10, 'timing', '-' * 10
+            print Instrumentation.summary()
+            if options.profile is not None:
+                print Instrumentation.profile_summary()
+        if options.timing_json is not None:
+            Instrumentation.append_json(options.timing_json, db_file=os.path.realpath(options.db_file),
+                                        analyzers=options.analyzers)
+        if options.profile is not None:
+            Instrumentation.save_profile(options.profile)
 
 
 if __name__ == '__main__':
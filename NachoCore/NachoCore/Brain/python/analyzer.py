@@ -13,3 +13,13 @@ class Analyzer(object):
     @abstractmethod
     def classify(self, objects):
         pass
+
+    def analyze_chunks(self, chunks):
+        """
+        Analyze objects that arrive as an iterable of lists. The default implementation
+        concatenates all chunks. Analyzers that can learn incrementally should override it.
+        """
+        objects = list()
+        for chunk in chunks:
+            objects.extend(chunk)
+        self.analyze(objects)
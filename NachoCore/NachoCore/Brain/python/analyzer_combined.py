@@ -1,34 +1,92 @@
+import numpy
+from sklearn import linear_model
 from analyzer import Analyzer
 from analyzer_relation import RelationAnalyzer
 from analyzer_content import ContentAnalyzer
+from evaluator import Evaluator
+
+
+# Registry of combined analyzers by name. algo.py looks analyzers up here, so a new combiner
+# only needs to be decorated with @register_combiner.
+COMBINERS = dict()
+
+
+def register_combiner(name):
+    def register(cls):
+        assert name not in COMBINERS
+        COMBINERS[name] = cls
+        return cls
+    return register
 
 
 class CombinedAnalyzer(Analyzer):
-    def __init__(self):
-        self.relation_analyzer = RelationAnalyzer()
-        self.content_analyzer = ContentAnalyzer()
+    def __init__(self, relation_analyzer=None, content_analyzer=None):
+        """
+        Already trained relation / content analyzers can be passed in to share them between
+        several combined analyzers. analyze() still retrains them.
+        """
+        if relation_analyzer is None:
+            relation_analyzer = RelationAnalyzer()
+        if content_analyzer is None:
+            content_analyzer = ContentAnalyzer()
+        self.relation_analyzer = relation_analyzer
+        self.content_analyzer = content_analyzer
+        # Function of two score arrays that returns the combined score array
         self.combine = None
 
     def analyze(self, email_messages):
         self.relation_analyzer.analyze(email_messages)
         self.content_analyzer.analyze(email_messages)
+        if self.needs_fit():
+            self.fit_combiner(email_messages, self.relation_analyzer.classify(email_messages),
+                              self.content_analyzer.classify(email_messages))
+
+    def analyze_chunks(self, chunks):
+        self.relation_analyzer.analyze_chunks(chunks)
+        self.content_analyzer.analyze_chunks(chunks)
+        if self.needs_fit():
+            is_read = list()
+            relation_scores = list()
+            content_scores = list()
+            for chunk in chunks:
+                is_read.extend(Evaluator.get_is_read(chunk).tolist())
+                relation_scores.extend(self.relation_analyzer.classify(chunk))
+                content_scores.extend(self.content_analyzer.classify(chunk))
+            self._fit_combiner(numpy.array(is_read, dtype=numpy.bool_), relation_scores, content_scores)
+
+    def needs_fit(self):
+        """
+        Whether the combiner itself has to be trained on the relation / content scores of the
+        analyze set.
+        """
+        return False
+
+    def fit_combiner(self, email_messages, relation_scores, content_scores):
+        """
+        Train the combiner from the relation / content scores of email_messages. Only called
+        when needs_fit() is True.
+        """
+        self._fit_combiner(Evaluator.get_is_read(email_messages), relation_scores, content_scores)
+
+    def _fit_combiner(self, is_read, relation_scores, content_scores):
+        pass
 
     def classify(self, email_messages):
         relation_scores = self.relation_analyzer.classify(email_messages)
         content_scores = self.content_analyzer.classify(email_messages)
-        score_len = len(relation_scores)
-        assert score_len == len(content_scores)
-        scores = list()
-        for n in range(score_len):
-            p = relation_scores[n]
-            q = content_scores[n]
-            scores.append(self.combine(p, q))
-        return scores
+        return self.combine_scores(relation_scores, content_scores)
+
+    def combine_scores(self, relation_scores, content_scores):
+        p = numpy.asarray(relation_scores, dtype=numpy.float64)
+        q = numpy.asarray(content_scores, dtype=numpy.float64)
+        assert p.shape == q.shape
+        return self.combine(p, q).tolist()
 
 
+@register_combiner('linear')
 class LinearCombinedAnalyzer(CombinedAnalyzer):
-    def __init__(self):
-        super(LinearCombinedAnalyzer, self).__init__()
+    def __init__(self, relation_analyzer=None, content_analyzer=None):
+        super(LinearCombinedAnalyzer, self).__init__(relation_analyzer, content_analyzer)
         self.combine = LinearCombinedAnalyzer.combine_func
 
     @staticmethod
@@ -36,9 +94,10 @@ class LinearCombinedAnalyzer(CombinedAnalyzer):
         return 0.5*p + 0.5*q
 
 
+@register_combiner('product')
 class ProductCombinedAnalyzer(CombinedAnalyzer):
-    def __init__(self):
-        super(ProductCombinedAnalyzer, self).__init__()
+    def __init__(self, relation_analyzer=None, content_analyzer=None):
+        super(ProductCombinedAnalyzer, self).__init__(relation_analyzer, content_analyzer)
         self.combine = ProductCombinedAnalyzer.combine_func
 
     @staticmethod
@@ -46,11 +105,34 @@ class ProductCombinedAnalyzer(CombinedAnalyzer):
         return p+q-(p*q)
 
 
+@register_combiner('max')
 class MaxCombinedAnalyzer(CombinedAnalyzer):
-    def __init__(self):
-        super(MaxCombinedAnalyzer, self).__init__()
+    def __init__(self, relation_analyzer=None, content_analyzer=None):
+        super(MaxCombinedAnalyzer, self).__init__(relation_analyzer, content_analyzer)
         self.combine = MaxCombinedAnalyzer.combine_func
 
     @staticmethod
     def combine_func(p, q):
-        return max(p, q)
+        return numpy.maximum(p, q)
+
+
+@register_combiner('stacked')
+class StackedCombinedAnalyzer(CombinedAnalyzer):
+    """
+    Learns the weights of the relation and content scores with a logistic regression over
+    the two scores, trained on the analyze set.
+    """
+    def __init__(self, relation_analyzer=None, content_analyzer=None):
+        super(StackedCombinedAnalyzer, self).__init__(relation_analyzer, content_analyzer)
+        self.logreg = linear_model.LogisticRegression(C=1e5, solver='liblinear')
+
+    def needs_fit(self):
+        return True
+
+    def _fit_combiner(self, is_read, relation_scores, content_scores):
+        x = numpy.column_stack((relation_scores, content_scores))
+        self.logreg.fit(x, is_read)
+
+    def combine_scores(self, relation_scores, content_scores):
+        x = numpy.column_stack((relation_scores, content_scores))
+        return self.logreg.predict_proba(x)[:, 1].tolist()
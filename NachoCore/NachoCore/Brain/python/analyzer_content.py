@@ -1,33 +1,119 @@
 from analyzer import Analyzer
+import itertools
 import numpy
 from sklearn import linear_model
-from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from message_store import MessageStore
+from instrumentation import Instrumentation
+from content_features import default_pipeline
 
 
 class ContentAnalyzer(Analyzer):
     def __init__(self):
         self.vectorizer = CountVectorizer(min_df=5)
         self.logreg = linear_model.LogisticRegression(C=1e5)
+        # Optional SubjectFeatureCache. When set, subject features are looked up by message Id
+        # instead of being tokenized.
+        self.feature_cache = None
 
     @staticmethod
     def is_none_or_empty(s):
         return (s is None) or (len(s) == 0)
 
-    def analyze(self, email_messages):
+    @staticmethod
+    def _select(email_messages):
+        """
+        Return (indices, ids, subjects, is_read) of the messages that have a subject.
+        """
+        if isinstance(email_messages, MessageStore):
+            mask = email_messages.has_subject()
+            strings = email_messages.subjects.strings
+            return (numpy.flatnonzero(mask).tolist(), email_messages.ids[mask].tolist(),
+                    [strings[n] for n in email_messages.subject_ids[mask]], email_messages.is_read[mask].tolist())
+        indices = list()
+        ids = list()
         subjects = list()
         is_read = list()
-        for email_message in email_messages:
+        for (n, email_message) in enumerate(email_messages):
             if ContentAnalyzer.is_none_or_empty(email_message.Subject):
                 continue
+            indices.append(n)
+            ids.append(getattr(email_message, 'Id', None))
             subjects.append(email_message.Subject)
             is_read.append(email_message.IsRead)
+        return indices, ids, subjects, is_read
 
-        x = self.vectorizer.fit_transform(subjects)
+    def _fit(self, ids, subjects, is_read):
+        with Instrumentation.stage('vectorize'):
+            if self.feature_cache is None:
+                x = self.vectorizer.fit_transform(subjects)
+            else:
+                x = self.feature_cache.fit_transform(ids, subjects)
+                self.vectorizer = self.feature_cache.vectorizer
         y = numpy.array(is_read)
 
-        self.logreg.fit(x, y)
+        with Instrumentation.stage('fit'):
+            self.logreg.fit(x, y)
+
+    def _transform(self, ids, subjects):
+        # The cache may have been refit by another analyzer since this one was trained
+        if self.feature_cache is None or self.feature_cache.vectorizer is not self.vectorizer:
+            return self.vectorizer.transform(subjects)
+        return self.feature_cache.transform(ids, subjects)
+
+    def analyze(self, email_messages):
+        (_, ids, subjects, is_read) = ContentAnalyzer._select(email_messages)
+        self._fit(ids, subjects, is_read)
+
+    def analyze_chunks(self, chunks):
+        # CountVectorizer needs all subjects at once but only the subjects and read flags are
+        # kept, not the messages themselves.
+        ids = list()
+        subjects = list()
+        is_read = list()
+        for chunk in chunks:
+            selected = ContentAnalyzer._select(chunk)
+            ids.extend(selected[1])
+            subjects.extend(selected[2])
+            is_read.extend(selected[3])
+        self._fit(ids, subjects, is_read)
 
     def classify(self, email_messages):
+        """
+        Score all messages with a single transform() and predict_proba() call. Messages without
+        a subject get the default score of 0.5.
+        """
+        if isinstance(email_messages, MessageStore) and self.feature_cache is None:
+            return self._classify_store(email_messages)
+        scores = numpy.empty(len(email_messages))
+        scores.fill(0.5)
+        (indices, ids, subjects, _) = ContentAnalyzer._select(email_messages)
+        if len(subjects) > 0:
+            with Instrumentation.stage('vectorize'):
+                x = self._transform(ids, subjects)
+            with Instrumentation.stage('predict'):
+                scores[indices] = self.logreg.predict_proba(x)[:, 1]
+        return scores.tolist()
+
+    def _classify_store(self, store):
+        # Each distinct subject is vectorized and scored once and then gathered by subject id
+        scores = numpy.empty(len(store))
+        scores.fill(0.5)
+        mask = store.has_subject()
+        if mask.any():
+            unique_ids = numpy.unique(store.subject_ids[mask])
+            with Instrumentation.stage('vectorize'):
+                x = self.vectorizer.transform([store.subjects[n] for n in unique_ids])
+            with Instrumentation.stage('predict'):
+                unique_scores = self.logreg.predict_proba(x)[:, 1]
+            scores[mask] = unique_scores[numpy.searchsorted(unique_ids, store.subject_ids[mask])]
+        return scores.tolist()
+
+    def classify_each(self, email_messages):
+        """
+        Reference per-message implementation of classify(). It is only kept for benchmarking and
+        verifying the batched path.
+        """
         scores = list()
         for email_message in email_messages:
             if ContentAnalyzer.is_none_or_empty(email_message.Subject):
@@ -37,3 +123,103 @@ class ContentAnalyzer(Analyzer):
             y_est = self.logreg.predict_proba(x)
             scores.append(y_est[0, 1])
         return scores
+
+
+class HashingContentAnalyzer(ContentAnalyzer):
+    """
+    Out-of-core variant of ContentAnalyzer. Subjects are mapped into a fixed-width hashed
+    feature space, so there is no vocabulary to fit, and a logistic model is trained by SGD
+    with partial_fit() one chunk at a time. Memory use depends on the chunk size and
+    n_features but not on the number of messages. update() folds newly arrived messages into
+    the trained model.
+    """
+    CLASSES = numpy.array([False, True])
+
+    def __init__(self, n_features=2 ** 18, chunk_size=10000, epochs=1):
+        super(HashingContentAnalyzer, self).__init__()
+        self.vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False)
+        self.logreg = linear_model.SGDClassifier(loss='log', random_state=0)
+        self.chunk_size = chunk_size
+        self.epochs = epochs
+
+    def _chunks(self, email_messages):
+        num_messages = len(email_messages)
+        for start in range(0, num_messages, self.chunk_size):
+            end = min(start + self.chunk_size, num_messages)
+            if isinstance(email_messages, MessageStore):
+                yield email_messages.subset(numpy.arange(start, end))
+            else:
+                yield email_messages[start:end]
+
+    def _partial_fit(self, email_messages):
+        (_, _, subjects, is_read) = ContentAnalyzer._select(email_messages)
+        if len(subjects) == 0:
+            return
+        with Instrumentation.stage('vectorize'):
+            x = self.vectorizer.transform(subjects)
+        y = numpy.array(is_read, dtype=numpy.bool_)
+        with Instrumentation.stage('fit'):
+            self.logreg.partial_fit(x, y, classes=HashingContentAnalyzer.CLASSES)
+
+    def analyze(self, email_messages):
+        for _ in range(self.epochs):
+            for chunk in self._chunks(email_messages):
+                self._partial_fit(chunk)
+
+    def analyze_chunks(self, chunks):
+        # More than one epoch requires chunks to be re-iterable (e.g. an EmailMessageStream)
+        for _ in range(self.epochs):
+            for chunk in chunks:
+                self._partial_fit(chunk)
+
+    def update(self, email_messages):
+        for chunk in self._chunks(email_messages):
+            self._partial_fit(chunk)
+
+    def _transform(self, ids, subjects):
+        return self.vectorizer.transform(subjects)
+
+
+class FeatureContentAnalyzer(ContentAnalyzer):
+    """
+    ContentAnalyzer over the subject words plus the sender domain, recipient counts, position
+    of the owner in To / Cc, reply / forward markers of the subject and time of DateReceived.
+    The features come from a content_features.FeaturePipeline as one sparse matrix. Messages
+    are scored even without a subject. The feature cache of SubjectFeatureCache is not used.
+    """
+    def __init__(self, pipeline=None):
+        super(FeatureContentAnalyzer, self).__init__()
+        if pipeline is None:
+            pipeline = default_pipeline()
+        self.pipeline = pipeline
+
+    @staticmethod
+    def _store(email_messages):
+        if isinstance(email_messages, MessageStore):
+            return email_messages
+        return MessageStore.from_rows(email_messages)
+
+    def _fit_store(self, store):
+        with Instrumentation.stage('vectorize'):
+            x = self.pipeline.fit_transform(store)
+        with Instrumentation.stage('fit'):
+            self.logreg.fit(x, store.is_read)
+
+    def analyze(self, email_messages):
+        self._fit_store(FeatureContentAnalyzer._store(email_messages))
+
+    def analyze_chunks(self, chunks):
+        # A MessageStore keeps the chunks compactly, with every header string interned once
+        self._fit_store(MessageStore.from_rows(itertools.chain.from_iterable(chunks)))
+
+    def classify(self, email_messages):
+        store = FeatureContentAnalyzer._store(email_messages)
+        if len(store) == 0:
+            return []
+        with Instrumentation.stage('vectorize'):
+            x = self.pipeline.transform(store)
+        with Instrumentation.stage('predict'):
+            return self.logreg.predict_proba(x)[:, 1].tolist()
+
+    def classify_each(self, email_messages):
+        return [self.classify([email_message])[0] for email_message in email_messages]
@@ -1,46 +1,274 @@
+import os
+import cPickle
+import numpy
 from analyzer import Analyzer
 from email_address import EmailAddress, EmailAddressTable
+from email_address_snapshot import EmailAddressSnapshot
+from message_store import MessageStore
 
 
 class RelationAnalyzer(Analyzer):
+    # Version of the files written by save(). 1: EmailAddressTable pickled with its objects.
+    # 2: canonical addresses normalized by address_parser. 3: EmailAddressTable pickled as its
+    # addresses and counters array.
+    STATE_VERSION = 3
+
     def __init__(self):
         self._table = EmailAddressTable()
+        # (IsRead, LastVerbExecuted) of every message counted by update(), keyed by Id
+        self._message_states = dict()
         # Default algorithm is bayes3
         self.analyze_to = True
         self.analyze_cc = True
 
-    def _analyze_one(self, email_message):
-        def update_address(email_address_stats):
-            email_address_stats.num_received += 1
-            if email_message.LastVerbExecuted in [1, 2]:
-                email_address_stats.num_replied += 1
-            elif email_message.IsRead:
-                email_address_stats.num_read += 1
+    @property
+    def table(self):
+        """
+        The address statistics. An EmailAddressTable, or an EmailAddressSnapshot after
+        load_snapshot().
+        """
+        return self._table
 
+    @staticmethod
+    def _is_replied(last_verb_executed):
+        return last_verb_executed in [1, 2]
+
+    def _address_columns(self, email_message):
+        """
+        Yield the (EmailAddress, counter column) pairs that a message contributes to.
+        """
         for to_addr in EmailAddress.parse_address_string(email_message.To):
             if len(to_addr) > 60:
                 continue
-            email_address = self._table.add_or_get(to_addr)
-            update_address(email_address.to_stats)
+            yield self._table.add_or_get(to_addr), EmailAddress.TO
 
         for from_addr in EmailAddress.parse_address_string(email_message.From):
             if len(from_addr) > 60:
                 continue
-            email_address = self._table.add_or_get(from_addr)
-            update_address(email_address.from_stats)
+            yield self._table.add_or_get(from_addr), EmailAddress.FROM
 
         for cc_addr in EmailAddress.parse_address_string(email_message.Cc):
             if len(cc_addr) > 60:
                 continue
-            email_address = self._table.add_or_get(cc_addr)
-            update_address(email_address.cc_stats)
+            yield self._table.add_or_get(cc_addr), EmailAddress.CC
+
+    @staticmethod
+    def _category(is_read, last_verb_executed):
+        if RelationAnalyzer._is_replied(last_verb_executed):
+            return EmailAddressTable.REPLIED
+        if is_read:
+            return EmailAddressTable.READ
+        return EmailAddressTable.UNREAD
+
+    def _analyze_one(self, email_message):
+        category = RelationAnalyzer._category(email_message.IsRead, email_message.LastVerbExecuted)
+        changed = list()
+        for (email_address, column) in self._address_columns(email_message):
+            self._table.add_message(email_address, column, category)
+            changed.append(email_address.canonical_address)
+        return changed
+
+    def _transition_one(self, email_message, old_state):
+        """
+        Move a message that was already counted with old_state = (IsRead, LastVerbExecuted)
+        to its current state. num_received is unchanged. The read / replied counters of the
+        old state are decremented and the ones of the new state incremented.
+        """
+        old_category = RelationAnalyzer._category(*old_state)
+        new_category = RelationAnalyzer._category(email_message.IsRead, email_message.LastVerbExecuted)
+        if old_category == new_category:
+            return []
+        changed = list()
+        for (email_address, column) in self._address_columns(email_message):
+            self._table.move_message(email_address, column, old_category, new_category)
+            changed.append(email_address.canonical_address)
+        return changed
+
+    def _analyze_store(self, store, weights=None):
+        """
+        Vectorized analyze() of a MessageStore. weights is an optional per-message weight that
+        each message counts with instead of 1.
+        """
+        replied = numpy.in1d(store.last_verb_executed, [1, 2])
+        read = store.is_read & ~replied
+        if weights is not None:
+            read = read * weights
+            replied = replied * weights
+        valid_address = store.address_lengths() <= 60
+        num_addresses = len(store.addresses)
+        present = numpy.zeros(num_addresses, dtype=numpy.bool_)
+
+        def count(column):
+            msg_indices = column.message_indices()
+            valid = valid_address[column.ids]
+            address_ids = column.ids[valid]
+            msg_indices = msg_indices[valid]
+            present[address_ids] = True
+            received = numpy.bincount(address_ids, weights=weights[msg_indices] if weights is not None else None,
+                                      minlength=num_addresses)
+            num_read = numpy.bincount(address_ids, weights=read[msg_indices], minlength=num_addresses)
+            num_replied = numpy.bincount(address_ids, weights=replied[msg_indices], minlength=num_addresses)
+            return received, num_read, num_replied
+
+        counts = ((EmailAddress.TO, count(store.to)),
+                  (EmailAddress.FROM, count(store.from_)),
+                  (EmailAddress.CC, count(store.cc)))
+        address_ids = numpy.flatnonzero(present)
+        table_ids = numpy.array([self._table.add_or_get(store.addresses[n]).id for n in address_ids],
+                                dtype=numpy.int64)
+        # Different store addresses may have the same canonical address, hence add.at()
+        table_counts = self._table.counts()
+        for (offset, (received, num_read, num_replied)) in counts:
+            numpy.add.at(table_counts[:, offset], table_ids, received[address_ids].astype(table_counts.dtype))
+            numpy.add.at(table_counts[:, offset + 1], table_ids, num_read[address_ids].astype(table_counts.dtype))
+            numpy.add.at(table_counts[:, offset + 2], table_ids,
+                         num_replied[address_ids].astype(table_counts.dtype))
 
     def analyze(self, email_messages):
+        if isinstance(email_messages, MessageStore):
+            return self._analyze_store(email_messages)
         if not isinstance(email_messages, list):
             self._analyze_one(email_messages)
         for email_message in email_messages:
             self._analyze_one(email_message)
 
+    def analyze_chunks(self, chunks):
+        for chunk in chunks:
+            self.analyze(chunk)
+
+    def update(self, email_messages):
+        """
+        Incrementally fold messages into the statistics. Messages not seen by a previous
+        update() are counted as newly arrived. For messages already seen, only a change of
+        IsRead / LastVerbExecuted is applied (e.g. unread -> read, read -> replied). Each
+        message costs O(1) table operations.
+
+        Returns the set of canonical addresses whose statistics changed.
+        """
+        changed = set()
+        for email_message in email_messages:
+            state = (bool(email_message.IsRead), email_message.LastVerbExecuted or 0)
+            old_state = self._message_states.get(email_message.Id, None)
+            if old_state is None:
+                changed.update(self._analyze_one(email_message))
+            elif old_state != state:
+                changed.update(self._transition_one(email_message, old_state))
+            else:
+                continue
+            self._message_states[email_message.Id] = state
+        return changed
+
+    def _referenced_addresses(self, email_message):
+        """
+        Yield the canonical addresses that classify() looks up for a message.
+        """
+        yield EmailAddress.get_canonical_address(email_message.From)
+        for (enabled, header) in ((self.analyze_to, email_message.To), (self.analyze_cc, email_message.Cc)):
+            if not enabled:
+                continue
+            for addr in EmailAddress.parse_address_string(header):
+                yield EmailAddress.get_canonical_address(addr)
+
+    def _index_store(self, store):
+        # Sender plus the To / Cc CSR columns as (address id, message index) pairs, grouped by
+        # address id with one sort
+        address_ids = [store.sender_ids.astype(numpy.int64)]
+        message_indices = [numpy.arange(len(store), dtype=numpy.int64)]
+        for (enabled, column) in ((self.analyze_to, store.to), (self.analyze_cc, store.cc)):
+            if enabled:
+                address_ids.append(column.ids.astype(numpy.int64))
+                message_indices.append(column.message_indices())
+        address_ids = numpy.concatenate(address_ids)
+        message_indices = numpy.concatenate(message_indices)
+        valid = address_ids >= 0
+        address_ids = address_ids[valid]
+        message_indices = message_indices[valid]
+        order = numpy.argsort(address_ids, kind='mergesort')
+        (unique_ids, starts) = numpy.unique(address_ids[order], return_index=True)
+        index = dict()
+        for (address_id, positions) in zip(unique_ids, numpy.split(message_indices[order], starts[1:])):
+            canonical_address = EmailAddress.get_canonical_address(store.addresses[address_id])
+            index.setdefault(canonical_address, []).extend(positions.tolist())
+        return index
+
+    def index_messages(self, email_messages):
+        """
+        Return {canonical address: positions in email_messages of the messages that reference
+        it}. Build it once for messages that are reclassified repeatedly. A MessageStore is
+        indexed from its address columns without parsing any header.
+        """
+        if isinstance(email_messages, MessageStore):
+            return self._index_store(email_messages)
+        index = dict()
+        for (n, email_message) in enumerate(email_messages):
+            for canonical_address in self._referenced_addresses(email_message):
+                index.setdefault(canonical_address, []).append(n)
+        return index
+
+    def reclassify(self, email_messages, scores, changed, index=None):
+        """
+        Update scores (as returned by classify() for the same messages) in place for only the
+        messages that reference an address in changed. index is index_messages(email_messages).
+        With it, the cost is proportional to the number of rescored messages. Without it, the
+        messages are indexed first. Returns the number of rescored messages.
+        """
+        assert len(email_messages) == len(scores)
+        if len(changed) == 0:
+            return 0
+        if index is None:
+            index = self.index_messages(email_messages)
+        positions = set()
+        for canonical_address in changed:
+            positions.update(index.get(canonical_address, ()))
+        for n in sorted(positions):
+            scores[n] = self._classify_one(email_messages[n])
+        return len(positions)
+
+    def _get_state(self):
+        return {'version': RelationAnalyzer.STATE_VERSION,
+                'table': self._table,
+                'message_states': self._message_states}
+
+    def _set_state(self, state):
+        self._table = state['table']
+        self._message_states = state['message_states']
+
+    def save(self, path):
+        """
+        Save the address statistics and the per-message states seen by update().
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(self._get_state(), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            state = cPickle.load(f)
+        if state.get('version', None) != RelationAnalyzer.STATE_VERSION:
+            raise ValueError('%s has an unsupported relation state version' % path)
+        self._set_state(state)
+
+    def save_snapshot(self, path):
+        """
+        Save the address statistics (without message states) as an EmailAddressSnapshot.
+        """
+        EmailAddressSnapshot.from_table(self._table).save(path)
+
+    def load_snapshot(self, path, writable=False):
+        """
+        Load address statistics saved by save_snapshot(). By default the memory-mapped snapshot
+        is used as the table directly, which is enough for classify(). Set writable to convert
+        it to an EmailAddressTable for further analyze() / update() calls.
+        """
+        snapshot = EmailAddressSnapshot.load(path)
+        if snapshot.counts().dtype.kind == 'f':
+            raise ValueError('%s holds decayed statistics. Load it with DecayedRelationAnalyzer' % path)
+        if writable:
+            self._table = snapshot.to_table()
+        else:
+            self._table = snapshot
+
     def _classify_one(self, email_message):
         top = 0.0
         bottom = 0.0
@@ -71,7 +299,41 @@ class RelationAnalyzer(Analyzer):
 
         return float(top)/float(bottom)
 
+    def _classify_store(self, store):
+        # Look up every distinct address once and gather its counters from the table array
+        num_addresses = len(store.addresses)
+        table_ids = -numpy.ones(num_addresses, dtype=numpy.int64)
+        for (address_id, address) in enumerate(store.addresses.strings):
+            email_addr = self._table.get(address)
+            if email_addr is not None:
+                table_ids[address_id] = email_addr.id
+        found = table_ids >= 0
+        table_counts = self._table.counts()[table_ids[found]]
+        tops = numpy.zeros((3, num_addresses))
+        bottoms = numpy.zeros((3, num_addresses))
+        for (k, offset) in enumerate((EmailAddress.FROM, EmailAddress.TO, EmailAddress.CC)):
+            tops[k, found] = table_counts[:, offset + 1] + table_counts[:, offset + 2]
+            bottoms[k, found] = table_counts[:, offset]
+
+        num_messages = len(store)
+        has_sender = store.sender_ids >= 0
+        top = numpy.where(has_sender, tops[0][store.sender_ids], 0.0)
+        bottom = numpy.where(has_sender, bottoms[0][store.sender_ids], 0.0)
+        for (k, enabled, column) in ((1, self.analyze_to, store.to), (2, self.analyze_cc, store.cc)):
+            if not enabled:
+                continue
+            msg_indices = column.message_indices()
+            top += numpy.bincount(msg_indices, weights=tops[k][column.ids], minlength=num_messages)
+            bottom += numpy.bincount(msg_indices, weights=bottoms[k][column.ids], minlength=num_messages)
+
+        scores = numpy.zeros(num_messages)
+        nonzero = bottom != 0
+        scores[nonzero] = top[nonzero] / bottom[nonzero]
+        return scores.tolist()
+
     def classify(self, email_messages):
+        if isinstance(email_messages, MessageStore):
+            return self._classify_store(email_messages)
         if not isinstance(email_messages, list):
             return self._classify_one(email_messages)
         scores = list()
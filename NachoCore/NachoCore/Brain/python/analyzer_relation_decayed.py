@@ -0,0 +1,177 @@
+import array
+import json
+import os
+import numpy
+from analyzer_relation import RelationAnalyzer
+from email_address import EmailAddressTable
+from email_address_snapshot import EmailAddressSnapshot
+
+
+class DecayedRelationAnalyzer(RelationAnalyzer):
+    """
+    RelationAnalyzer whose counters decay exponentially with the age of the messages. A message
+    counts 1 at its DateReceived and half as much every half_life_days after.
+
+    Each address keeps fractional counters valid at one time, the latest DateReceived that
+    touched it, in EmailAddressTable('d'). A newer message first decays the counters of its
+    addresses to its own time and then adds 1. An older message adds its weight at the time of
+    the counters. Either way a message costs O(1) per address, without revisiting history.
+    Before classifying, all counters are decayed to the latest DateReceived seen (now), so that
+    the counters of different addresses are comparable.
+
+    Messages without DateReceived are counted at now.
+    """
+    TICKS_PER_DAY = 24 * 3600 * 10000000
+    # Half life and time of the counters of a snapshot, next to its addresses and counts
+    DECAY_FILE = 'decay.json'
+
+    def __init__(self, half_life_days=90.0):
+        super(DecayedRelationAnalyzer, self).__init__()
+        assert half_life_days > 0.0
+        self._table = EmailAddressTable('d')
+        self.half_life_days = half_life_days
+        # Time (DateReceived ticks) of the counters of each address, indexed by address id
+        self._last_ticks = array.array('l')
+        # Latest DateReceived seen
+        self.now = 0
+
+    def _half_life_ticks(self):
+        return float(self.half_life_days) * DecayedRelationAnalyzer.TICKS_PER_DAY
+
+    def _get_ticks(self, email_message):
+        ticks = getattr(email_message, 'DateReceived', None) or self.now
+        if ticks > self.now:
+            self.now = ticks
+        return ticks
+
+    def _grow(self, ticks=0):
+        """
+        Set the time of the counters of addresses added to the table since the last call.
+        """
+        missing = self._table.count() - len(self._last_ticks)
+        if missing > 0:
+            self._last_ticks.extend([ticks] * missing)
+
+    def _advance(self, email_address, ticks):
+        """
+        Decay the counters of email_address to ticks if they are older. Returns the weight of a
+        message received at ticks relative to the time of the counters.
+        """
+        self._grow()
+        last = self._last_ticks[email_address.id]
+        if ticks >= last:
+            if ticks > last:
+                self._table.scale(email_address, 0.5 ** (float(ticks - last) / self._half_life_ticks()))
+                self._last_ticks[email_address.id] = ticks
+            return 1.0
+        return 0.5 ** (float(last - ticks) / self._half_life_ticks())
+
+    def _decay_to(self, ticks):
+        """
+        Decay the counters of every address that are older than ticks to ticks.
+        """
+        self._grow()
+        if len(self._last_ticks) == 0:
+            return
+        last = numpy.frombuffer(self._last_ticks, dtype=numpy.dtype('l'))
+        behind = numpy.flatnonzero(last < ticks)
+        if len(behind) == 0:
+            # Nothing to do. This also keeps a read-only snapshot table untouched.
+            return
+        counts = self._table.counts()
+        counts[behind] *= (0.5 ** ((ticks - last[behind]) / self._half_life_ticks()))[:, numpy.newaxis]
+        last[behind] = ticks
+
+    def _analyze_one(self, email_message):
+        ticks = self._get_ticks(email_message)
+        category = RelationAnalyzer._category(email_message.IsRead, email_message.LastVerbExecuted)
+        changed = list()
+        for (email_address, column) in self._address_columns(email_message):
+            weight = self._advance(email_address, ticks)
+            self._table.add_message(email_address, column, category, weight)
+            changed.append(email_address.canonical_address)
+        return changed
+
+    def _transition_one(self, email_message, old_state):
+        old_category = RelationAnalyzer._category(*old_state)
+        new_category = RelationAnalyzer._category(email_message.IsRead, email_message.LastVerbExecuted)
+        if old_category == new_category:
+            return []
+        ticks = self._get_ticks(email_message)
+        changed = list()
+        for (email_address, column) in self._address_columns(email_message):
+            # The message was counted at ticks so it has decayed along with the counters
+            weight = self._advance(email_address, ticks)
+            self._table.move_message(email_address, column, old_category, new_category, weight)
+            changed.append(email_address.canonical_address)
+        return changed
+
+    def _analyze_store(self, store, weights=None):
+        ticks = store.date_received.astype(numpy.int64)
+        if len(ticks) > 0:
+            self.now = max(self.now, int(ticks.max()))
+        ticks[ticks <= 0] = self.now
+        # Bring the existing counters to now and weigh every message relative to now
+        self._decay_to(self.now)
+        weights = 0.5 ** ((self.now - ticks) / self._half_life_ticks())
+        super(DecayedRelationAnalyzer, self)._analyze_store(store, weights)
+        self._grow(self.now)
+
+    def decay(self):
+        """
+        Decay all counters to now. classify() starts with this. Calling it ahead makes the
+        following classify() calls read-only, until the next analyze() / update().
+        """
+        self._decay_to(self.now)
+
+    def reclassify(self, email_messages, scores, changed, index=None):
+        self._decay_to(self.now)
+        return super(DecayedRelationAnalyzer, self).reclassify(email_messages, scores, changed, index)
+
+    def classify(self, email_messages):
+        self._decay_to(self.now)
+        return super(DecayedRelationAnalyzer, self).classify(email_messages)
+
+    def _get_state(self):
+        state = super(DecayedRelationAnalyzer, self)._get_state()
+        state['half_life_days'] = self.half_life_days
+        state['last_ticks'] = self._last_ticks
+        state['now'] = self.now
+        return state
+
+    def _set_state(self, state):
+        if state.get('half_life_days', None) != self.half_life_days:
+            raise ValueError('relation state was not saved with a half life of %g days' % self.half_life_days)
+        super(DecayedRelationAnalyzer, self)._set_state(state)
+        self._last_ticks = state['last_ticks']
+        self.now = state['now']
+
+    def save_snapshot(self, path):
+        """
+        Decay all counters to now and save them as an EmailAddressSnapshot, along with now and
+        the half life. Message states are not saved, as with RelationAnalyzer.
+        """
+        self._decay_to(self.now)
+        super(DecayedRelationAnalyzer, self).save_snapshot(path)
+        decay_path = os.path.join(path, DecayedRelationAnalyzer.DECAY_FILE)
+        with open(decay_path + '.tmp', 'w') as f:
+            json.dump({'half_life_days': self.half_life_days, 'now': self.now}, f)
+        os.rename(decay_path + '.tmp', decay_path)
+
+    def load_snapshot(self, path, writable=False):
+        """
+        Load counters saved by save_snapshot(). They are all valid at the saved now, so the
+        memory-mapped snapshot can be classified with as is until the next analyze() / update(),
+        which need writable.
+        """
+        decay_path = os.path.join(path, DecayedRelationAnalyzer.DECAY_FILE)
+        if not os.path.exists(decay_path):
+            raise ValueError('%s was not saved by DecayedRelationAnalyzer' % path)
+        with open(decay_path, 'r') as f:
+            decay = json.load(f)
+        if decay['half_life_days'] != self.half_life_days:
+            raise ValueError('%s was not saved with a half life of %g days' % (path, self.half_life_days))
+        snapshot = EmailAddressSnapshot.load(path)
+        self._table = snapshot.to_table() if writable else snapshot
+        self.now = decay['now']
+        self._last_ticks = array.array('l', [self.now] * snapshot.count())
@@ -0,0 +1,107 @@
+from sqlalchemy import text
+from model import Model
+from analyzer_relation import RelationAnalyzer
+from email_address import EmailAddress
+from message_store import MessageStore
+from instrumentation import Instrumentation
+
+
+class SqlRelationAnalyzer(RelationAnalyzer):
+    """
+    RelationAnalyzer whose statistics are aggregated by SQLite instead of by parsing the
+    From / To / Cc headers in Python. The device database links every message to its
+    addresses in McMapEmailAddressEntry (ObjectId is the message Id), so the received / read /
+    replied counts of all addresses are a single GROUP BY over McEmailMessage joined to
+    McMapEmailAddressEntry.
+
+    The messages must come from the database opened by Model (Model.open() / load() /
+    stream() or MessageStore.load()) as only their Ids are used. classify(), update() and
+    the state / snapshot methods are the ones of RelationAnalyzer.
+    """
+    # EmailMessageAddressType (McMapEmailAddressEntry.AddressType) -> counter column
+    ADDRESS_TYPES = {
+        1: EmailAddress.FROM,  # From
+        4: EmailAddress.TO,    # To
+        5: EmailAddress.CC,    # Cc
+    }
+
+    STATISTICS_QUERY = """
+        SELECT a.CanonicalEmailAddress, e.AddressType, COUNT(*),
+               SUM(CASE WHEN m.LastVerbExecuted IN (1, 2) THEN 0 WHEN m.IsRead THEN 1 ELSE 0 END),
+               SUM(CASE WHEN m.LastVerbExecuted IN (1, 2) THEN 1 ELSE 0 END)
+        FROM McMapEmailAddressEntry AS e
+        JOIN McEmailMessage AS m ON m.Id = e.ObjectId
+        JOIN McEmailAddress AS a ON a.Id = e.EmailAddressId
+        %s
+        WHERE e.AddressType IN (1, 4, 5) AND length(a.CanonicalEmailAddress) <= 60
+        GROUP BY e.EmailAddressId, e.AddressType
+    """
+
+    @staticmethod
+    def _get_ids(email_messages):
+        if isinstance(email_messages, MessageStore):
+            return email_messages.ids.tolist()
+        if not isinstance(email_messages, list):
+            return [email_messages.Id]
+        return [email_message.Id for email_message in email_messages]
+
+    def _add_rows(self, rows):
+        for (canonical_address, address_type, received, num_read, num_replied) in rows:
+            self._table.add_counts(self._table.add_or_get(canonical_address),
+                                   SqlRelationAnalyzer.ADDRESS_TYPES[address_type],
+                                   received, num_read, num_replied)
+
+    def analyze(self, email_messages):
+        ids = SqlRelationAnalyzer._get_ids(email_messages)
+        if len(ids) == 0:
+            return
+        with Instrumentation.stage('sql aggregation'):
+            self._analyze_ids(ids)
+
+    def _analyze_ids(self, ids):
+        connection = Model.engine.connect()
+        try:
+            num_messages = connection.execute(text('SELECT COUNT(*) FROM McEmailMessage')).scalar()
+            if len(set(ids)) == num_messages:
+                # All messages. No need to restrict the join.
+                self._add_rows(connection.execute(text(SqlRelationAnalyzer.STATISTICS_QUERY % '')))
+                return
+            # A subset (a chunk or a cross-validation fold). Join on a temporary table of the Ids.
+            connection.execute(text('CREATE TEMP TABLE IF NOT EXISTS AnalyzedMessage (Id INTEGER PRIMARY KEY)'))
+            connection.execute(text('DELETE FROM AnalyzedMessage'))
+            connection.execute(text('INSERT OR IGNORE INTO AnalyzedMessage (Id) VALUES (:id)'),
+                               [{'id': id_} for id_ in ids])
+            join = 'JOIN temp.AnalyzedMessage AS s ON s.Id = m.Id'
+            self._add_rows(connection.execute(text(SqlRelationAnalyzer.STATISTICS_QUERY % join)))
+            connection.execute(text('DROP TABLE temp.AnalyzedMessage'))
+        finally:
+            connection.close()
+
+
+def compare_backends(email_messages):
+    """
+    Analyze email_messages with both RelationAnalyzer and SqlRelationAnalyzer and return the
+    addresses whose statistics differ as a list of (canonical address, Python counters, SQL
+    counters). Each counters entry is the (from, to, cc) x (received, read, replied) row of
+    EmailAddressTable.counts(), or None if that backend does not know the address.
+    """
+    python_analyzer = RelationAnalyzer()
+    python_analyzer.analyze(email_messages)
+    sql_analyzer = SqlRelationAnalyzer()
+    sql_analyzer.analyze(email_messages)
+
+    def rows(analyzer):
+        counts = analyzer._table.counts()
+        return dict([(email_address.canonical_address, tuple(counts[email_address.id].tolist()))
+                     for email_address in analyzer._table.get_all()
+                     if counts[email_address.id].any()])
+
+    python_rows = rows(python_analyzer)
+    sql_rows = rows(sql_analyzer)
+    mismatches = list()
+    for canonical_address in sorted(set(python_rows.keys()) | set(sql_rows.keys())):
+        python_row = python_rows.get(canonical_address, None)
+        sql_row = sql_rows.get(canonical_address, None)
+        if python_row != sql_row:
+            mismatches.append((canonical_address, python_row, sql_row))
+    return mismatches
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import fnmatch
+import json
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+import numpy
+from model import Model
+from message_store import MessageStore
+from evaluator import Evaluator, EvaluatorResult
+from analyzer_combined import COMBINERS
+import algo
+
+
+# Columns of a result row. One row per (database, analyzer). A database that fails has a
+# single row with the error and an empty analyzer.
+FIELDS = ('db_file', 'analyzer', 'total', 'read', 'unread', 'hot', 'not_hot', 'misses', 'false_alarms',
+          'error_rate', 'miss_rate', 'false_alarms_rate', 'hot_error_rate', 'not_hot_error_rate',
+          'roc_auc', 'average_precision', 'seconds', 'error')
+COUNTS = ('total', 'read', 'unread', 'hot', 'not_hot', 'misses', 'false_alarms')
+RATES = ('error_rate', 'miss_rate', 'false_alarms_rate', 'hot_error_rate', 'not_hot_error_rate',
+         'roc_auc', 'average_precision', 'seconds')
+# Labels in the report, the same as in the per-database summaries
+LABELS = dict(EvaluatorResult.RATE_LABELS, roc_auc='ROC AUC', average_precision='average precision',
+              seconds='seconds')
+
+# State inherited by forked pool workers
+_worker_state = dict()
+
+
+def find_databases(paths, pattern='*.db'):
+    """
+    Expand directories (recursively) into the database files in them that match pattern.
+    """
+    db_files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for (directory, _, file_names) in os.walk(path):
+                for file_name in sorted(fnmatch.filter(file_names, pattern)):
+                    db_files.append(os.path.join(directory, file_name))
+        else:
+            db_files.append(path)
+    return sorted(set([os.path.realpath(db_file) for db_file in db_files]))
+
+
+def result_row(db_file, name, results, seconds):
+    row = OrderedDict([('db_file', db_file), ('analyzer', name)])
+    for field in COUNTS:
+        row[field] = getattr(results, field)
+    for field in ('error_rate', 'miss_rate', 'false_alarms_rate', 'hot_error_rate', 'not_hot_error_rate'):
+        row[field] = getattr(results, field)
+    if results.sweep is not None:
+        row['roc_auc'] = results.sweep.auc()
+        row['average_precision'] = results.sweep.average_precision()
+    else:
+        row['roc_auc'] = None
+        row['average_precision'] = None
+    row['seconds'] = seconds
+    row['error'] = None
+    return row
+
+
+def _score_database(db_file):
+    """
+    Evaluate all analyzers on one database. Never raises. Errors are returned as a row.
+    """
+    options = _worker_state['options']
+    try:
+        if options.columnar:
+            email_messages = MessageStore.load(db_file)
+        else:
+            Model.load(db_file, columns=Model.ANALYZED_COLUMNS)
+            email_messages = Model.email_messages
+        evaluator = Evaluator()
+        evaluator.hot_threshold = options.hot_threshold
+        evaluator.sweep = options.sweep
+        rows = list()
+        for name in options.analyzers:
+            start = time.time()
+            results = algo.run(name, email_messages, evaluator, relation_backend=options.relation_backend,
+                               half_life=options.half_life)
+            rows.append(result_row(db_file, name, results, time.time() - start))
+        return db_file, rows
+    except Exception as e:
+        row = OrderedDict([(field, None) for field in FIELDS])
+        row['db_file'] = db_file
+        row['analyzer'] = ''
+        row['error'] = '%s: %s' % (type(e).__name__, (str(e).splitlines() or [''])[0])
+        return db_file, [row]
+
+
+class ResultFile:
+    """
+    Result rows in CSV or JSON lines (by file extension). Rows are appended and flushed one
+    database at a time, so an interrupted run loses at most the database being written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.lower().endswith('.csv')
+
+    def _truncate_partial_line(self):
+        # A run killed in the middle of a write leaves a partial last line
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            if len(data) > 0 and not data.endswith('\n'):
+                f.seek(data.rfind('\n') + 1)
+                f.truncate()
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return list()
+        self._truncate_partial_line()
+        rows = list()
+        with open(self.path, 'rb') as f:
+            if self.is_csv:
+                for row in csv.DictReader(f):
+                    rows.append(OrderedDict([(field, ResultFile._parse(row.get(field, None))) for field in FIELDS]))
+            else:
+                for line in f:
+                    rows.append(json.loads(line, object_pairs_hook=OrderedDict))
+        return rows
+
+    @staticmethod
+    def _parse(value):
+        if value is None or value == '':
+            return None
+        for type_ in (int, float):
+            try:
+                return type_(value)
+            except ValueError:
+                pass
+        return value
+
+    def append(self, rows):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'ab') as f:
+            if self.is_csv:
+                writer = csv.DictWriter(f, FIELDS)
+                if new_file:
+                    writer.writeheader()
+                for row in rows:
+                    writer.writerow(dict([(k, '' if v is None else v) for (k, v) in row.items()]))
+            else:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def completed_databases(rows, analyzers):
+    """
+    Databases that have a successful row for every analyzer. Failed databases are retried.
+    """
+    done = dict()
+    for row in rows:
+        if row.get('error', None) is None:
+            done.setdefault(row['db_file'], set()).add(row['analyzer'])
+    return set([db_file for (db_file, names) in done.items() if set(analyzers) <= names])
+
+
+def aggregate_report(rows, analyzers=None):
+    """
+    Cross-device summary of result rows. Per analyzer, the pooled rates weigh every message
+    equally and the mean / median / stddev across devices weigh every device equally.
+    """
+    # Only the latest row of each (database, analyzer) counts, in case a database was rerun
+    latest = OrderedDict()
+    failed = set()
+    for row in rows:
+        if row.get('error', None) is not None:
+            failed.add(row['db_file'])
+            continue
+        latest[(row['db_file'], row['analyzer'])] = row
+        failed.discard(row['db_file'])
+    by_analyzer = OrderedDict()
+    for ((_, name), row) in latest.items():
+        if analyzers is not None and name not in analyzers:
+            continue
+        by_analyzer.setdefault(name, list()).append(row)
+
+    out = 'devices: %d  failed: %d\n' % (len(set([db_file for (db_file, _) in latest.keys()])), len(failed))
+    for (name, analyzer_rows) in by_analyzer.items():
+        out += '\n' + '-' * 10 + ' ' + name + ' ' + '-' * 10 + '\n'
+        totals = dict([(field, sum([row[field] for row in analyzer_rows])) for field in COUNTS])
+        out += 'devices: %d  messages: %d\n' % (len(analyzer_rows), totals['total'])
+        if totals['total'] > 0:
+            out += 'pooled error rate: %.3f%%  miss rate: %.3f%%  false alarm rate: %.3f%%\n' % \
+                   (100.0 * (totals['misses'] + totals['false_alarms']) / totals['total'],
+                    100.0 * totals['misses'] / totals['total'], 100.0 * totals['false_alarms'] / totals['total'])
+        for field in RATES:
+            values = numpy.array([row[field] for row in analyzer_rows if row.get(field, None) is not None],
+                                 dtype=numpy.float64)
+            if len(values) == 0:
+                continue
+            (scale, unit) = (1.0, '') if field in ('roc_auc', 'average_precision', 'seconds') else (100.0, '%%')
+            out += ('%s: mean %.3f{0}  median %.3f{0}  stddev %.3f{0}  min %.3f{0}  max %.3f{0}\n'.format(unit)) % \
+                   (LABELS[field], numpy.mean(values) * scale, numpy.median(values) * scale,
+                    len(values) > 1 and numpy.std(values, ddof=1) * scale or 0.0,
+                    numpy.min(values) * scale, numpy.max(values) * scale)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate analyzers over many device databases')
+    parser.add_argument('paths', nargs='+', help='Database files or directories of them')
+    parser.add_argument('--analyzers', default='bayes1,bayes3,logistic,linear',
+                        help='Comma-separated analyzers (bayes1, bayes3, logistic, hashing, features, %s)' %
+                             ', '.join(sorted(COMBINERS)))
+    parser.add_argument('--output', '-o', required=True,
+                        help='Result file. .csv for CSV, anything else for JSON lines. Databases already'
+                             ' in it are skipped')
+    parser.add_argument('--pattern', default='*.db', help='File name pattern of databases in directories')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of databases evaluated in parallel (default: # of CPUs)')
+    parser.add_argument('--restart', action='store_true',
+                        help='Discard the results in --output instead of resuming')
+    parser.add_argument('--report-only', action='store_true',
+                        help='Only print the aggregate report of the results in --output')
+    parser.add_argument('--columnar', action='store_true', help='Load databases into a MessageStore')
+    parser.add_argument('--hot-threshold', type=float, default=0.5, help='Score at or above which a message is hot')
+    parser.add_argument('--sweep', action='store_true', help='Also report ROC AUC and average precision')
+    parser.add_argument('--relation-backend', choices=sorted(algo.RELATION_BACKENDS), default='python',
+                        help='How the relation statistics are computed')
+    parser.add_argument('--half-life', type=float, default=None, metavar='DAYS',
+                        help='Decay the relation statistics with a half life of DAYS days')
+    options = parser.parse_args()
+    options.analyzers = options.analyzers.split(',')
+    if options.half_life is not None and options.relation_backend != 'python':
+        parser.error('--half-life cannot be combined with --relation-backend sql')
+
+    result_file = ResultFile(options.output)
+    if options.restart and os.path.exists(options.output):
+        os.remove(options.output)
+    rows = result_file.read()
+
+    if not options.report_only:
+        db_files = find_databases(options.paths, options.pattern)
+        done = completed_databases(rows, options.analyzers)
+        todo = [db_file for db_file in db_files if db_file not in done]
+        print '%d databases, %d already done, %d to run' % (len(db_files), len(db_files) - len(todo), len(todo))
+
+        _worker_state.clear()
+        _worker_state['options'] = options
+        # One database per worker process so that Model state and memory do not carry over
+        pool = multiprocessing.Pool(processes=options.processes, maxtasksperchild=1)
+        try:
+            for (n, (db_file, db_rows)) in enumerate(pool.imap_unordered(_score_database, todo)):
+                result_file.append(db_rows)
+                rows.extend(db_rows)
+                status = db_rows[0]['error'] or 'ok'
+                print '[%d/%d] %s: %s' % (n + 1, len(todo), db_file, status)
+        except BaseException:
+            # Interrupted. Whatever was appended so far is picked up by the next run.
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+
+    print aggregate_report(rows, options.analyzers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+from synthetic_mailbox import SyntheticMailbox
+
+
+BASELINE_VERSION = 1
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def generate(args):
+    (mailbox, path) = args
+    mailbox.generate(path)
+
+
+def run_size(args):
+    """
+    Time loading, every analyzer and the evaluation of one database. Runs in a fresh process so
+    that the peak RSS belongs to this database only. Returns an OrderedDict of step -> seconds
+    plus peak_rss_mb.
+    """
+    (db_path, analyzers, columnar) = args
+    # Imported here so that the parent process stays small
+    from model import Model
+    from message_store import MessageStore
+    from evaluator import Evaluator
+    from algo import get_analyzer
+
+    results = OrderedDict()
+    if columnar:
+        (email_messages, results['load']) = timed(MessageStore.load, db_path)
+    else:
+        (_, results['load']) = timed(Model.load, db_path, Model.ANALYZED_COLUMNS)
+        email_messages = Model.email_messages
+    evaluator = Evaluator()
+    for name in analyzers:
+        analyzer = get_analyzer(name)
+        (_, results['%s.analyze' % name]) = timed(analyzer.analyze, email_messages)
+        (scores, results['%s.classify' % name]) = timed(analyzer.classify, email_messages)
+        (_, results['%s.evaluate' % name]) = timed(evaluator.evaluate, email_messages, scores)
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def in_new_process(func, args):
+    pool = multiprocessing.Pool(processes=1)
+    try:
+        return pool.apply(func, (args,))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def compare(size, step, value, baseline, tolerance, min_seconds):
+    """
+    Return the comparison column of a step and whether it regressed. Timings that are slower
+    by less than min_seconds are not regressions, as very short steps are mostly noise.
+    """
+    reference = baseline.get('results', {}).get(str(size), {}).get(step, None)
+    if reference is None or reference <= 0.0:
+        return '', False
+    ratio = value / reference
+    regressed = ratio > 1.0 + tolerance and (step == 'peak_rss_mb' or value - reference >= min_seconds)
+    return '%6.2fx baseline%s' % (ratio, regressed and '  REGRESSION' or ''), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Brain analyzers on synthetic mailboxes')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='Comma-separated numbers of messages')
+    parser.add_argument('--analyzers', default='bayes1,bayes3,logistic,linear',
+                        help='Comma-separated analyzers (as in algo.py)')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Load into a MessageStore instead of ORM objects')
+    parser.add_argument('--data-dir', default='benchmark_data',
+                        help='Directory of the generated databases. They are reused across runs')
+    parser.add_argument('--zipf', type=float, default=1.2, help='Zipf exponent of address popularity')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='Number of distinct subject words')
+    parser.add_argument('--read-rate', type=float, default=0.6, help='Base probability of a message being read')
+    parser.add_argument('--reply-rate', type=float, default=0.1, help='Approximate fraction of replied messages')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--baseline', default=None, metavar='FILE',
+                        help='Compare against the results stored in FILE')
+    parser.add_argument('--save-baseline', default=None, metavar='FILE',
+                        help='Store the results in FILE as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown (or RSS growth) over the baseline reported as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='Minimum absolute slowdown over the baseline reported as a regression')
+    options = parser.parse_args()
+
+    sizes = [int(x) for x in options.sizes.split(',')]
+    analyzers = options.analyzers.split(',')
+    baseline = dict()
+    if options.baseline is not None:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('version', None) != BASELINE_VERSION:
+            parser.error('%s has an unsupported baseline version' % options.baseline)
+        if baseline.get('columnar', False) != options.columnar or baseline.get('analyzers', analyzers) != analyzers:
+            print 'warning: the baseline was recorded with different --columnar / --analyzers options'
+    if not os.path.exists(options.data_dir):
+        os.makedirs(options.data_dir)
+
+    all_results = OrderedDict()
+    regressions = 0
+    for size in sizes:
+        mailbox = SyntheticMailbox(size, zipf_s=options.zipf, vocabulary_size=options.vocabulary,
+                                   read_rate=options.read_rate, reply_rate=options.reply_rate, seed=options.seed)
+        db_path = os.path.join(options.data_dir, mailbox.name())
+        if not os.path.exists(db_path):
+            print 'generating %s' % db_path
+            in_new_process(generate, (mailbox, db_path))
+        results = in_new_process(run_size, (db_path, analyzers, options.columnar))
+        all_results[str(size)] = results
+
+        print '-' * 10, '%d messages' % size, '-' * 10
+        for (step, value) in results.items():
+            (comparison, regressed) = compare(size, step, value, baseline, options.tolerance,
+                                            options.min_seconds)
+            regressions += regressed
+            if step == 'peak_rss_mb':
+                print '%-24s %10.1f MB %28s %s' % ('peak RSS', value, '', comparison)
+            else:
+                throughput = size / value if value > 0.0 else float('inf')
+                print '%-24s %10.3f sec %14.0f msgs/sec %s' % (step, value, throughput, comparison)
+
+    if options.save_baseline is not None:
+        with open(options.save_baseline + '.tmp', 'w') as f:
+            json.dump(OrderedDict([('version', BASELINE_VERSION),
+                                   ('time', time.time()),
+                                   ('columnar', options.columnar),
+                                   ('analyzers', analyzers),
+                                   ('results', all_results)]), f, indent=2)
+        os.rename(options.save_baseline + '.tmp', options.save_baseline)
+
+    if regressions > 0:
+        print '%d regressions' % regressions
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import argparse
+import random
+import time
+from collections import namedtuple
+from analyzer_content import ContentAnalyzer
+
+
+SyntheticMessage = namedtuple('SyntheticMessage', ['Subject', 'IsRead'])
+
+
+def make_corpus(num_messages, vocabulary_size, seed):
+    """
+    Generate messages with random subjects drawn from a fixed vocabulary. About 5% of the messages
+    have no subject so that the default score path is exercised as well.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['word%d' % n for n in range(vocabulary_size)]
+    email_messages = list()
+    for n in range(num_messages):
+        if rng.random() < 0.05:
+            subject = ''
+        else:
+            subject = ' '.join([rng.choice(vocabulary) for _ in range(rng.randint(1, 8))])
+        email_messages.append(SyntheticMessage(Subject=subject, IsRead=rng.random() < 0.5))
+    return email_messages
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare batched and per-message ContentAnalyzer.classify()')
+    parser.add_argument('--messages', '-n', type=int, default=100000, help='Number of synthetic messages')
+    parser.add_argument('--vocabulary', type=int, default=2000, help='Number of distinct subject words')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    options = parser.parse_args()
+
+    email_messages = make_corpus(options.messages, options.vocabulary, options.seed)
+    analyzer = ContentAnalyzer()
+    (_, analyze_time) = timed(analyzer.analyze, email_messages)
+    (batch_scores, batch_time) = timed(analyzer.classify, email_messages)
+    (each_scores, each_time) = timed(analyzer.classify_each, email_messages)
+
+    max_diff = max([abs(p - q) for (p, q) in zip(batch_scores, each_scores)])
+    print 'messages: %d' % len(email_messages)
+    print 'analyze: %.3f sec' % analyze_time
+    print 'classify (per-message): %.3f sec' % each_time
+    print 'classify (batched): %.3f sec' % batch_time
+    print 'speedup: %.1fx' % (each_time / max(batch_time, 1e-9))
+    print 'max score difference: %g' % max_diff
+
+
+if __name__ == '__main__':
+    main()
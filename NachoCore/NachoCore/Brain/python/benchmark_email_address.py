@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import argparse
+import email.utils
+import multiprocessing
+import random
+import resource
+import time
+from email_address import EmailAddress, EmailAddressTable
+
+
+class LegacyEmailAddressStatistics:
+    """
+    The dict-backed statistics class that EmailAddressTable used before it became array-backed.
+    """
+    def __init__(self):
+        self.num_received = 0
+        self.num_read = 0
+        self.num_replied = 0
+
+    def score(self):
+        if self.num_received == 0:
+            return 0.0
+        return float(self.num_read + self.num_replied) / float(self.num_received)
+
+    def has_received(self):
+        return self.num_received > 0
+
+
+class LegacyEmailAddress:
+    def __init__(self, address):
+        self.original_address = address
+        (self.name, self.canonical_address) = email.utils.parseaddr(address)
+        self.from_stats = LegacyEmailAddressStatistics()
+        self.to_stats = LegacyEmailAddressStatistics()
+        self.cc_stats = LegacyEmailAddressStatistics()
+
+
+class LegacyEmailAddressTable:
+    def __init__(self):
+        self._table = dict()
+
+    def add_or_get(self, address):
+        email_address = self._table.get(address, None)
+        if email_address is None:
+            email_address = LegacyEmailAddress(address)
+            self._table[address] = email_address
+        return email_address
+
+    def count_from(self):
+        return len([x for x in self._table.values() if x.from_stats.has_received()])
+
+    def get_has_to(self):
+        return [x for x in self._table.values() if x.to_stats.has_received()]
+
+    def bayes1_scores(self):
+        return [x.from_stats.score() for x in self._table.values()]
+
+
+def make_updates(num_addresses, num_updates, seed):
+    rng = random.Random(seed)
+    addresses = ['user%d@example%d.com' % (n, n % 97) for n in range(num_addresses)]
+    updates = list()
+    for n in range(num_updates):
+        if n < num_addresses:
+            address = addresses[n]
+        else:
+            # Skewed towards the first addresses like real correspondents
+            address = addresses[min(int(rng.paretovariate(1.0)) - 1, num_addresses - 1)]
+        updates.append((address, rng.randint(0, 2), rng.random() < 0.5, rng.random() < 0.1))
+    return updates
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_one(args):
+    """
+    Build one kind of table in a fresh process and return (build time, query time, RSS growth).
+    'views' updates the array-backed table through the from_stats / to_stats / cc_stats views.
+    """
+    (kind, num_addresses, num_updates, seed) = args
+    updates = make_updates(num_addresses, num_updates, seed)
+    # Canonical addresses are already canonical. Keep address parsing out of the measurement.
+    EmailAddress.get_canonical_address = staticmethod(lambda address: address)
+    rss_before = max_rss_kb()
+
+    start = time.time()
+    if kind == 'legacy':
+        table = LegacyEmailAddressTable()
+    else:
+        table = EmailAddressTable()
+    columns = (EmailAddress.FROM, EmailAddress.TO, EmailAddress.CC)
+    for (address, kind_, is_read, is_replied) in updates:
+        email_address = table.add_or_get(address)
+        if kind == 'array':
+            # The RelationAnalyzer path. It updates the counters without creating views.
+            category = is_replied and EmailAddressTable.REPLIED or \
+                (is_read and EmailAddressTable.READ or EmailAddressTable.UNREAD)
+            table.add_message(email_address, columns[kind_], category)
+            continue
+        if kind_ == 0:
+            stats = email_address.from_stats
+        elif kind_ == 1:
+            stats = email_address.to_stats
+        else:
+            stats = email_address.cc_stats
+        stats.num_received += 1
+        if is_replied:
+            stats.num_replied += 1
+        elif is_read:
+            stats.num_read += 1
+    build_time = time.time() - start
+    rss_after = max_rss_kb()
+
+    start = time.time()
+    for _ in range(10):
+        table.count_from()
+        table.get_has_to()
+        table.bayes1_scores()
+    query_time = (time.time() - start) / 10.0
+    return build_time, query_time, rss_after - rss_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the array-backed EmailAddressTable against the'
+                                                 ' legacy dict-backed classes')
+    parser.add_argument('--addresses', '-n', type=int, default=50000, help='Number of distinct addresses')
+    parser.add_argument('--updates', '-u', type=int, default=500000, help='Number of counter updates')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    options = parser.parse_args()
+
+    print 'addresses: %d  updates: %d' % (options.addresses, options.updates)
+    for kind in ('legacy', 'views', 'array'):
+        # A new process per kind so that the RSS growth is not hidden by the other run
+        pool = multiprocessing.Pool(processes=1)
+        try:
+            (build_time, query_time, rss_kb) = \
+                pool.apply(run_one, ((kind, options.addresses, options.updates, options.seed),))
+        finally:
+            pool.close()
+            pool.join()
+        print '%-6s build: %.3f sec  count_from + get_has_to + bayes1_scores: %.4f sec  RSS growth: %.1f MB' % \
+              (kind, build_time, query_time, rss_kb / 1024.0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import re
+import numpy
+import scipy.sparse
+from abc import ABCMeta, abstractmethod
+from sklearn.feature_extraction.text import CountVectorizer
+
+
+class ColumnTransformer(object):
+    """
+    Turns one column of a MessageStore into a block of sparse features. The store interns every
+    column, so a transformer computes the features of each distinct value (subject, sender,
+    header) once and gathers them per message with numpy. Adding a transformer costs per
+    distinct value, not per message.
+    """
+    __metaclass__ = ABCMeta
+
+    def fit(self, store):
+        pass
+
+    @abstractmethod
+    def transform(self, store):
+        pass
+
+    def fit_transform(self, store):
+        self.fit(store)
+        return self.transform(store)
+
+    @abstractmethod
+    def feature_names(self):
+        pass
+
+
+def _one_hot(columns, num_columns):
+    """
+    Return a CSR matrix with a 1 at columns[n] in row n. Rows with a negative column are empty.
+    """
+    rows = numpy.flatnonzero(columns >= 0)
+    return scipy.sparse.csr_matrix((numpy.ones(len(rows)), (rows, columns[rows])),
+                                   shape=(len(columns), num_columns))
+
+
+class SubjectWords(ColumnTransformer):
+    """
+    Bag of words of the subject. The vocabulary is fit on distinct subjects, so min_df counts
+    distinct subjects rather than messages and a long thread does not inflate its words.
+    """
+    def __init__(self, min_df=5):
+        self.vectorizer = CountVectorizer(min_df=min_df)
+
+    @staticmethod
+    def _subjects(store):
+        return [s or '' for s in store.subjects.strings]
+
+    def fit(self, store):
+        self.vectorizer.fit(SubjectWords._subjects(store))
+
+    def transform(self, store):
+        return self.vectorizer.transform(SubjectWords._subjects(store))[store.subject_ids]
+
+    def feature_names(self):
+        return ['subject:%s' % word for word in self.vectorizer.get_feature_names()]
+
+
+class SubjectMarkers(ColumnTransformer):
+    """
+    Whether the subject starts with reply (Re:, AW:, SV:) or forward (Fwd:, Fw:, WG:, TR:)
+    prefixes, in any order and number.
+    """
+    PREFIX = re.compile(r'\s*(re|aw|sv|fwd?|wg|tr)\s*(\[\d+\])?\s*:', re.IGNORECASE)
+    REPLY = frozenset(['re', 'aw', 'sv'])
+
+    @staticmethod
+    def _markers(subject):
+        (is_reply, is_forward) = (0.0, 0.0)
+        position = 0
+        while subject is not None:
+            match = SubjectMarkers.PREFIX.match(subject, position)
+            if match is None:
+                break
+            if match.group(1).lower() in SubjectMarkers.REPLY:
+                is_reply = 1.0
+            else:
+                is_forward = 1.0
+            position = match.end()
+        return is_reply, is_forward
+
+    def transform(self, store):
+        markers = numpy.array([SubjectMarkers._markers(s) for s in store.subjects.strings],
+                              dtype=numpy.float64).reshape(-1, 2)
+        return scipy.sparse.csr_matrix(markers[store.subject_ids])
+
+    def feature_names(self):
+        return ['subject is reply', 'subject is forward']
+
+
+class SenderDomain(ColumnTransformer):
+    """
+    One-hot domain of the sender. Domains of fewer than min_count analyzed messages share no
+    feature.
+    """
+    def __init__(self, min_count=2):
+        self.min_count = min_count
+        self.domains = dict()
+
+    @staticmethod
+    def _index(address, index):
+        (_, at, domain) = address.rpartition('@')
+        if len(at) == 0 or len(domain) == 0:
+            return -1
+        return index(domain.lower())
+
+    @staticmethod
+    def _domain_indices(store, index):
+        """
+        Return the index (by the index dict of domains) of the sender domain of every message,
+        or -1. Each distinct sender is looked up once.
+        """
+        has_sender = store.sender_ids >= 0
+        (senders, inverse) = numpy.unique(store.sender_ids[has_sender], return_inverse=True)
+        sender_indices = numpy.array([SenderDomain._index(store.addresses[n], index) for n in senders],
+                                     dtype=numpy.int64)
+        indices = -numpy.ones(len(store), dtype=numpy.int64)
+        indices[has_sender] = sender_indices[inverse]
+        return indices
+
+    def fit(self, store):
+        names = list()
+        domains = dict()
+
+        def index(domain):
+            n = domains.get(domain, None)
+            if n is None:
+                n = domains[domain] = len(names)
+                names.append(domain)
+            return n
+        indices = SenderDomain._domain_indices(store, index)
+        counts = numpy.bincount(indices[indices >= 0], minlength=len(names))
+        self.domains = dict([(names[n], k) for (k, n) in enumerate(numpy.flatnonzero(counts >= self.min_count))])
+
+    def transform(self, store):
+        indices = SenderDomain._domain_indices(store, lambda domain: self.domains.get(domain, -1))
+        return _one_hot(indices, len(self.domains))
+
+    def feature_names(self):
+        names = [None] * len(self.domains)
+        for (domain, n) in self.domains.items():
+            names[n] = 'sender domain:%s' % domain
+        return names
+
+
+class RecipientCounts(ColumnTransformer):
+    """
+    log(1 + number of addresses) of To and of Cc.
+    """
+    def transform(self, store):
+        return scipy.sparse.csr_matrix(numpy.log1p(numpy.column_stack((store.to.counts(), store.cc.counts()))))
+
+    def feature_names(self):
+        return ['log to count', 'log cc count']
+
+
+class RecipientPosition(ColumnTransformer):
+    """
+    Whether the owner of the mailbox is in To, in Cc or in neither (e.g. Bcc or a mailing
+    list). The owner is the address that receives the most analyzed messages in To / Cc.
+    """
+    def __init__(self):
+        self.owner = None
+
+    def fit(self, store):
+        counts = numpy.bincount(numpy.concatenate((store.to.ids, store.cc.ids)), minlength=len(store.addresses))
+        self.owner = None
+        if len(counts) > 0 and counts.max() > 0:
+            self.owner = store.addresses[int(numpy.argmax(counts))]
+
+    def transform(self, store):
+        features = numpy.zeros((len(store), 3))
+        owner_id = -1 if self.owner is None else store.addresses.find(self.owner)
+        for (k, column) in enumerate((store.to, store.cc)):
+            features[:, k] = numpy.bincount(column.message_indices(), weights=column.ids == owner_id,
+                                            minlength=len(store)) > 0
+        features[:, 2] = (features[:, 0] == 0) & (features[:, 1] == 0)
+        return scipy.sparse.csr_matrix(features)
+
+    def feature_names(self):
+        return ['owner in to', 'owner in cc', 'owner not in to / cc']
+
+
+class TimeOfWeek(ColumnTransformer):
+    """
+    One-hot hour of day and day of week (UTC) of DateReceived. Messages without DateReceived
+    have neither.
+    """
+    TICKS_PER_HOUR = 3600 * 10000000
+
+    def transform(self, store):
+        ticks = store.date_received
+        hours = ticks // TimeOfWeek.TICKS_PER_HOUR
+        # .NET ticks count from Monday, January 1, 0001
+        hour_of_day = numpy.where(ticks > 0, hours % 24, -1)
+        day_of_week = numpy.where(ticks > 0, (hours // 24) % 7, -1)
+        return scipy.sparse.hstack((_one_hot(hour_of_day, 24), _one_hot(day_of_week, 7)), format='csr')
+
+    def feature_names(self):
+        return ['hour:%d' % n for n in range(24)] + \
+            ['day:%s' % day for day in ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')]
+
+
+class FeaturePipeline:
+    """
+    Concatenates the blocks of several ColumnTransformer into one CSR matrix with a row per
+    message.
+    """
+    def __init__(self, transformers):
+        self.transformers = transformers
+
+    def fit_transform(self, store):
+        return scipy.sparse.hstack([t.fit_transform(store) for t in self.transformers], format='csr')
+
+    def transform(self, store):
+        return scipy.sparse.hstack([t.transform(store) for t in self.transformers], format='csr')
+
+    def feature_names(self):
+        names = list()
+        for transformer in self.transformers:
+            names.extend(transformer.feature_names())
+        return names
+
+
+def default_pipeline():
+    return FeaturePipeline([SubjectWords(), SubjectMarkers(), SenderDomain(), RecipientCounts(),
+                            RecipientPosition(), TimeOfWeek()])
@@ -0,0 +1,150 @@
+import multiprocessing
+import numpy
+from email_address import EmailAddress
+from evaluator import Evaluator, EvaluatorResult
+from message_store import MessageStore
+
+
+def kfold_splits(num_messages, folds, seed=0):
+    """
+    Randomly partition the message indices into folds. Returns a list of (train, test) index
+    arrays, one per fold.
+    """
+    assert folds >= 2
+    assert num_messages >= folds
+    permutation = numpy.random.RandomState(seed).permutation(num_messages)
+    blocks = numpy.array_split(permutation, folds)
+    splits = list()
+    for n in range(folds):
+        train = numpy.sort(numpy.concatenate([blocks[m] for m in range(folds) if m != n]))
+        test = numpy.sort(blocks[n])
+        splits.append((train, test))
+    return splits
+
+
+def time_splits(date_received, folds):
+    """
+    Chronological splits. Messages are sorted by DateReceived and cut into folds + 1 blocks.
+    Fold n trains on blocks 0..n and tests on block n + 1, so a model is never evaluated on
+    messages older than the ones it was trained on.
+    """
+    assert folds >= 1
+    assert len(date_received) >= folds + 1
+    order = numpy.argsort(numpy.asarray(date_received), kind='mergesort')
+    blocks = numpy.array_split(order, folds + 1)
+    splits = list()
+    for n in range(folds):
+        train = numpy.sort(numpy.concatenate(blocks[:n + 1]))
+        test = numpy.sort(blocks[n + 1])
+        splits.append((train, test))
+    return splits
+
+
+def _subset(email_messages, indices):
+    if isinstance(email_messages, MessageStore):
+        return email_messages.subset(indices)
+    return [email_messages[n] for n in indices]
+
+
+# State inherited by forked pool workers
+_worker_state = dict()
+
+
+def _run_fold(n):
+    email_messages = _worker_state['email_messages']
+    (train, test) = _worker_state['splits'][n]
+    analyzer = _worker_state['factory']()
+    analyzer.analyze(_subset(email_messages, train))
+    test_messages = _subset(email_messages, test)
+    results = _worker_state['evaluator'].evaluate(test_messages, analyzer.classify(test_messages))
+    # Report misses and false alarms as indices into the full message list
+    results.miss_indices = test[results.miss_indices].tolist()
+    results.false_alarm_indices = test[results.false_alarm_indices].tolist()
+    return results
+
+
+class CrossValidationResult:
+    # EvaluatorResult attributes that are aggregated across folds
+    RATES = ('error_rate', 'miss_rate', 'false_alarms_rate', 'hot_error_rate', 'not_hot_error_rate')
+
+    def __init__(self, folds):
+        self.folds = folds
+
+    def values(self, attr):
+        return numpy.array([getattr(results, attr) for results in self.folds], dtype=numpy.float64)
+
+    def mean(self, attr):
+        return float(numpy.mean(self.values(attr)))
+
+    def std(self, attr):
+        if len(self.folds) < 2:
+            return 0.0
+        return float(numpy.std(self.values(attr), ddof=1))
+
+    def summary(self):
+        out = ''
+        for (n, results) in enumerate(self.folds):
+            out += 'fold %d: total: %d  error rate: %.3f%%  miss rate: %.3f%%  false alarm rate: %.3f%%\n' % \
+                   (n, results.total, results.error_rate * 100.0, results.miss_rate * 100.0,
+                    results.false_alarms_rate * 100.0)
+        out += '\n'
+        for attr in CrossValidationResult.RATES:
+            out += '%s: mean %.3f%%  stddev %.3f%%\n' % \
+                   (EvaluatorResult.RATE_LABELS[attr], self.mean(attr) * 100.0, self.std(attr) * 100.0)
+        if len(self.folds) > 0 and all([results.sweep is not None for results in self.folds]):
+            auc = numpy.array([results.sweep.auc() for results in self.folds])
+            out += 'ROC AUC: mean %.4f  stddev %.4f\n' % (numpy.mean(auc), len(auc) > 1 and numpy.std(auc, ddof=1) or 0.0)
+        return out
+
+
+class CrossValidator:
+    """
+    Evaluate an analyzer on held-out messages. factory is a callable that returns a new
+    untrained analyzer. Folds run in parallel worker processes that are forked after the
+    messages are set up, so a MessageStore (with all headers parsed and subjects interned once)
+    or a warm address cache is shared by all folds.
+    """
+    def __init__(self, email_messages, processes=None, evaluator=None):
+        self.email_messages = email_messages
+        self.processes = processes
+        if evaluator is None:
+            evaluator = Evaluator()
+        self.evaluator = evaluator
+
+    def _warm_address_cache(self):
+        if isinstance(self.email_messages, MessageStore):
+            return
+        for email_message in self.email_messages:
+            for header in (email_message.From, email_message.To, email_message.Cc):
+                for address in EmailAddress.parse_address_string(header):
+                    EmailAddress.get_canonical_address(address)
+            EmailAddress.get_canonical_address(email_message.From)
+
+    def run(self, factory, splits):
+        _worker_state.clear()
+        _worker_state['email_messages'] = self.email_messages
+        _worker_state['splits'] = splits
+        _worker_state['factory'] = factory
+        _worker_state['evaluator'] = self.evaluator
+        self._warm_address_cache()
+        folds = range(len(splits))
+        if self.processes == 1 or len(splits) == 1:
+            results = map(_run_fold, folds)
+        else:
+            pool = multiprocessing.Pool(processes=self.processes)
+            try:
+                results = pool.map(_run_fold, folds)
+            finally:
+                pool.close()
+                pool.join()
+        return CrossValidationResult(results)
+
+    def kfold(self, factory, folds, seed=0):
+        return self.run(factory, kfold_splits(len(self.email_messages), folds, seed))
+
+    def time_split(self, factory, folds):
+        if isinstance(self.email_messages, MessageStore):
+            date_received = self.email_messages.date_received
+        else:
+            date_received = [email_message.DateReceived for email_message in self.email_messages]
+        return self.run(factory, time_splits(date_received, folds))
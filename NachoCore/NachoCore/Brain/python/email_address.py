@@ -1,11 +1,98 @@
-import email.utils
+import array
+import threading
+from collections import OrderedDict
+import numpy
+from instrumentation import Instrumentation
+from address_parser import parse_address, parse_address_list, normalize_address
 
 
-class EmailAddressStatistics:
-    def __init__(self):
-        self.num_received = 0
-        self.num_read = 0
-        self.num_replied = 0
+class LruCache:
+    """
+    A bounded least-recently-used cache that keeps hit / miss statistics. It is shared by all
+    threads, so every access holds a lock.
+    """
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.capacity = capacity
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, compute):
+        """
+        Return the cached value of key. On a miss, compute(key) is called and its result is
+        cached, evicting the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            try:
+                value = self._cache.pop(key)
+                self.hits += 1
+            except KeyError:
+                with Instrumentation.stage('address parsing'):
+                    value = compute(key)
+                self.misses += 1
+                if len(self._cache) >= self.capacity:
+                    self._cache.popitem(last=False)
+            self._cache[key] = value
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / float(total)
+
+    def summary(self):
+        return 'size: %d/%d  hits: %d  misses: %d  hit rate: %.3f%%' % \
+               (len(self._cache), self.capacity, self.hits, self.misses, self.hit_rate() * 100.0)
+
+
+class EmailAddressStatistics(object):
+    """
+    Received / read / replied counters. This is a view of three consecutive slots of an integer
+    array, which normally belongs to an EmailAddressTable. A standalone instance owns its own
+    array.
+    """
+    __slots__ = ('_counts', '_offset')
+
+    def __init__(self, counts=None, offset=0):
+        if counts is None:
+            counts = array.array('l', [0, 0, 0])
+            offset = 0
+        self._counts = counts
+        self._offset = offset
+
+    def _get_num_received(self):
+        return self._counts[self._offset]
+
+    def _set_num_received(self, value):
+        self._counts[self._offset] = value
+
+    def _get_num_read(self):
+        return self._counts[self._offset + 1]
+
+    def _set_num_read(self, value):
+        self._counts[self._offset + 1] = value
+
+    def _get_num_replied(self):
+        return self._counts[self._offset + 2]
+
+    def _set_num_replied(self, value):
+        self._counts[self._offset + 2] = value
+
+    num_received = property(_get_num_received, _set_num_received)
+    num_read = property(_get_num_read, _set_num_read)
+    num_replied = property(_get_num_replied, _set_num_replied)
 
     def score(self):
         if self.num_received == 0:
@@ -25,23 +112,88 @@ class EmailAddressStatistics:
         return self.num_replied > 0
 
 
-class EmailAddress:
+class EmailAddress(object):
+    # Layout of the 9 counters of an address. Each of from / to / cc is followed by
+    # received, read, replied.
+    FROM = 0
+    TO = 3
+    CC = 6
+    NUM_COUNTERS = 9
+
+    __slots__ = ('original_address', 'name', 'canonical_address', 'id', '_counts')
+
+    # Header strings and senders repeat heavily in a mailbox. These caches are shared by all
+    # tables and analyzers so that analyze and classify passes do not parse the same string twice.
+    header_cache = LruCache(100000)
+    canonical_cache = LruCache(100000)
+
+    @staticmethod
+    def _get_canonical_address(address):
+        return normalize_address(parse_address(address)[1])
+
+    @staticmethod
+    def _parse_address_string(s):
+        return tuple([x[1] for x in parse_address_list(s)])
+
     @staticmethod
     def get_canonical_address(address):
-        return email.utils.parseaddr(address)[1]
+        """
+        The address part of address, lowercased and without +tag, which identifies an address in
+        a table. Bob+news@X.com and bob@x.com are the same address.
+        """
+        return EmailAddress.canonical_cache.get(address, EmailAddress._get_canonical_address)
 
     @staticmethod
     def parse_address_string(s):
         if s is None or len(s) == 0:
             return []
-        return [x[1] for x in email.utils.getaddresses([s])]
+        return list(EmailAddress.header_cache.get(s, EmailAddress._parse_address_string))
+
+    @staticmethod
+    def set_cache_capacity(capacity):
+        EmailAddress.header_cache = LruCache(capacity)
+        EmailAddress.canonical_cache = LruCache(capacity)
+
+    @staticmethod
+    def cache_summary():
+        msg = 'header cache: %s\n' % EmailAddress.header_cache.summary()
+        msg += 'canonical address cache: %s\n' % EmailAddress.canonical_cache.summary()
+        return msg
 
-    def __init__(self, address):
+    def __init__(self, address, counts=None, id_=0):
+        """
+        An address of an EmailAddressTable has its counters in row id_ of the table counts
+        array. A standalone address owns its counters.
+        """
         self.original_address = address
-        (self.name, self.canonical_address) = email.utils.parseaddr(address)
-        self.from_stats = EmailAddressStatistics()
-        self.to_stats = EmailAddressStatistics()
-        self.cc_stats = EmailAddressStatistics()
+        (self.name, canonical_address) = parse_address(address)
+        self.canonical_address = normalize_address(canonical_address)
+        if counts is None:
+            counts = array.array('l', [0] * EmailAddress.NUM_COUNTERS)
+            id_ = 0
+        self.id = id_
+        self._counts = counts
+
+    @property
+    def from_stats(self):
+        return EmailAddressStatistics(self._counts, self.id * EmailAddress.NUM_COUNTERS + EmailAddress.FROM)
+
+    @property
+    def to_stats(self):
+        return EmailAddressStatistics(self._counts, self.id * EmailAddress.NUM_COUNTERS + EmailAddress.TO)
+
+    @property
+    def cc_stats(self):
+        return EmailAddressStatistics(self._counts, self.id * EmailAddress.NUM_COUNTERS + EmailAddress.CC)
+
+    def has_from(self):
+        return self.from_stats.has_received()
+
+    def has_to(self):
+        return self.to_stats.has_received()
+
+    def has_cc(self):
+        return self.cc_stats.has_received()
 
     def bayes1_score(self):
         """
@@ -65,28 +217,124 @@ class EmailAddress:
 
 
 class EmailAddressTable:
-    def __init__(self):
+    """
+    All counters are kept in one contiguous array of NUM_COUNTERS integers per address, indexed by
+    EmailAddress.id. EmailAddress and EmailAddressStatistics are lightweight views into it, and
+    bulk queries are vectorized reductions over the array.
+    """
+    def __init__(self, typecode='l'):
+        """
+        typecode is the array.array type of the counters. 'd' gives fractional (e.g. time
+        decayed) counters.
+        """
         self._table = dict()
+        self._addresses = list()
+        self._counts = array.array(typecode)
+
+    def __getstate__(self):
+        return {'addresses': [email_address.original_address for email_address in self._addresses],
+                'counts': self._counts}
+
+    def __setstate__(self, state):
+        if 'addresses' not in state or 'counts' not in state:
+            raise ValueError('unsupported EmailAddressTable pickle')
+        self.__init__(state['counts'].typecode)
+        for address in state['addresses']:
+            self.add(address)
+        self._counts = state['counts']
+        for email_address in self._addresses:
+            email_address._counts = self._counts
+
+    def counts(self):
+        """
+        Return the counters as a (# addresses, NUM_COUNTERS) NumPy array. It is a view of the
+        table and is only valid until the next address is added.
+        """
+        dtype = numpy.dtype(self._counts.typecode)
+        counts = numpy.frombuffer(self._counts, dtype=dtype) if len(self._counts) > 0 else numpy.zeros(0, dtype=dtype)
+        return counts.reshape(-1, EmailAddress.NUM_COUNTERS)
 
     def count(self):
         return len(self._table)
 
+    def _has_received(self, column):
+        return self.counts()[:, column] > 0
+
     def count_from(self):
-        return reduce(lambda x: x.from_stats.has_received() and 1 or 0, self._table.values(), 0)
+        return int(numpy.count_nonzero(self._has_received(EmailAddress.FROM)))
 
     def count_to(self):
-        return reduce(lambda x: x.to_stats.has_received() and 1 or 0, self._table.values(), 0)
+        return int(numpy.count_nonzero(self._has_received(EmailAddress.TO)))
 
     def count_cc(self):
-        return reduce(lambda x: x.cc_stats.has_received() and 1 or 0, self._table.values(), 0)
+        return int(numpy.count_nonzero(self._has_received(EmailAddress.CC)))
+
+    def scores(self, column=EmailAddress.FROM):
+        """
+        Return the (read + replied) / received score of every address (indexed by id) for one of
+        the from / to / cc counters. Addresses that received nothing score 0.
+        """
+        counts = self.counts()
+        received = counts[:, column].astype(numpy.float64)
+        top = (counts[:, column + 1] + counts[:, column + 2]).astype(numpy.float64)
+        return numpy.where(received > 0, top / numpy.maximum(received, 1.0), 0.0)
+
+    def bayes1_scores(self):
+        return self.scores(EmailAddress.FROM)
 
     def add(self, address):
         canonical_address = EmailAddress.get_canonical_address(address)
         assert canonical_address not in self._table
-        email_address = EmailAddress(address)
+        email_address = EmailAddress(address, self._counts, len(self._addresses))
+        self._counts.extend([0] * EmailAddress.NUM_COUNTERS)
+        Instrumentation.count('addresses created')
+        self._addresses.append(email_address)
         self._table[canonical_address] = email_address
         return email_address
 
+    # Message categories of add_message() / move_message(). The read and replied counters are at
+    # column + READ and column + REPLIED.
+    UNREAD = 0
+    READ = 1
+    REPLIED = 2
+
+    def add_message(self, email_address, column, category, weight=1):
+        """
+        Count one message of category in the from / to / cc counters of email_address. This is
+        the same as updating email_address.from_stats etc. but without creating a view.
+        """
+        offset = email_address.id * EmailAddress.NUM_COUNTERS + column
+        self._counts[offset] += weight
+        if category != EmailAddressTable.UNREAD:
+            self._counts[offset + category] += weight
+
+    def move_message(self, email_address, column, old_category, new_category, weight=1):
+        """
+        Move one already counted message from old_category to new_category.
+        """
+        offset = email_address.id * EmailAddress.NUM_COUNTERS + column
+        if old_category != EmailAddressTable.UNREAD:
+            self._counts[offset + old_category] -= weight
+        if new_category != EmailAddressTable.UNREAD:
+            self._counts[offset + new_category] += weight
+
+    def scale(self, email_address, factor):
+        """
+        Multiply all counters of email_address by factor. Only meaningful for fractional counters.
+        """
+        offset = email_address.id * EmailAddress.NUM_COUNTERS
+        for n in xrange(offset, offset + EmailAddress.NUM_COUNTERS):
+            self._counts[n] *= factor
+
+    def add_counts(self, email_address, column, received, num_read, num_replied):
+        """
+        Add aggregated received / read / replied counts to the from / to / cc counters.
+        """
+        offset = email_address.id * EmailAddress.NUM_COUNTERS + column
+        self._counts[offset] += received
+        self._counts[offset + 1] += num_read
+        self._counts[offset + 2] += num_replied
+
     def add_or_get(self, address):
         canonical_address = EmailAddress.get_canonical_address(address)
         email_address = self._table.get(canonical_address, None)
@@ -98,17 +346,23 @@ class EmailAddressTable:
         canonical_address = EmailAddress.get_canonical_address(address)
         return self._table.get(canonical_address, None)
 
+    def get_by_id(self, id_):
+        return self._addresses[id_]
+
     def get_all(self):
         return self._table.values()
 
+    def _select(self, mask):
+        return [self._addresses[n] for n in numpy.flatnonzero(mask)]
+
     def get_has_from(self):
-        return filter(lambda x: x.has_from(), self.get_all())
+        return self._select(self._has_received(EmailAddress.FROM))
 
     def get_has_to(self):
-        return filter(lambda x: x.has_to(), self.get_all())
+        return self._select(self._has_received(EmailAddress.TO))
 
     def get_has_cc(self):
-        return filter(lambda x: x.has_to(), self.get_all())
+        return self._select(self._has_received(EmailAddress.CC))
 
     def __repr__(self):
         msg = ''
@@ -0,0 +1,178 @@
+import os
+import json
+import numpy
+from email_address import EmailAddress, EmailAddressTable
+
+
+class SnapshotStatistics(object):
+    """
+    Read-only EmailAddressStatistics view of three columns of a snapshot counts array.
+    """
+    __slots__ = ('_row', '_column')
+
+    def __init__(self, row, column):
+        self._row = row
+        self._column = column
+
+    # item() keeps decayed (float64) counters fractional
+    @property
+    def num_received(self):
+        return self._row[self._column].item()
+
+    @property
+    def num_read(self):
+        return self._row[self._column + 1].item()
+
+    @property
+    def num_replied(self):
+        return self._row[self._column + 2].item()
+
+    def score(self):
+        if self.num_received == 0:
+            return 0.0
+        return float(self.num_read + self.num_replied) / float(self.num_received)
+
+    def has_received(self):
+        return self.num_received > 0
+
+    def has_read(self):
+        return self.num_read > 0
+
+    def has_replied(self):
+        return self.num_replied > 0
+
+
+class SnapshotEmailAddress(object):
+    """
+    Read-only EmailAddress view of one row of a snapshot. Only the canonical address is stored in
+    a snapshot so the name is always empty.
+    """
+    __slots__ = ('canonical_address', 'id', 'from_stats', 'to_stats', 'cc_stats')
+
+    def __init__(self, canonical_address, id_, row):
+        self.canonical_address = canonical_address
+        self.id = id_
+        self.from_stats = SnapshotStatistics(row, EmailAddressSnapshot.FROM)
+        self.to_stats = SnapshotStatistics(row, EmailAddressSnapshot.TO)
+        self.cc_stats = SnapshotStatistics(row, EmailAddressSnapshot.CC)
+
+    @property
+    def original_address(self):
+        return self.canonical_address
+
+    @property
+    def name(self):
+        return ''
+
+    def bayes1_score(self):
+        return self.from_stats.score()
+
+
+class EmailAddressSnapshot:
+    """
+    A compact on-disk form of EmailAddressTable. A snapshot is a directory with two files:
+
+      addresses.json - format version and the list of canonical addresses. The position of an
+                       address in the list is its index.
+      counts.npy     - an int32 (float64 for decayed counters) array of shape (# addresses, 9).
+                       Row n holds the from / to / cc received, read and replied counts of
+                       address n.
+
+    counts.npy is memory-mapped on load, so loading costs one JSON parse and one dict build
+    regardless of the statistics. A loaded snapshot supports the read-only part of the
+    EmailAddressTable API and can be used as the table of a RelationAnalyzer for classify().
+    """
+    VERSION = 2
+    ADDRESSES_FILE = 'addresses.json'
+    COUNTS_FILE = 'counts.npy'
+
+    # Column offsets of the from / to / cc counters. Each is followed by received, read, replied.
+    # This is the same layout as EmailAddressTable.counts().
+    FROM = EmailAddress.FROM
+    TO = EmailAddress.TO
+    CC = EmailAddress.CC
+
+    def __init__(self, addresses, counts):
+        assert counts.shape == (len(addresses), 9)
+        self.addresses = addresses
+        self._counts = counts
+        self._index = dict(zip(addresses, xrange(len(addresses))))
+
+    @staticmethod
+    def from_table(table):
+        email_addresses = sorted(table.get_all(), key=lambda x: x.canonical_address)
+        addresses = [email_address.canonical_address for email_address in email_addresses]
+        ids = numpy.array([email_address.id for email_address in email_addresses], dtype=numpy.int64)
+        counts = table.counts()[ids]
+        counts = counts.astype(numpy.float64 if counts.dtype.kind == 'f' else numpy.int32)
+        return EmailAddressSnapshot(addresses, counts)
+
+    def counts(self):
+        return self._counts
+
+    def to_table(self):
+        """
+        Convert to a mutable EmailAddressTable. Fractional counters stay fractional.
+        """
+        table = EmailAddressTable('d' if self._counts.dtype.kind == 'f' else 'l')
+        ids = numpy.array([table.add_or_get(canonical_address).id for canonical_address in self.addresses],
+                          dtype=numpy.int64)
+        numpy.add.at(table.counts(), ids, self._counts)
+        return table
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # Write both files under temporary names first and then rename them into place
+        addresses_path = os.path.join(path, EmailAddressSnapshot.ADDRESSES_FILE)
+        counts_path = os.path.join(path, EmailAddressSnapshot.COUNTS_FILE)
+        with open(addresses_path + '.tmp', 'w') as f:
+            json.dump({'version': EmailAddressSnapshot.VERSION, 'addresses': self.addresses}, f)
+        with open(counts_path + '.tmp', 'wb') as f:
+            numpy.save(f, self._counts)
+        os.rename(counts_path + '.tmp', counts_path)
+        os.rename(addresses_path + '.tmp', addresses_path)
+
+    @staticmethod
+    def load(path, mmap=True):
+        with open(os.path.join(path, EmailAddressSnapshot.ADDRESSES_FILE), 'r') as f:
+            header = json.load(f)
+        if header.get('version', None) != EmailAddressSnapshot.VERSION:
+            raise ValueError('%s has an unsupported snapshot version' % path)
+        counts = numpy.load(os.path.join(path, EmailAddressSnapshot.COUNTS_FILE),
+                            mmap_mode=mmap and 'r' or None)
+        addresses = header['addresses']
+        if counts.shape != (len(addresses), 9):
+            raise ValueError('%s has inconsistent addresses and counts' % path)
+        return EmailAddressSnapshot(addresses, counts)
+
+    def count(self):
+        return len(self.addresses)
+
+    def _count_received(self, column):
+        return int(numpy.count_nonzero(self._counts[:, column]))
+
+    def count_from(self):
+        return self._count_received(EmailAddressSnapshot.FROM)
+
+    def count_to(self):
+        return self._count_received(EmailAddressSnapshot.TO)
+
+    def count_cc(self):
+        return self._count_received(EmailAddressSnapshot.CC)
+
+    def get_by_index(self, n):
+        return SnapshotEmailAddress(self.addresses[n], n, self._counts[n])
+
+    def get_by_id(self, id_):
+        # Same as EmailAddressTable. The id of an address is its index.
+        return self.get_by_index(id_)
+
+    def get(self, address):
+        n = self._index.get(EmailAddress.get_canonical_address(address), None)
+        if n is None:
+            return None
+        return self.get_by_index(n)
+
+    def get_all(self):
+        return [self.get_by_index(n) for n in xrange(len(self.addresses))]
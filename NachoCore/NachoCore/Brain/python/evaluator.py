@@ -1,4 +1,18 @@
+from collections import OrderedDict
+import numpy
+from message_store import MessageStore
+
+
 class EvaluatorResult:
+    # Rates and their labels in summary(). Other reports use the same labels.
+    RATE_LABELS = OrderedDict([
+        ('error_rate', 'error rate'),
+        ('miss_rate', 'miss rate'),
+        ('false_alarms_rate', 'false alarm rate'),
+        ('hot_error_rate', 'hot error rate'),
+        ('not_hot_error_rate', 'not-hot error rate'),
+    ])
+
     def __init__(self):
         self.total = 0
         self.read = 0
@@ -18,6 +32,9 @@ class EvaluatorResult:
         self.hot_error_rate = 0.0
         self.not_hot_error_rate = 0.0
 
+        # ThresholdSweep over all thresholds if the evaluator was asked for one
+        self.sweep = None
+
     def update_rate(self):
         def rate(top, bottom):
             if bottom == 0:
@@ -40,48 +57,189 @@ class EvaluatorResult:
         out += 'misses: %d\n' % self.misses
         out += 'false alarms: %d\n\n' % self.false_alarms
 
-        out += 'error rate: %.3f%%\n' % (self.error_rate * 100.0)
-        out += 'miss rate: %.3f%%\n' % (self.miss_rate * 100.0)
-        out += 'false alarm rate: %.3f%%\n' % (self.false_alarms_rate * 100.0)
-        out += 'hot error rate: %.3f%%\n' % (self.hot_error_rate * 100.0)
-        out += 'not-hot error rate: %.3f%%\n' % (self.not_hot_error_rate * 100.0)
+        for (attr, label) in EvaluatorResult.RATE_LABELS.items():
+            out += '%s: %.3f%%\n' % (label, getattr(self, attr) * 100.0)
+
+        if self.sweep is not None:
+            out += '\n' + self.sweep.summary()
 
         return out
 
 
+class ThresholdSweep:
+    """
+    Confusion counts of a score vector for every distinct threshold. A message is hot when
+    its score >= threshold and it is a hit when it is read. thresholds is in descending order
+    and starts with +inf (nothing is hot) so the ROC / PR curves start at the origin.
+    """
+    def __init__(self, is_read, scores):
+        is_read = numpy.asarray(is_read, dtype=numpy.bool_)
+        scores = numpy.asarray(scores, dtype=numpy.float64)
+        assert len(is_read) == len(scores)
+        self.is_read = is_read
+        self.scores = scores
+
+        # One sorted pass. The last position of each run of equal scores gives the counts of
+        # messages with score >= that score.
+        order = numpy.argsort(-scores, kind='mergesort')
+        sorted_scores = scores[order]
+        sorted_read = is_read[order]
+        last = numpy.flatnonzero(numpy.diff(sorted_scores) != 0)
+        last = numpy.append(last, len(sorted_scores) - 1) if len(sorted_scores) > 0 else last
+        read_cumsum = numpy.cumsum(sorted_read, dtype=numpy.int64)
+
+        self.thresholds = numpy.concatenate(([numpy.inf], sorted_scores[last]))
+        self.hot = numpy.concatenate(([0], last + 1))
+        self.true_hot = numpy.concatenate(([0], read_cumsum[last]))
+        self.false_alarms = self.hot - self.true_hot
+
+        self.total = len(scores)
+        self.read = int(numpy.count_nonzero(is_read))
+        self.unread = self.total - self.read
+        self.misses = self.read - self.true_hot
+        self.not_hot = self.total - self.hot
+
+    @staticmethod
+    def _rate(top, bottom):
+        top = numpy.asarray(top, dtype=numpy.float64)
+        bottom = numpy.asarray(bottom, dtype=numpy.float64)
+        return numpy.where(bottom > 0, top / numpy.maximum(bottom, 1.0), 0.0)
+
+    def error_rates(self):
+        return ThresholdSweep._rate(self.misses + self.false_alarms, self.total)
+
+    def roc(self):
+        """
+        Return (false positive rate, true positive rate) per threshold.
+        """
+        return (ThresholdSweep._rate(self.false_alarms, self.unread),
+                ThresholdSweep._rate(self.true_hot, self.read))
+
+    def auc(self):
+        (fpr, tpr) = self.roc()
+        return float(numpy.trapz(tpr, fpr))
+
+    def precision_recall(self):
+        """
+        Return (precision, recall) per threshold. Precision is 1 when nothing is hot.
+        """
+        precision = numpy.where(self.hot > 0, ThresholdSweep._rate(self.true_hot, self.hot), 1.0)
+        recall = ThresholdSweep._rate(self.true_hot, self.read)
+        return precision, recall
+
+    def average_precision(self):
+        (precision, recall) = self.precision_recall()
+        return float(numpy.sum(numpy.diff(recall) * precision[1:]))
+
+    def best_index(self, criterion='error'):
+        """
+        Index of the optimal threshold. criterion is 'error' (minimum error rate), 'f1'
+        (maximum F1 score) or 'youden' (maximum true positive rate - false positive rate).
+        """
+        if criterion == 'error':
+            return int(numpy.argmin(self.error_rates()))
+        if criterion == 'f1':
+            (precision, recall) = self.precision_recall()
+            f1 = ThresholdSweep._rate(2.0 * precision * recall, precision + recall)
+            return int(numpy.argmax(f1))
+        if criterion == 'youden':
+            (fpr, tpr) = self.roc()
+            return int(numpy.argmax(tpr - fpr))
+        raise ValueError('unknown criterion %s' % criterion)
+
+    def best_threshold(self, criterion='error'):
+        return float(self.thresholds[self.best_index(criterion)])
+
+    def results_at(self, threshold):
+        """
+        Return the EvaluatorResult (including miss / false alarm indices) for one threshold.
+        """
+        results = EvaluatorResult()
+        Evaluator.count(self.is_read, self.scores >= threshold, results, 0)
+        results.update_rate()
+        return results
+
+    CURVE_FIELDS = ('threshold', 'hot', 'true_hot', 'false_alarms', 'tpr', 'fpr', 'precision', 'recall',
+                    'error_rate')
+
+    def curve_rows(self):
+        """
+        Yield one row (in CURVE_FIELDS order) per threshold: the ROC and precision-recall curves
+        with the counts they are computed from. Recall equals tpr.
+        """
+        (fpr, tpr) = self.roc()
+        (precision, recall) = self.precision_recall()
+        error_rates = self.error_rates()
+        for n in xrange(len(self.thresholds)):
+            yield (float(self.thresholds[n]), int(self.hot[n]), int(self.true_hot[n]), int(self.false_alarms[n]),
+                   float(tpr[n]), float(fpr[n]), float(precision[n]), float(recall[n]), float(error_rates[n]))
+
+    def write_curves(self, writer, prefix=()):
+        """
+        Write curve_rows() to a csv writer, each row after the prefix columns.
+        """
+        for row in self.curve_rows():
+            writer.writerow(tuple(prefix) + row)
+
+    def summary(self):
+        n = self.best_index()
+        out = 'ROC AUC: %.4f\n' % self.auc()
+        out += 'average precision: %.4f\n' % self.average_precision()
+        out += 'optimal threshold: %g (error rate: %.3f%%)\n' % (self.thresholds[n], self.error_rates()[n] * 100.0)
+        return out
+
+
 class Evaluator:
     """
     This takes scores from an algorithm for a set of email message. It returns a dictionary of information
     """
     def __init__(self):
         self.hot_threshold = 0.5
-
-    def evaluate(self, email_messages, scores):
-        results = EvaluatorResult()
+        # Also compute a ThresholdSweep in evaluate()
+        self.sweep = False
+
+    @staticmethod
+    def get_is_read(email_messages):
+        if isinstance(email_messages, MessageStore):
+            return email_messages.is_read
+        return numpy.array([bool(email_message.IsRead) for email_message in email_messages], dtype=numpy.bool_)
+
+    @staticmethod
+    def count(is_read, hot, results, offset):
+        false_alarms = numpy.flatnonzero(hot & ~is_read)
+        misses = numpy.flatnonzero(~hot & is_read)
+        num_read = int(numpy.count_nonzero(is_read))
+        num_hot = int(numpy.count_nonzero(hot))
+
+        results.total += len(is_read)
+        results.read += num_read
+        results.unread += len(is_read) - num_read
+        results.hot += num_hot
+        results.not_hot += len(hot) - num_hot
+        results.false_alarms += len(false_alarms)
+        results.misses += len(misses)
+        results.false_alarm_indices.extend((false_alarms + offset).tolist())
+        results.miss_indices.extend((misses + offset).tolist())
+
+    def evaluate(self, email_messages, scores, results=None, offset=0):
+        """
+        Pass the returned results (and the number of messages already evaluated as offset) back in
+        to accumulate the evaluation of a message stream chunk by chunk.
+        """
+        if results is None:
+            results = EvaluatorResult()
 
         score_len = len(scores)
         assert len(email_messages) == score_len
 
-        for n in range(score_len):
-            email_message = email_messages[n]
-            score = scores[n]
-
-            results.total += 1
-            if email_message.IsRead:
-                results.read += 1
-            else:
-                results.unread += 1
-
-            if score >= self.hot_threshold:
-                results.hot += 1
-                if not email_message.IsRead:
-                    results.false_alarms += 1
-                    results.false_alarm_indices.append(n)
-            else:
-                results.not_hot += 1
-                if email_message.IsRead:
-                    results.misses += 1
-                    results.miss_indices.append(n)
+        is_read = Evaluator.get_is_read(email_messages)
+        scores = numpy.asarray(scores, dtype=numpy.float64)
+        Evaluator.count(is_read, scores >= self.hot_threshold, results, offset)
+        if self.sweep:
+            results.sweep = ThresholdSweep(is_read, scores)
 
         results.update_rate()
         return results
+
+    def sweep_thresholds(self, email_messages, scores):
+        return ThresholdSweep(Evaluator.get_is_read(email_messages), scores)
@@ -0,0 +1,169 @@
+import os
+import hashlib
+import sqlite3
+import numpy
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+
+class SubjectFeatureCache:
+    """
+    Caches the fitted subject vocabulary of ContentAnalyzer and the sparse feature row of every
+    message, keyed by McEmailMessage.Id. The cache file lives in cache_dir and its name is
+    derived from the real path of the database. It also stores a fingerprint of the (Id,
+    Subject) of the cached messages, so a database that was rebuilt or replaced at the same
+    path does not get the rows of other messages with the same Ids. New messages do not change
+    the fingerprint.
+
+    fit_transform() reuses the cached vocabulary as long as the messages not in the cache are at
+    most refit_ratio of the requested ones. Those new messages are tokenized with the cached
+    vocabulary and appended, so the cache grows with the mailbox. Otherwise (or if there is no
+    cache yet), the vocabulary is refit from scratch. transform() only tokenizes messages that
+    are not in the cache.
+
+    Note that extending the cache does not add new words to the vocabulary nor update document
+    frequencies. That is what refit_ratio bounds.
+    """
+    VERSION = 2
+
+    def __init__(self, cache_dir, db_path, min_df=5, refit_ratio=0.1):
+        self.db_path = os.path.realpath(db_path)
+        key = hashlib.sha1(self.db_path).hexdigest()
+        self.path = os.path.join(cache_dir, 'subject_features_%s.npz' % key)
+        self.min_df = min_df
+        self.refit_ratio = refit_ratio
+
+        self.vectorizer = None
+        self.vocabulary = None
+        # Message ids in ascending order and their feature rows
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.features = None
+        self.dirty = False
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """
+        Load the cache file if it exists. Returns True if a cache was loaded.
+        """
+        if not os.path.exists(self.path):
+            return False
+        with numpy.load(self.path) as f:
+            if int(f['version']) != SubjectFeatureCache.VERSION or int(f['min_df']) != self.min_df or \
+                    f['db_path'].item() != self.db_path:
+                return False
+            self.ids = f['ids']
+            if f['fingerprint'].item() != self._fingerprint():
+                self.ids = numpy.zeros(0, dtype=numpy.int64)
+                return False
+            feature_names = f['feature_names']
+            self.features = scipy.sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                                    shape=tuple(f['shape']))
+        self.vocabulary = dict([(name, n) for (n, name) in enumerate(feature_names.tolist())])
+        self.vectorizer = CountVectorizer(min_df=self.min_df, vocabulary=self.vocabulary)
+        self.dirty = False
+        return True
+
+    def save(self):
+        if not self.dirty or self.vectorizer is None:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if len(cache_dir) > 0 and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        feature_names = [None] * len(self.vocabulary)
+        for (name, n) in self.vocabulary.items():
+            feature_names[n] = name
+        features = self.features.tocsr()
+        tmp_path = self.path + '.tmp.npz'
+        numpy.savez(tmp_path,
+                    version=SubjectFeatureCache.VERSION,
+                    min_df=self.min_df,
+                    db_path=numpy.array(self.db_path),
+                    fingerprint=numpy.array(self._fingerprint()),
+                    feature_names=numpy.array(feature_names, dtype=numpy.unicode_),
+                    ids=self.ids,
+                    data=features.data,
+                    indices=features.indices,
+                    indptr=features.indptr,
+                    shape=numpy.array(features.shape))
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def max_id(self):
+        if len(self.ids) == 0:
+            return None
+        return int(self.ids[-1])
+
+    def _fingerprint(self):
+        """
+        Return the SHA-1 of the (Id, Subject) in the database of the cached messages. Deleted
+        messages change it too.
+        """
+        digest = hashlib.sha1()
+        max_id = self.max_id()
+        if max_id is None:
+            return digest.hexdigest()
+        cached = set(self.ids.tolist())
+        connection = sqlite3.connect(self.db_path)
+        try:
+            rows = connection.execute('SELECT Id, Subject FROM McEmailMessage WHERE Id <= ? ORDER BY Id',
+                                      (max_id,))
+            for (id_, subject) in rows:
+                if id_ in cached:
+                    digest.update('%d\0%s\0' % (id_, '\1' if subject is None else subject.encode('utf-8')))
+        finally:
+            connection.close()
+        return digest.hexdigest()
+
+    def _lookup(self, ids):
+        """
+        Return the cache row of each id, or -1 if it is not cached.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if len(self.ids) == 0:
+            return -numpy.ones(len(ids), dtype=numpy.int64)
+        positions = numpy.searchsorted(self.ids, ids)
+        positions = numpy.minimum(positions, len(self.ids) - 1)
+        return numpy.where(self.ids[positions] == ids, positions, -1)
+
+    def _extend(self, ids, subjects):
+        new_features = self.vectorizer.transform(subjects)
+        ids = numpy.concatenate((self.ids, numpy.asarray(ids, dtype=numpy.int64)))
+        features = scipy.sparse.vstack((self.features, new_features), format='csr')
+        order = numpy.argsort(ids, kind='mergesort')
+        self.ids = ids[order]
+        self.features = features[order]
+        self.dirty = True
+
+    def fit_transform(self, ids, subjects):
+        rows = self._lookup(ids)
+        missing = numpy.flatnonzero(rows < 0)
+        if self.vectorizer is None or len(missing) > self.refit_ratio * len(ids):
+            self.vectorizer = CountVectorizer(min_df=self.min_df)
+            features = self.vectorizer.fit_transform(subjects).tocsr()
+            self.vocabulary = self.vectorizer.vocabulary_
+            order = numpy.argsort(numpy.asarray(ids, dtype=numpy.int64), kind='mergesort')
+            self.ids = numpy.asarray(ids, dtype=numpy.int64)[order]
+            self.features = features[order]
+            self.misses += len(ids)
+            self.dirty = True
+            return features
+        return self.transform(ids, subjects)
+
+    def transform(self, ids, subjects):
+        assert self.vectorizer is not None
+        rows = self._lookup(ids)
+        missing = numpy.flatnonzero(rows < 0)
+        self.hits += len(ids) - len(missing)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            self._extend([ids[n] for n in missing], [subjects[n] for n in missing])
+            rows = self._lookup(ids)
+        return self.features[rows]
+
+    def summary(self):
+        return 'subject feature cache: %d messages  %d features  hits: %d  misses: %d' % \
+               (len(self.ids), len(self.vocabulary) if self.vocabulary is not None else 0,
+                self.hits, self.misses)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import argparse
+import email.utils
+import random
+import sys
+import time
+import address_parser
+
+
+# Building blocks of generated headers. Most are common forms that take the fast path. The
+# rest are unusual but legal or malformed input that must fall back to email.utils.
+LOCAL_CHARS = 'abcXYZ019.+-_=\'!#$%&*/?^`{|}~'
+DOMAIN_CHARS = 'abcXYZ09.-_'
+NAME_CHARS = u'abc XYZ.\'-\u00e9\u4e2d'
+SPECIALS = '()<>@,;:\\".[] \t\r\n'
+
+
+def random_string(rng, chars, min_length, max_length):
+    return ''.join([rng.choice(chars) for _ in range(rng.randint(min_length, max_length))])
+
+
+def random_address(rng):
+    kind = rng.random()
+    if kind < 0.7:
+        return '%s@%s.%s' % (random_string(rng, 'abcxyz019', 1, 8), random_string(rng, 'abcxyz', 1, 6),
+                             rng.choice(['com', 'COM', 'org', 'co.uk']))
+    if kind < 0.9:
+        return '%s@%s' % (random_string(rng, LOCAL_CHARS, 0, 10), random_string(rng, DOMAIN_CHARS, 0, 10))
+    # Quoted local parts, IP literals, missing @, stray specials
+    return rng.choice(['"a b"@x.com', 'a@[10.0.0.1]', 'nobody', '', '@x.com', 'a@', 'a@@b.com',
+                       'a @ b.com', 'a.@b.com', '.a@b.com', 'a..b@c.com', 'a@b..com']) + \
+        random_string(rng, SPECIALS, 0, 1)
+
+
+def random_name(rng):
+    kind = rng.random()
+    if kind < 0.3:
+        return ''
+    if kind < 0.6:
+        return random_string(rng, NAME_CHARS, 1, 15)
+    if kind < 0.85:
+        return '"%s"' % random_string(rng, NAME_CHARS + ',;:<>@()', 0, 15)
+    # Escaped quotes, comments, encoded words, unbalanced quotes
+    return rng.choice(['"a \\" b"', '(comment) a', 'a (comment)', '=?utf-8?q?=C3=A9?=', '"unbalanced',
+                       'a, b', 'a;b'])
+
+
+def random_element(rng):
+    kind = rng.random()
+    whitespace = lambda: rng.choice(['', '', ' ', '  ', '\t', '\r\n '])
+    if kind < 0.35:
+        return whitespace() + random_address(rng) + whitespace()
+    if kind < 0.9:
+        name = random_name(rng)
+        return whitespace() + name + whitespace() + '<' + random_address(rng) + '>' + whitespace()
+    # Groups, route addresses, comments and plain junk
+    return rng.choice(['group: a@b.com, c@d.com;', 'undisclosed-recipients:;', '<@route:a@b.com>',
+                       'a@b.com (Name)', '<a@b.com', 'a@b.com>', random_string(rng, SPECIALS + 'ab@', 0, 8)])
+
+
+def random_header(rng):
+    elements = [random_element(rng) for _ in range(rng.choice([1, 1, 1, 2, 3, 5]))]
+    separators = [rng.choice([',', ',', ', ', ' , ', ',,', ';']) for _ in range(len(elements))]
+    header = ''.join([e + s for (e, s) in zip(elements, separators)])[:-len(separators[-1])]
+    if rng.random() < 0.05:
+        header += rng.choice([',', ', ', ' '])
+    return header
+
+
+def getaddresses(header):
+    # email.utils.getaddresses([None]) fails. A missing header has no addresses.
+    return email.utils.getaddresses([header] if header is not None else [])
+
+
+def check(headers, func, reference):
+    failures = list()
+    for header in headers:
+        expected = reference(header)
+        actual = func(header)
+        if actual != expected:
+            failures.append((header, expected, actual))
+    return failures
+
+
+def timed(func, headers):
+    start = time.time()
+    for header in headers:
+        func(header)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that address_parser agrees with email.utils on random headers')
+    parser.add_argument('--iterations', type=int, default=200000, help='Number of random headers')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--show', type=int, default=10, help='Number of disagreements shown')
+    options = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    # Missing (NULL) and empty headers come straight from the database
+    headers = [None, ''] + [random_header(rng) for _ in range(options.iterations)]
+    single = [h for h in headers if h is None or ',' not in h]
+
+    failures = check(headers, address_parser.parse_address, email.utils.parseaddr)
+    failures += check(headers, address_parser.parse_address_list, getaddresses)
+    fast_single = sum([h is not None and address_parser._SINGLE.match(h) is not None for h in headers])
+    print '%d headers  fast path (single address): %.1f%%' % (len(headers), 100.0 * fast_single / len(headers))
+    for (name, func, reference, inputs) in (
+            ('parse_address', address_parser.parse_address, email.utils.parseaddr, single),
+            ('parse_address_list', address_parser.parse_address_list, getaddresses, headers)):
+        (fast, slow) = (timed(func, inputs), timed(reference, inputs))
+        print '%-20s %8.3f sec  email.utils %8.3f sec  speedup %.1fx' % (name, fast, slow, slow / max(fast, 1e-9))
+
+    if len(failures) > 0:
+        print '%d disagreements with email.utils' % len(failures)
+        for (header, expected, actual) in failures[:options.show]:
+            print '  %r\n    email.utils: %r\n    fast path:   %r' % (header, expected, actual)
+        sys.exit(1)
+    print 'no disagreements'
+
+
+if __name__ == '__main__':
+    main()
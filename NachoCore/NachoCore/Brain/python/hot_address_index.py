@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import argparse
+import bisect
+import os
+import time
+import numpy
+from email_address import EmailAddress
+from message_store import MessageStore
+from analyzer_relation import RelationAnalyzer
+from analyzer_relation_decayed import DecayedRelationAnalyzer
+
+
+class HotAddressIndex:
+    """
+    Addresses of an EmailAddressTable (or EmailAddressSnapshot) ranked by the (read + replied) /
+    received score of one of the from / to / cc columns, hottest first. Ties are ranked by the
+    number of received messages. Only addresses that received at least min_received messages in
+    the column are ranked.
+
+    The ranking is a sorted list of (-score, -received, id) keys. build() ranks all addresses
+    with one numpy sort. After that, refresh() re-ranks only the addresses whose statistics
+    changed (e.g. the set returned by RelationAnalyzer.update()) with one bisect removal and
+    insertion each. top(k) costs O(k) and range() O(log n + number of results).
+    """
+    def __init__(self, table, column=EmailAddress.FROM, min_received=1):
+        assert column in (EmailAddress.FROM, EmailAddress.TO, EmailAddress.CC)
+        self.table = table
+        self.column = column
+        self.min_received = min_received
+        self._keys = list()
+        # Current key of every ranked address id
+        self._key_of = dict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def build(self):
+        counts = self.table.counts()
+        received = counts[:, self.column]
+        ids = numpy.flatnonzero(received >= max(self.min_received, 1))
+        received = received[ids]
+        scores = (counts[ids, self.column + 1] + counts[ids, self.column + 2]).astype(numpy.float64) / received
+        order = numpy.lexsort((ids, -received, -scores))
+        self._keys = zip((-scores[order]).tolist(), (-received[order]).tolist(), ids[order].tolist())
+        self._key_of = dict([(key[2], key) for key in self._keys])
+
+    def _key(self, id_):
+        row = self.table.counts()[id_]
+        received = row[self.column]
+        if received < max(self.min_received, 1):
+            return None
+        score = float(row[self.column + 1] + row[self.column + 2]) / float(received)
+        return -score, -received.item(), id_
+
+    def _refresh_id(self, id_):
+        old_key = self._key_of.pop(id_, None)
+        if old_key is not None:
+            del self._keys[bisect.bisect_left(self._keys, old_key)]
+        new_key = self._key(id_)
+        if new_key is not None:
+            bisect.insort(self._keys, new_key)
+            self._key_of[id_] = new_key
+
+    def refresh(self, canonical_addresses):
+        """
+        Re-rank the addresses whose statistics changed. Addresses new to the table are ranked.
+        """
+        for canonical_address in canonical_addresses:
+            email_address = self.table.get(canonical_address)
+            if email_address is not None:
+                self._refresh_id(email_address.id)
+
+    def _entry(self, key):
+        return self.table.get_by_id(key[2]).canonical_address, -key[0], -key[1]
+
+    def top(self, k):
+        """
+        Return (canonical address, score, received) of the k hottest addresses.
+        """
+        return [self._entry(key) for key in self._keys[:k]]
+
+    def range(self, low, high):
+        """
+        Return (canonical address, score, received) of the addresses with low <= score <= high,
+        hottest first.
+        """
+        start = bisect.bisect_left(self._keys, (-high, float('-inf')))
+        end = bisect.bisect_right(self._keys, (-low, float('inf')))
+        return [self._entry(key) for key in self._keys[start:end]]
+
+    def rank(self, address):
+        """
+        Return the 0-based rank of an address or None if it is not ranked.
+        """
+        email_address = self.table.get(address)
+        if email_address is None:
+            return None
+        key = self._key_of.get(email_address.id, None)
+        if key is None:
+            return None
+        return bisect.bisect_left(self._keys, key)
+
+
+COLUMNS = {'from': EmailAddress.FROM, 'to': EmailAddress.TO, 'cc': EmailAddress.CC}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the hottest correspondents of a mailbox')
+    parser.add_argument('db_file', help='Database of the mailbox')
+    parser.add_argument('--column', choices=sorted(COLUMNS), default='from',
+                        help='Rank by the statistics of messages from / to / cc the address')
+    parser.add_argument('--top', type=int, default=20, help='Number of addresses listed')
+    parser.add_argument('--range', type=float, nargs=2, default=None, metavar=('LOW', 'HIGH'),
+                        help='List the addresses with a score in [LOW, HIGH] instead of the top ones')
+    parser.add_argument('--min-received', type=int, default=3,
+                        help='Only rank addresses that received at least this many messages')
+    parser.add_argument('--address', action='append', default=[], help='Also show the rank of an address')
+    parser.add_argument('--state', default=None, metavar='FILE',
+                        help='Relation state saved by algo.py --relation-state. Created if missing')
+    parser.add_argument('--snapshot', default=None, metavar='DIR',
+                        help='Relation snapshot saved by algo.py --relation-snapshot (memory-mapped)')
+    parser.add_argument('--half-life', type=float, default=None, metavar='DAYS',
+                        help='Decay the relation statistics with a half life of DAYS days')
+    options = parser.parse_args()
+    if options.snapshot is not None and options.state is not None:
+        parser.error('--snapshot cannot be combined with --state')
+
+    start = time.time()
+    if options.half_life is not None:
+        analyzer = DecayedRelationAnalyzer(options.half_life)
+    else:
+        analyzer = RelationAnalyzer()
+    if options.snapshot is not None:
+        analyzer.load_snapshot(options.snapshot)
+    elif options.state is not None and os.path.exists(options.state):
+        analyzer.load(options.state)
+    else:
+        analyzer.analyze(MessageStore.load(options.db_file))
+        if options.state is not None:
+            analyzer.save(options.state)
+    if options.half_life is not None:
+        analyzer.decay()
+    load_seconds = time.time() - start
+
+    start = time.time()
+    index = HotAddressIndex(analyzer.table, COLUMNS[options.column], options.min_received)
+    index.build()
+    build_seconds = time.time() - start
+
+    start = time.time()
+    if options.range is not None:
+        entries = index.range(*options.range)
+        first_rank = index.rank(entries[0][0]) if len(entries) > 0 else 0
+    else:
+        entries = index.top(options.top)
+        first_rank = 0
+    query_seconds = time.time() - start
+
+    print '%d of %d addresses ranked by %s score  (load %.3f sec  build %.3f sec  query %.6f sec)' % \
+          (len(index), analyzer.table.count(), options.column, load_seconds, build_seconds, query_seconds)
+    print '%6s %8s %10s  %s' % ('rank', 'score', 'received', 'address')
+    for (n, (canonical_address, score, received)) in enumerate(entries):
+        print '%6d %8.4f %10g  %s' % (first_rank + n + 1, score, received, canonical_address)
+    for address in options.address:
+        rank = index.rank(address)
+        print '%s: %s' % (address, 'not ranked' if rank is None else 'rank %d' % (rank + 1))
+
+
+if __name__ == '__main__':
+    main()
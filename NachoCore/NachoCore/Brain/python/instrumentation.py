@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import cProfile
+import pstats
+import StringIO
+from collections import OrderedDict
+
+
+class StageTimer:
+    """
+    Accumulated wall clock and CPU time of all runs of one stage.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def to_dict(self):
+        return OrderedDict([('calls', self.calls), ('wall', self.wall), ('cpu', self.cpu)])
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.timer = None
+        self.wall = None
+        self.cpu = None
+
+    def __enter__(self):
+        Instrumentation.stack.append(self.name)
+        # Register the timer on entry so that stages are listed in the order they start
+        path = '/'.join(Instrumentation.stack)
+        self.timer = Instrumentation.stages.get(path, None)
+        if self.timer is None:
+            self.timer = StageTimer()
+            Instrumentation.stages[path] = self.timer
+        self.wall = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.cpu += time.clock() - self.cpu
+        self.timer.wall += time.time() - self.wall
+        self.timer.calls += 1
+        Instrumentation.stack.pop()
+        return False
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Instrumentation:
+    """
+    Opt-in timers and counters for the Brain pipeline. Everything is a no-op until enable() is
+    called, so instrumented code only pays for an attribute check.
+
+    Stages nest. A stage is recorded under the path of all enclosing stages, e.g.
+    "bayes3/analyze/address parsing". Counters are recorded under the outermost enclosing stage,
+    which algo.py names after the analyzer. Only the process that calls enable() is measured.
+    Stages run in pool workers (--shared, --cv, --time-split) are not.
+    """
+    enabled = False
+    stack = list()
+    stages = OrderedDict()
+    counters = OrderedDict()
+    profiler = None
+
+    _null_stage = _NullStage()
+
+    @classmethod
+    def enable(cls, profile=False):
+        cls.enabled = True
+        cls.reset()
+        if profile:
+            cls.profiler = cProfile.Profile()
+            cls.profiler.enable()
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+        if cls.profiler is not None:
+            cls.profiler.disable()
+
+    @classmethod
+    def reset(cls):
+        cls.stack = list()
+        cls.stages = OrderedDict()
+        cls.counters = OrderedDict()
+
+    @classmethod
+    def stage(cls, name):
+        """
+        Return a context manager that times the enclosed block as stage name.
+        """
+        if not cls.enabled:
+            return cls._null_stage
+        return _Stage(name)
+
+    @classmethod
+    def count(cls, name, n=1):
+        if not cls.enabled:
+            return
+        scope = cls.stack[0] if len(cls.stack) > 0 else ''
+        counters = cls.counters.get(scope, None)
+        if counters is None:
+            counters = OrderedDict()
+            cls.counters[scope] = counters
+        counters[name] = counters.get(name, 0) + n
+
+    @classmethod
+    def summary(cls, scope=None):
+        """
+        Return the stages and counters under scope (an outermost stage name) or all of them.
+        """
+        out = ''
+        for (path, timer) in cls.stages.items():
+            if scope is not None and path != scope and not path.startswith(scope + '/'):
+                continue
+            depth = path.count('/')
+            out += '%-40s calls: %7d  wall: %9.3f sec  cpu: %9.3f sec\n' % \
+                   ('  ' * depth + path.rsplit('/', 1)[-1], timer.calls, timer.wall, timer.cpu)
+        for (counter_scope, counters) in cls.counters.items():
+            if scope is not None and counter_scope != scope:
+                continue
+            for (name, value) in counters.items():
+                out += '%-40s %d\n' % ((counter_scope + ' ' if scope is None else '') + name, value)
+        return out
+
+    @classmethod
+    def profile_summary(cls, limit=20):
+        if cls.profiler is None:
+            return ''
+        out = StringIO.StringIO()
+        pstats.Stats(cls.profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    @classmethod
+    def save_profile(cls, path):
+        """
+        Save the cProfile statistics in pstats format.
+        """
+        if cls.profiler is not None:
+            cls.profiler.dump_stats(path)
+
+    @classmethod
+    def to_dict(cls, **info):
+        return OrderedDict([('time', time.time())] + sorted(info.items()) +
+                           [('stages', OrderedDict([(path, timer.to_dict()) for (path, timer) in cls.stages.items()])),
+                            ('counters', cls.counters)])
+
+    @classmethod
+    def append_json(cls, path, **info):
+        """
+        Append the timers and counters of this run as one JSON line to path. info is stored
+        along (e.g. the database and the analyzers) to tell runs apart.
+        """
+        directory = os.path.dirname(path)
+        if len(directory) > 0 and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'a') as f:
+            f.write(json.dumps(cls.to_dict(**info)) + '\n')
@@ -0,0 +1,290 @@
+import numpy
+from sqlalchemy import text
+from model import Model
+from email_address import EmailAddress
+
+
+class StringTable:
+    """
+    Interns strings. Each distinct string is stored once and identified by its index.
+    """
+    def __init__(self):
+        self.strings = list()
+        self._index = dict()
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, n):
+        return self.strings[n]
+
+    def intern(self, s):
+        n = self._index.get(s, None)
+        if n is None:
+            n = len(self.strings)
+            self._index[s] = n
+            self.strings.append(s)
+        return n
+
+    def find(self, s):
+        """
+        Return the index of a string or -1 if it has never been interned.
+        """
+        return self._index.get(s, -1)
+
+
+class AddressColumn:
+    """
+    A list of address ids per message stored in CSR form. The addresses of message n are
+    ids[offsets[n]:offsets[n+1]].
+    """
+    def __init__(self, offsets, ids):
+        self.offsets = offsets
+        self.ids = ids
+
+    def counts(self):
+        return numpy.diff(self.offsets)
+
+    def message_indices(self):
+        """
+        Return the message index of every entry in ids.
+        """
+        return numpy.repeat(numpy.arange(len(self.offsets) - 1), self.counts())
+
+    def get(self, n):
+        return self.ids[self.offsets[n]:self.offsets[n + 1]]
+
+    def subset(self, indices):
+        counts = self.counts()[indices]
+        offsets = numpy.zeros(len(indices) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+        # Position of every selected entry in the original ids
+        positions = numpy.repeat(self.offsets[:-1][indices] - offsets[:-1], counts) + \
+            numpy.arange(offsets[-1], dtype=numpy.int64)
+        return AddressColumn(offsets, self.ids[positions])
+
+
+class MessageRow:
+    """
+    A lightweight read-only view of one message of a MessageStore. It has the same attributes
+    as McEmailMessage that the analyzers read.
+    """
+    __slots__ = ('_store', '_n')
+
+    def __init__(self, store, n):
+        self._store = store
+        self._n = n
+
+    @property
+    def Id(self):
+        return int(self._store.ids[self._n])
+
+    @property
+    def From(self):
+        return self._store.header(self._store.from_headers[self._n])
+
+    @property
+    def To(self):
+        return self._store.header(self._store.to_headers[self._n])
+
+    @property
+    def Cc(self):
+        return self._store.header(self._store.cc_headers[self._n])
+
+    @property
+    def Subject(self):
+        return self._store.subjects[self._store.subject_ids[self._n]]
+
+    @property
+    def IsRead(self):
+        return bool(self._store.is_read[self._n])
+
+    @property
+    def LastVerbExecuted(self):
+        return int(self._store.last_verb_executed[self._n])
+
+    @property
+    def DateReceived(self):
+        return int(self._store.date_received[self._n])
+
+
+class MessageStore:
+    """
+    Columnar representation of McEmailMessage for the analyzers. Scalar columns are NumPy
+    arrays. Subjects, raw address headers and canonical addresses are interned in string
+    tables. Each distinct header string is parsed only once, and the parsed addresses of
+    From / To / Cc are kept as AddressColumn of address ids.
+
+    RelationAnalyzer, ContentAnalyzer and Evaluator accept a MessageStore anywhere they accept
+    a list of McEmailMessage and then use vectorized code paths.
+    """
+    COLUMNS = ('Id', 'From', 'To', 'Cc', 'Subject', 'IsRead', 'LastVerbExecuted', 'DateReceived')
+
+    def __init__(self):
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.is_read = numpy.zeros(0, dtype=numpy.bool_)
+        self.last_verb_executed = numpy.zeros(0, dtype=numpy.int32)
+        self.date_received = numpy.zeros(0, dtype=numpy.int64)
+
+        self.subjects = StringTable()
+        self.subject_ids = numpy.zeros(0, dtype=numpy.int32)
+
+        # Raw header strings. None is stored as -1.
+        self.headers = StringTable()
+        self.from_headers = numpy.zeros(0, dtype=numpy.int32)
+        self.to_headers = numpy.zeros(0, dtype=numpy.int32)
+        self.cc_headers = numpy.zeros(0, dtype=numpy.int32)
+
+        # Canonical addresses
+        self.addresses = StringTable()
+        self.from_ = AddressColumn(numpy.zeros(1, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int32))
+        self.to = AddressColumn(numpy.zeros(1, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int32))
+        self.cc = AddressColumn(numpy.zeros(1, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int32))
+        # Address id of EmailAddress.get_canonical_address(From) (what RelationAnalyzer uses
+        # to look up the sender), also for a missing From.
+        self.sender_ids = numpy.zeros(0, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+        if n < 0 or n >= len(self):
+            raise IndexError('message index %d out of range' % n)
+        return MessageRow(self, n)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield MessageRow(self, n)
+
+    def header(self, n):
+        if n < 0:
+            return None
+        return self.headers[n]
+
+    def has_subject(self):
+        """
+        Return a boolean array that is True for messages with a non-empty subject.
+        """
+        empty = numpy.array([(s is None) or (len(s) == 0) for s in self.subjects.strings], dtype=numpy.bool_)
+        if len(empty) == 0:
+            return numpy.zeros(len(self), dtype=numpy.bool_)
+        return ~empty[self.subject_ids]
+
+    def subset(self, indices):
+        """
+        Return a store with only the messages at indices (in that order). The string tables,
+        and therefore all parsed headers and addresses, are shared with this store.
+        """
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        store = MessageStore()
+        store.ids = self.ids[indices]
+        store.is_read = self.is_read[indices]
+        store.last_verb_executed = self.last_verb_executed[indices]
+        store.date_received = self.date_received[indices]
+        store.subjects = self.subjects
+        store.subject_ids = self.subject_ids[indices]
+        store.headers = self.headers
+        store.from_headers = self.from_headers[indices]
+        store.to_headers = self.to_headers[indices]
+        store.cc_headers = self.cc_headers[indices]
+        store.addresses = self.addresses
+        store.from_ = self.from_.subset(indices)
+        store.to = self.to.subset(indices)
+        store.cc = self.cc.subset(indices)
+        store.sender_ids = self.sender_ids[indices]
+        return store
+
+    def address_lengths(self):
+        return numpy.array([len(a) for a in self.addresses.strings], dtype=numpy.int32)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a store from an iterable of objects with McEmailMessage attributes (ORM instances,
+        row tuples from EmailMessageStream, ...).
+        """
+        store = cls()
+        ids = list()
+        is_read = list()
+        last_verb_executed = list()
+        date_received = list()
+        subject_ids = list()
+        from_headers = list()
+        to_headers = list()
+        cc_headers = list()
+        sender_ids = list()
+        header_addresses = dict()
+        sender_cache = dict()
+
+        def intern_header(s):
+            if s is None:
+                return -1
+            n = store.headers.intern(s)
+            if n not in header_addresses:
+                header_addresses[n] = [store.addresses.intern(a) for a in EmailAddress.parse_address_string(s)]
+            return n
+
+        def intern_sender(n):
+            sender = sender_cache.get(n, None)
+            if sender is None:
+                # RelationAnalyzer looks up a missing From as get_canonical_address(None), i.e. ''
+                header = store.headers[n] if n >= 0 else None
+                sender = store.addresses.intern(EmailAddress.get_canonical_address(header))
+                sender_cache[n] = sender
+            return sender
+
+        for row in rows:
+            ids.append(row.Id)
+            is_read.append(bool(row.IsRead))
+            last_verb_executed.append(row.LastVerbExecuted or 0)
+            date_received.append(getattr(row, 'DateReceived', None) or 0)
+            subject_ids.append(store.subjects.intern(row.Subject))
+            from_header = intern_header(row.From)
+            from_headers.append(from_header)
+            to_headers.append(intern_header(row.To))
+            cc_headers.append(intern_header(row.Cc))
+            sender_ids.append(intern_sender(from_header))
+
+        store.ids = numpy.array(ids, dtype=numpy.int64)
+        store.is_read = numpy.array(is_read, dtype=numpy.bool_)
+        store.last_verb_executed = numpy.array(last_verb_executed, dtype=numpy.int32)
+        store.date_received = numpy.array(date_received, dtype=numpy.int64)
+        store.subject_ids = numpy.array(subject_ids, dtype=numpy.int32)
+        store.from_headers = numpy.array(from_headers, dtype=numpy.int32)
+        store.to_headers = numpy.array(to_headers, dtype=numpy.int32)
+        store.cc_headers = numpy.array(cc_headers, dtype=numpy.int32)
+        store.sender_ids = numpy.array(sender_ids, dtype=numpy.int32)
+        store.from_ = MessageStore._make_address_column(store.from_headers, header_addresses)
+        store.to = MessageStore._make_address_column(store.to_headers, header_addresses)
+        store.cc = MessageStore._make_address_column(store.cc_headers, header_addresses)
+        return store
+
+    @staticmethod
+    def _make_address_column(header_ids, header_addresses):
+        counts = numpy.zeros(len(header_ids), dtype=numpy.int64)
+        ids = list()
+        for (n, header_id) in enumerate(header_ids):
+            if header_id < 0:
+                continue
+            addresses = header_addresses[header_id]
+            counts[n] = len(addresses)
+            ids.extend(addresses)
+        offsets = numpy.zeros(len(header_ids) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+        return AddressColumn(offsets, numpy.array(ids, dtype=numpy.int32))
+
+    @classmethod
+    def load(cls, db_path):
+        """
+        Build a store directly from McEmailMessage of a SQLite file without creating any ORM
+        instance.
+        """
+        Model.open(db_path)
+        columns = ', '.join(['"%s"' % c for c in cls.COLUMNS])
+        result = Model.engine.execute(text('SELECT %s FROM McEmailMessage ORDER BY Id' % columns))
+        try:
+            return cls.from_rows(result)
+        finally:
+            result.close()
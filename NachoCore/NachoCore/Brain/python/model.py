@@ -1,27 +1,97 @@
 import os
 from sqlalchemy import *
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, load_only
+
+
+def with_id(columns):
+    if 'Id' not in columns:
+        return ('Id',) + tuple(columns)
+    return tuple(columns)
 
 
 class Model:
     db_path = None
     engine = None
     metadata = None
+    session = None
     email_messages = list()
 
+    # Columns of McEmailMessage that the analyzers and the evaluator actually read
+    ANALYZED_COLUMNS = ('Id', 'From', 'To', 'Cc', 'Subject', 'IsRead', 'LastVerbExecuted', 'DateReceived')
+
     @classmethod
-    def load(cls, db_path):
+    def open(cls, db_path):
         if not os.path.exists(db_path):
             raise IOError('%s does not exist' % db_path)
         cls.db_path = db_path
         cls.engine = create_engine('sqlite:///' + os.path.realpath(cls.db_path))
         cls.metadata = MetaData(bind=cls.engine)
 
+    @classmethod
+    def load(cls, db_path, columns=None):
+        """
+        Load all email messages into Model.email_messages. Without columns, they are
+        McEmailMessage instances with only ANALYZED_COLUMNS loaded. The other columns are
+        deferred and loaded from the database on first access. With columns, only those columns
+        (plus Id) are selected and the messages are lightweight named tuples instead of ORM
+        instances, which is several times faster to load and much smaller.
+        """
+        cls.open(db_path)
+
         # Load all emails. Note that we import after Model.metadata is initialized. This is
         # because I am using SQLAlchemy autoload feature that automatically import schema from
         # db file. This is very slick as it nicely sidesteps all db schema migration issues as long
         # as fields we use are not removed.
         import model_emailmessage
-        session = sessionmaker(bind=cls.engine)()
-        query = session.query(model_emailmessage.McEmailMessage)
+        table = model_emailmessage.McEmailMessage
+        # Kept open so that deferred columns can still be loaded
+        if cls.session is not None:
+            cls.session.close()
+        cls.session = sessionmaker(bind=cls.engine)()
+        if columns is None:
+            query = cls.session.query(table).options(load_only(*cls.ANALYZED_COLUMNS))
+        else:
+            query = cls.session.query(*[getattr(table, c) for c in with_id(columns)])
         cls.email_messages = query.all()
+
+    @classmethod
+    def stream(cls, db_path, chunk_size=10000, columns=ANALYZED_COLUMNS):
+        """
+        Open the database without loading any email message. Returns an EmailMessageStream that
+        can be iterated (multiple times) to get the messages in chunks.
+        """
+        cls.open(db_path)
+        cls.email_messages = list()
+        return EmailMessageStream(chunk_size, columns)
+
+
+class EmailMessageStream:
+    """
+    A re-iterable view of McEmailMessage. Each iteration runs a fresh keyset-paginated query
+    (WHERE Id > last Id ORDER BY Id LIMIT chunk_size) and yields a list of rows per chunk. Only
+    the selected columns are loaded and rows are plain tuples with attribute access, so memory
+    is bounded by the chunk size instead of the size of the mailbox.
+    """
+    def __init__(self, chunk_size, columns):
+        assert chunk_size > 0
+        self.chunk_size = chunk_size
+        self.columns = with_id(columns)
+
+    def __iter__(self):
+        import model_emailmessage
+        table = model_emailmessage.McEmailMessage
+        session = sessionmaker(bind=Model.engine)()
+        try:
+            query = session.query(*[getattr(table, c) for c in self.columns]).order_by(table.Id)
+            last_id = None
+            while True:
+                chunk_query = query
+                if last_id is not None:
+                    chunk_query = chunk_query.filter(table.Id > last_id)
+                chunk = chunk_query.limit(self.chunk_size).all()
+                if len(chunk) == 0:
+                    break
+                yield chunk
+                last_id = chunk[-1].Id
+        finally:
+            session.close()
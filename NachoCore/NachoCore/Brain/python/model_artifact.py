@@ -0,0 +1,260 @@
+import array
+import cPickle
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+import numpy
+from sklearn import linear_model
+from sklearn.feature_extraction.text import CountVectorizer
+from analyzer_relation import RelationAnalyzer
+from analyzer_relation_decayed import DecayedRelationAnalyzer
+from analyzer_content import ContentAnalyzer, HashingContentAnalyzer, FeatureContentAnalyzer
+from analyzer_combined import CombinedAnalyzer, StackedCombinedAnalyzer, COMBINERS
+from email_address_snapshot import EmailAddressSnapshot
+
+
+class ModelArtifact:
+    """
+    A versioned single-file bundle of named NumPy arrays, string lists, byte blobs and JSON
+    parameters.
+
+    Layout: MAGIC, format version (uint32), header length (uint64) and SHA-1 of the header,
+    then the JSON header, then one segment per entry. The header lists the offset (from the
+    first multiple of ALIGNMENT after the header), size and SHA-1 of every segment, and the
+    dtype and shape of every array. Every segment is aligned to ALIGNMENT so that arrays can be
+    used straight from a memory map.
+
+    save() writes a temporary file, fsyncs it and renames it over path, so readers see either
+    the old or the new artifact. load() checks the header checksum always and the segment
+    checksums unless verify is False.
+    """
+    MAGIC = 'BRAINMDL'
+    VERSION = 1
+    ALIGNMENT = 64
+    PREAMBLE = struct.Struct('<8sIQ20s')
+
+    def __init__(self, parameters=None):
+        self.parameters = parameters if parameters is not None else dict()
+        self.arrays = OrderedDict()
+        self.strings = OrderedDict()
+        self.blobs = OrderedDict()
+
+    def _segments(self):
+        for (name, a) in self.arrays.items():
+            a = numpy.ascontiguousarray(a)
+            yield name, 'array', a.data, {'dtype': a.dtype.str, 'shape': list(a.shape)}
+        for (name, strings) in self.strings.items():
+            yield name, 'strings', json.dumps(strings), {}
+        for (name, blob) in self.blobs.items():
+            yield name, 'blob', blob, {}
+
+    @staticmethod
+    def _align(offset):
+        return (offset + ModelArtifact.ALIGNMENT - 1) // ModelArtifact.ALIGNMENT * ModelArtifact.ALIGNMENT
+
+    def save(self, path):
+        segments = list(self._segments())
+        entries = list()
+        offset = 0
+        for (name, kind, data, info) in segments:
+            entry = OrderedDict([('name', name), ('kind', kind), ('offset', offset), ('size', len(data)),
+                                 ('sha1', hashlib.sha1(data).hexdigest())])
+            entry.update(info)
+            entries.append(entry)
+            offset = ModelArtifact._align(offset + len(data))
+        header = json.dumps({'parameters': self.parameters, 'entries': entries})
+        base = ModelArtifact._align(ModelArtifact.PREAMBLE.size + len(header))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(ModelArtifact.PREAMBLE.pack(ModelArtifact.MAGIC, ModelArtifact.VERSION, len(header),
+                                                hashlib.sha1(header).digest()))
+            f.write(header)
+            for (entry, (_, _, data, _)) in zip(entries, segments):
+                f.write('\0' * (base + entry['offset'] - f.tell()))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(path, mmap_arrays=True, verify=True):
+        """
+        Load an artifact. With mmap_arrays, arrays are read-only views of a memory map of the
+        file and are only paged in when used. Otherwise they are writable copies.
+        """
+        with open(path, 'rb') as f:
+            preamble = f.read(ModelArtifact.PREAMBLE.size)
+            if len(preamble) != ModelArtifact.PREAMBLE.size:
+                raise ValueError('%s is not a model artifact' % path)
+            (magic, version, header_length, header_sha1) = ModelArtifact.PREAMBLE.unpack(preamble)
+            if magic != ModelArtifact.MAGIC:
+                raise ValueError('%s is not a model artifact' % path)
+            if version != ModelArtifact.VERSION:
+                raise ValueError('%s has an unsupported model artifact version %d' % (path, version))
+            header = f.read(header_length)
+            if hashlib.sha1(header).digest() != header_sha1:
+                raise ValueError('%s has a corrupted header' % path)
+            header = json.loads(header)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        artifact = ModelArtifact(header['parameters'])
+        base = ModelArtifact._align(ModelArtifact.PREAMBLE.size + header_length)
+        for entry in header['entries']:
+            (offset, size) = (base + entry['offset'], entry['size'])
+            if offset + size > len(data):
+                raise ValueError('%s is truncated' % path)
+            if verify and hashlib.sha1(buffer(data, offset, size)).hexdigest() != entry['sha1']:
+                raise ValueError('%s has a corrupted %s segment' % (path, entry['name']))
+            if entry['kind'] == 'array':
+                dtype = numpy.dtype(str(entry['dtype']))
+                if size == 0:
+                    a = numpy.zeros(entry['shape'], dtype=dtype)
+                else:
+                    a = numpy.frombuffer(data, dtype=dtype, count=size // dtype.itemsize, offset=offset)
+                    a = a.reshape(entry['shape'])
+                    if not mmap_arrays:
+                        a = a.copy()
+                artifact.arrays[entry['name']] = a
+            elif entry['kind'] == 'strings':
+                artifact.strings[entry['name']] = json.loads(data[offset:offset + size])
+            else:
+                artifact.blobs[entry['name']] = data[offset:offset + size]
+        return artifact
+
+
+def _put_linear_model(artifact, prefix, model):
+    for attribute in ('coef_', 'intercept_', 'classes_'):
+        artifact.arrays[prefix + attribute] = getattr(model, attribute)
+    if hasattr(model, 't_'):
+        artifact.parameters[prefix + 't_'] = model.t_
+
+
+def _get_linear_model(artifact, prefix, model):
+    for attribute in ('coef_', 'intercept_', 'classes_'):
+        setattr(model, attribute, numpy.array(artifact.arrays[prefix + attribute]))
+    if prefix + 't_' in artifact.parameters:
+        model.t_ = artifact.parameters[prefix + 't_']
+    return model
+
+
+def _put_relation(artifact, analyzer):
+    artifact.parameters['relation'] = {
+        'class': type(analyzer).__name__,
+        'analyze_to': analyzer.analyze_to,
+        'analyze_cc': analyzer.analyze_cc,
+    }
+    if isinstance(analyzer, DecayedRelationAnalyzer):
+        analyzer.decay()
+    state = analyzer._get_state()
+    if isinstance(analyzer, DecayedRelationAnalyzer):
+        artifact.parameters['relation'].update({'half_life_days': state['half_life_days'], 'now': state['now']})
+        artifact.arrays['relation_last_ticks'] = numpy.array(state['last_ticks'], dtype=numpy.int64)
+    table = state['table']
+    artifact.strings['relation_addresses'] = [table.get_by_id(n).canonical_address for n in xrange(table.count())]
+    artifact.arrays['relation_counts'] = table.counts()
+    states = state['message_states']
+    artifact.arrays['relation_state_ids'] = numpy.array(states.keys(), dtype=numpy.int64)
+    artifact.arrays['relation_state_read'] = numpy.array([s[0] for s in states.values()], dtype=numpy.bool_)
+    artifact.arrays['relation_state_verbs'] = numpy.array([s[1] for s in states.values()], dtype=numpy.int32)
+
+
+def _get_relation(artifact, writable):
+    parameters = artifact.parameters['relation']
+    snapshot = EmailAddressSnapshot(artifact.strings['relation_addresses'], artifact.arrays['relation_counts'])
+    if parameters['class'] == 'DecayedRelationAnalyzer':
+        analyzer = DecayedRelationAnalyzer(parameters['half_life_days'])
+        # classify() decays the counters in place, so they must be writable
+        writable = True
+    else:
+        analyzer = RelationAnalyzer()
+    analyzer.analyze_to = parameters['analyze_to']
+    analyzer.analyze_cc = parameters['analyze_cc']
+    state = {'table': snapshot.to_table() if writable else snapshot, 'message_states': dict()}
+    if writable:
+        state['message_states'] = dict(zip(artifact.arrays['relation_state_ids'].tolist(),
+                                           zip(artifact.arrays['relation_state_read'].tolist(),
+                                               artifact.arrays['relation_state_verbs'].tolist())))
+    if isinstance(analyzer, DecayedRelationAnalyzer):
+        state.update({'half_life_days': parameters['half_life_days'], 'now': parameters['now'],
+                      'last_ticks': array.array('l', artifact.arrays['relation_last_ticks'].tolist())})
+    analyzer._set_state(state)
+    return analyzer
+
+
+def _put_content(artifact, analyzer):
+    artifact.parameters['content'] = {'class': type(analyzer).__name__}
+    if isinstance(analyzer, FeatureContentAnalyzer):
+        artifact.blobs['content_pipeline'] = cPickle.dumps(analyzer.pipeline, cPickle.HIGHEST_PROTOCOL)
+    elif isinstance(analyzer, HashingContentAnalyzer):
+        artifact.parameters['content'].update({'n_features': analyzer.vectorizer.n_features,
+                                               'chunk_size': analyzer.chunk_size, 'epochs': analyzer.epochs})
+    else:
+        vocabulary = analyzer.vectorizer.vocabulary_
+        terms = [None] * len(vocabulary)
+        for (term, n) in vocabulary.items():
+            terms[n] = term
+        artifact.parameters['content']['min_df'] = analyzer.vectorizer.min_df
+        artifact.strings['content_vocabulary'] = terms
+    _put_linear_model(artifact, 'content_', analyzer.logreg)
+
+
+def _get_content(artifact):
+    parameters = artifact.parameters['content']
+    if parameters['class'] == 'FeatureContentAnalyzer':
+        analyzer = FeatureContentAnalyzer(cPickle.loads(artifact.blobs['content_pipeline']))
+    elif parameters['class'] == 'HashingContentAnalyzer':
+        analyzer = HashingContentAnalyzer(parameters['n_features'], parameters['chunk_size'], parameters['epochs'])
+    else:
+        analyzer = ContentAnalyzer()
+        terms = artifact.strings['content_vocabulary']
+        analyzer.vectorizer = CountVectorizer(min_df=parameters['min_df'],
+                                              vocabulary=dict(zip(terms, xrange(len(terms)))))
+    _get_linear_model(artifact, 'content_', analyzer.logreg)
+    return analyzer
+
+
+def save_analyzer(analyzer, name, path, **info):
+    """
+    Save a trained analyzer (as created by algo.get_analyzer(name)) to an artifact. info is
+    stored as is (e.g. what it was trained on).
+    """
+    artifact = ModelArtifact({'analyzer': name, 'time': time.time(), 'info': info})
+    if isinstance(analyzer, CombinedAnalyzer):
+        _put_relation(artifact, analyzer.relation_analyzer)
+        _put_content(artifact, analyzer.content_analyzer)
+        if isinstance(analyzer, StackedCombinedAnalyzer):
+            _put_linear_model(artifact, 'combiner_', analyzer.logreg)
+    elif isinstance(analyzer, RelationAnalyzer):
+        _put_relation(artifact, analyzer)
+    elif isinstance(analyzer, ContentAnalyzer):
+        _put_content(artifact, analyzer)
+    else:
+        raise ValueError('cannot save analyzer %s' % name)
+    artifact.save(path)
+
+
+def load_analyzer(path, writable=False, verify=True):
+    """
+    Load an analyzer saved by save_analyzer(). Returns (name, analyzer, artifact parameters).
+
+    By default the relation statistics stay in the memory-mapped file, which is enough for
+    classify() and loads in milliseconds. Set writable to copy them into an EmailAddressTable
+    for further update() calls.
+    """
+    artifact = ModelArtifact.load(path, mmap_arrays=not writable, verify=verify)
+    name = artifact.parameters['analyzer']
+    if name in COMBINERS:
+        analyzer = COMBINERS[name](relation_analyzer=_get_relation(artifact, writable),
+                                   content_analyzer=_get_content(artifact))
+        if isinstance(analyzer, StackedCombinedAnalyzer):
+            _get_linear_model(artifact, 'combiner_', analyzer.logreg)
+    elif 'relation' in artifact.parameters:
+        analyzer = _get_relation(artifact, writable)
+    else:
+        analyzer = _get_content(artifact)
+    return name, analyzer, artifact.parameters
@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import numpy
+from message_store import MessageStore
+
+
+class ScoreDiff:
+    """
+    Comparison of the scores of one analyzer with McEmailMessage.Score written by the device.
+    All arrays are aligned by message and only cover messages that have both scores.
+    """
+    def __init__(self, analyzer, ids, device_scores, score_versions, python_scores, num_missing,
+                 hot_threshold=0.5):
+        self.analyzer = analyzer
+        self.ids = ids
+        self.device_scores = device_scores
+        self.score_versions = score_versions
+        self.python_scores = python_scores
+        # Messages with a Python score but no device score (NULL or ScoreVersion 0)
+        self.num_missing = num_missing
+        self.hot_threshold = hot_threshold
+
+    def __len__(self):
+        return len(self.ids)
+
+    def abs_diff(self):
+        return numpy.abs(self.python_scores - self.device_scores)
+
+    def correlation(self):
+        if len(self) < 2 or numpy.std(self.python_scores) == 0.0 or numpy.std(self.device_scores) == 0.0:
+            return 0.0
+        return float(numpy.corrcoef(self.python_scores, self.device_scores)[0, 1])
+
+    @staticmethod
+    def _ranks(x):
+        # Average ranks of ties
+        (_, inverse, counts) = numpy.unique(x, return_inverse=True, return_counts=True)
+        ends = numpy.cumsum(counts)
+        return ((ends - counts + ends - 1) / 2.0)[inverse]
+
+    def rank_correlation(self):
+        """
+        Spearman rank correlation.
+        """
+        if len(self) < 2:
+            return 0.0
+        p = ScoreDiff._ranks(self.python_scores)
+        q = ScoreDiff._ranks(self.device_scores)
+        if numpy.std(p) == 0.0 or numpy.std(q) == 0.0:
+            return 0.0
+        return float(numpy.corrcoef(p, q)[0, 1])
+
+    def hot_agreement(self):
+        """
+        Return the 2 x 2 counts of (device hot, python hot), indexed [device][python].
+        """
+        device_hot = (self.device_scores >= self.hot_threshold).astype(numpy.int64)
+        python_hot = (self.python_scores >= self.hot_threshold).astype(numpy.int64)
+        return numpy.bincount(device_hot * 2 + python_hot, minlength=4).reshape(2, 2)
+
+    def largest(self, n=10):
+        """
+        Return (Id, device score, python score) of the n messages that differ the most.
+        """
+        order = numpy.argsort(-self.abs_diff(), kind='mergesort')[:n]
+        return zip(self.ids[order].tolist(), self.device_scores[order].tolist(), self.python_scores[order].tolist())
+
+    def summary(self):
+        out = 'messages compared: %d  without device score: %d\n' % (len(self), self.num_missing)
+        if len(self) == 0:
+            return out
+        diff = self.abs_diff()
+        out += 'mean abs diff: %.6f  rmse: %.6f  max abs diff: %.6f\n' % \
+               (numpy.mean(diff), numpy.sqrt(numpy.mean(diff ** 2)), numpy.max(diff))
+        out += 'abs diff percentiles: 50%%: %.6f  90%%: %.6f  99%%: %.6f\n' % \
+               tuple(numpy.percentile(diff, [50, 90, 99]))
+        out += 'pearson: %.4f  spearman: %.4f\n' % (self.correlation(), self.rank_correlation())
+        agreement = self.hot_agreement()
+        out += 'hot agreement: %.3f%%  (device hot / python not hot: %d  device not hot / python hot: %d)\n' % \
+               (100.0 * (agreement[0, 0] + agreement[1, 1]) / len(self), agreement[1, 0], agreement[0, 1])
+        (versions, inverse) = numpy.unique(self.score_versions, return_inverse=True)
+        if len(versions) > 1:
+            for (n, version) in enumerate(versions):
+                out += 'ScoreVersion %d: %d messages  mean abs diff: %.6f\n' % \
+                       (version, numpy.count_nonzero(inverse == n), numpy.mean(diff[inverse == n]))
+        out += 'largest differences (Id: device / python):\n'
+        for (id_, device_score, python_score) in self.largest():
+            out += '  %d: %.6f / %.6f\n' % (id_, device_score, python_score)
+        return out
+
+
+class ScoreExport:
+    """
+    Writes analyzer scores into a side table keyed by McEmailMessage Id and analyzer name, so
+    they can be compared with the Score the device wrote to McEmailMessage.
+
+    The side table lives in the device database unless score_db_path is given. Then it lives in
+    that database, which is attached to the device database, and the device database is only
+    read.
+    """
+    TABLE = 'BrainScore'
+
+    def __init__(self, db_path, score_db_path=None, batch_size=100000):
+        if not os.path.exists(db_path):
+            raise IOError('%s does not exist' % db_path)
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(db_path)
+        if score_db_path is None:
+            self.table = ScoreExport.TABLE
+        else:
+            self.connection.execute('ATTACH DATABASE ? AS brain', (score_db_path,))
+            self.table = 'brain.' + ScoreExport.TABLE
+        self.connection.execute('CREATE TABLE IF NOT EXISTS %s (EmailMessageId INTEGER NOT NULL, '
+                                'Analyzer TEXT NOT NULL, Score REAL, '
+                                'PRIMARY KEY (EmailMessageId, Analyzer))' % self.table)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def _get_ids(email_messages):
+        if isinstance(email_messages, MessageStore):
+            return email_messages.ids.tolist()
+        return [email_message.Id for email_message in email_messages]
+
+    def clear(self, analyzer):
+        self.connection.execute('DELETE FROM %s WHERE Analyzer = ?' % self.table, (analyzer,))
+        self.connection.commit()
+
+    def write(self, analyzer, email_messages, scores):
+        """
+        Store the scores of email_messages. Rows are inserted with executemany() in transactions
+        of batch_size rows. Existing scores of the same analyzer are replaced.
+        """
+        ids = ScoreExport._get_ids(email_messages)
+        assert len(ids) == len(scores)
+        scores = numpy.asarray(scores, dtype=numpy.float64).tolist()
+        sql = 'INSERT OR REPLACE INTO %s (EmailMessageId, Analyzer, Score) VALUES (?, ?, ?)' % self.table
+        for start in xrange(0, len(ids), self.batch_size):
+            end = start + self.batch_size
+            with self.connection:
+                self.connection.executemany(sql, zip(ids[start:end], [analyzer] * len(ids[start:end]),
+                                                     scores[start:end]))
+
+    def diff(self, analyzer, hot_threshold=0.5):
+        """
+        Return a ScoreDiff of the stored scores of analyzer against McEmailMessage.Score.
+        Messages whose device Score is NULL or whose ScoreVersion is 0 (never scored) are
+        counted as missing.
+        """
+        rows = self.connection.execute(
+            'SELECT b.EmailMessageId, COALESCE(m.Score, 0.0), m.Score IS NULL, COALESCE(m.ScoreVersion, 0), '
+            'b.Score FROM %s AS b JOIN McEmailMessage AS m ON m.Id = b.EmailMessageId WHERE b.Analyzer = ? '
+            'ORDER BY b.EmailMessageId' % self.table, (analyzer,)).fetchall()
+        columns = numpy.array(rows, dtype=numpy.float64).reshape(-1, 5)
+        ids = columns[:, 0].astype(numpy.int64)
+        device_scores = columns[:, 1]
+        score_versions = columns[:, 3].astype(numpy.int64)
+        python_scores = columns[:, 4]
+        scored = (columns[:, 2] == 0) & (score_versions > 0)
+        return ScoreDiff(analyzer, ids[scored], device_scores[scored], score_versions[scored],
+                         python_scores[scored], int(numpy.count_nonzero(~scored)), hot_threshold)
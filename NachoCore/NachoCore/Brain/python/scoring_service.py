@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+
+import argparse
+import copy
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import stat
+import threading
+import time
+from collections import namedtuple
+from model import Model
+from message_store import MessageStore
+from analyzer_relation import RelationAnalyzer
+from analyzer_relation_decayed import DecayedRelationAnalyzer
+from analyzer_combined import CombinedAnalyzer, COMBINERS
+from model_artifact import save_analyzer, load_analyzer
+import algo
+
+
+# A message sent to the service. Header fields that are not sent are None.
+ServiceMessage = namedtuple('ServiceMessage', Model.ANALYZED_COLUMNS)
+DEFAULTS = {'Id': 0, 'IsRead': False, 'LastVerbExecuted': 0, 'DateReceived': 0}
+
+
+def to_message(fields):
+    return ServiceMessage(*[fields.get(c, DEFAULTS.get(c, None)) for c in Model.ANALYZED_COLUMNS])
+
+
+def train(analyzer, email_messages):
+    """
+    Like analyze() except that relation analyzers are trained with update(), so that they
+    remember the state of every message and a later update of the same message is applied as
+    a transition instead of being counted twice.
+    """
+    if isinstance(analyzer, CombinedAnalyzer):
+        train(analyzer.relation_analyzer, email_messages)
+        train(analyzer.content_analyzer, email_messages)
+        if analyzer.needs_fit():
+            analyzer.fit_combiner(email_messages, analyzer.relation_analyzer.classify(email_messages),
+                                  analyzer.content_analyzer.classify(email_messages))
+    elif isinstance(analyzer, RelationAnalyzer):
+        analyzer.update(email_messages)
+    else:
+        analyzer.analyze(email_messages)
+
+
+def copy_for_update(analyzer):
+    """
+    Return a copy of analyzer that update_analyzer() can modify without affecting analyzer.
+    Only the parts that learn incrementally are copied. The others are shared, as nothing
+    modifies them after training. A deep copy of a large relation table is slow, so the
+    service makes one replica at start instead of a copy per update.
+    """
+    if isinstance(analyzer, CombinedAnalyzer):
+        new_analyzer = copy.copy(analyzer)
+        new_analyzer.relation_analyzer = copy_for_update(analyzer.relation_analyzer)
+        new_analyzer.content_analyzer = copy_for_update(analyzer.content_analyzer)
+        return new_analyzer
+    if hasattr(analyzer, 'update'):
+        return copy.deepcopy(analyzer)
+    return analyzer
+
+
+def update_analyzer(analyzer, email_messages):
+    """
+    Fold messages into the parts of analyzer that learn incrementally (RelationAnalyzer,
+    HashingContentAnalyzer). The other parts and a trained combiner are left as they are.
+    """
+    if isinstance(analyzer, CombinedAnalyzer):
+        update_analyzer(analyzer.relation_analyzer, email_messages)
+        update_analyzer(analyzer.content_analyzer, email_messages)
+    elif hasattr(analyzer, 'update'):
+        analyzer.update(email_messages)
+
+
+def settle(analyzer):
+    """
+    Make classify() read-only until the next update. Only DecayedRelationAnalyzer needs it, as
+    its classify() first decays the counters to now.
+    """
+    if isinstance(analyzer, CombinedAnalyzer):
+        settle(analyzer.relation_analyzer)
+    elif isinstance(analyzer, DecayedRelationAnalyzer):
+        analyzer.decay()
+
+
+class ModelSnapshot:
+    """
+    A trained analyzer and its version. The analyzer is not modified while it is published.
+    """
+    def __init__(self, analyzer, version):
+        self.analyzer = analyzer
+        self.version = version
+
+
+class _Request:
+    def __init__(self, messages):
+        self.messages = messages
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        # Event.wait() without a timeout cannot be interrupted in Python 2
+        while not self._done.wait(1.0):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class ScoringService:
+    """
+    Scores messages with a trained analyzer kept in memory. score() and update() can be called
+    from any number of threads.
+
+    Score requests are queued and a single scoring thread takes whatever has queued up, waiting
+    up to max_delay seconds after the first request for more, up to max_batch_size messages. The
+    batch is turned into one MessageStore and classified with the vectorized code paths, and the
+    scores are handed back to each request.
+
+    Every batch is classified by the current ModelSnapshot, which is not modified while it is
+    published. Updates are queued and coalesced the same way by an update thread. The service
+    keeps two replicas of the analyzer: the published one and an idle one. An update is applied
+    to the idle replica, which is published as a new snapshot by a single reference assignment,
+    so a batch never sees a half-applied update and scoring never waits for training. Once the
+    scoring thread is done with the previous snapshot, the update is replayed onto it and it
+    becomes the idle replica. An update costs two update() calls instead of a copy of the model.
+    """
+    def __init__(self, analyzer, max_batch_size=1000, max_delay=0.005):
+        assert max_batch_size > 0
+        settle(analyzer)
+        self._snapshot = ModelSnapshot(analyzer, 0)
+        self._replica = copy_for_update(analyzer)
+        # Held by the scoring thread while it classifies a batch with a snapshot
+        self._scoring = threading.Lock()
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._score_queue = Queue.Queue()
+        self._update_queue = Queue.Queue()
+        self._threads = list()
+        self.num_batches = 0
+        self.num_scored = 0
+        self.num_updates = 0
+        self.num_updated = 0
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def start(self):
+        for target in (self._score_loop, self._update_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Finish the queued requests and stop the threads.
+        """
+        self._score_queue.put(None)
+        self._update_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = list()
+
+    def score(self, email_messages):
+        """
+        Return the scores of email_messages and the version of the snapshot that scored them.
+        """
+        request = _Request(email_messages)
+        self._score_queue.put(request)
+        return request.wait()
+
+    def update(self, email_messages):
+        """
+        Fold email_messages (new messages or new read / replied states of known ones) into the
+        model. Returns the version of the first snapshot that includes them.
+        """
+        request = _Request(email_messages)
+        self._update_queue.put(request)
+        return request.wait()
+
+    def _next_batch(self, queue):
+        """
+        Block for the next request and coalesce the requests that arrive within max_delay
+        seconds into one batch. Returns (requests, stop).
+        """
+        request = queue.get()
+        if request is None:
+            return [], True
+        requests = [request]
+        size = len(request.messages)
+        deadline = time.time() + self.max_delay
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0.0:
+                    request = queue.get(timeout=timeout)
+                else:
+                    request = queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                return requests, True
+            requests.append(request)
+            size += len(request.messages)
+        return requests, False
+
+    @staticmethod
+    def _messages(requests):
+        email_messages = list()
+        for request in requests:
+            email_messages.extend(request.messages)
+        return email_messages
+
+    def _score_loop(self):
+        stop = False
+        while not stop:
+            (requests, stop) = self._next_batch(self._score_queue)
+            if len(requests) == 0:
+                continue
+            with self._scoring:
+                snapshot = self._snapshot
+                try:
+                    email_messages = ScoringService._messages(requests)
+                    scores = snapshot.analyzer.classify(MessageStore.from_rows(email_messages))
+                except Exception as e:
+                    for request in requests:
+                        request.finish(error=e)
+                    continue
+            self.num_batches += 1
+            self.num_scored += len(email_messages)
+            start = 0
+            for request in requests:
+                end = start + len(request.messages)
+                request.finish(result=(scores[start:end], snapshot.version))
+                start = end
+
+    def _update_loop(self):
+        stop = False
+        while not stop:
+            (requests, stop) = self._next_batch(self._update_queue)
+            if len(requests) == 0:
+                continue
+            snapshot = self._snapshot
+            analyzer = self._replica
+            try:
+                email_messages = ScoringService._messages(requests)
+                update_analyzer(analyzer, email_messages)
+                settle(analyzer)
+            except Exception as e:
+                # The replica may be partly updated. Copy it again from the published one.
+                self._replica = copy_for_update(snapshot.analyzer)
+                for request in requests:
+                    request.finish(error=e)
+                continue
+            # Only this thread publishes snapshots
+            self._snapshot = ModelSnapshot(analyzer, snapshot.version + 1)
+            self.num_updates += 1
+            self.num_updated += len(email_messages)
+            for request in requests:
+                request.finish(result=snapshot.version + 1)
+            self._replay(snapshot.analyzer, email_messages)
+
+    def _replay(self, analyzer, email_messages):
+        """
+        Apply an update that was published to the previous snapshot analyzer, which becomes the
+        idle replica.
+        """
+        # A batch that took the previous snapshot before the update was published may still be
+        # classifying with it
+        with self._scoring:
+            pass
+        try:
+            update_analyzer(analyzer, email_messages)
+            settle(analyzer)
+        except Exception:
+            analyzer = copy_for_update(self._snapshot.analyzer)
+        self._replica = analyzer
+
+    def stats(self):
+        return {'version': self._snapshot.version,
+                'batches': self.num_batches,
+                'scored': self.num_scored,
+                'updates': self.num_updates,
+                'updated': self.num_updated}
+
+    def handle(self, request):
+        """
+        Execute a decoded JSON request and return the response:
+
+        {"op": "score", "messages": [...]} -> {"scores": [...], "version": n}
+        {"op": "update", "messages": [...]} -> {"version": n}
+        {"op": "stats"} -> {"version": n, "batches": ..., ...}
+
+        Messages are objects with McEmailMessage fields (From, To, Cc, Subject, ...). Updates
+        need Id, IsRead and LastVerbExecuted as well. Failures return {"error": "..."}.
+        """
+        try:
+            op = request.get('op', None)
+            if op == 'score':
+                (scores, version) = self.score([to_message(m) for m in request['messages']])
+                return {'scores': scores, 'version': version}
+            if op == 'update':
+                return {'version': self.update([to_message(m) for m in request['messages']])}
+            if op == 'stats':
+                return self.stats()
+            return {'error': 'unknown op %r' % op}
+        except Exception as e:
+            return {'error': '%s: %s' % (type(e).__name__, e)}
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    One connection. Requests and responses are JSON objects, one per line.
+    """
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if len(line) == 0:
+                break
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'error': 'invalid request: %s' % e}
+            else:
+                response = self.server.service.handle(request)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class ScoringServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        # A socket left behind by a previous server that was killed
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.path = path
+        self.service = service
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ScoringClient:
+    """
+    A connection to a ScoringServer.
+    """
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self._file = self.socket.makefile('rb')
+
+    def close(self):
+        self._file.close()
+        self.socket.close()
+
+    def request(self, request):
+        self.socket.sendall(json.dumps(request) + '\n')
+        response = json.loads(self._file.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def score(self, messages):
+        response = self.request({'op': 'score', 'messages': messages})
+        return response['scores']
+
+    def update(self, messages):
+        return self.request({'op': 'update', 'messages': messages})['version']
+
+    def stats(self):
+        return self.request({'op': 'stats'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the scores of a Brain analyzer over a Unix socket')
+    parser.add_argument('db_file', nargs='?', default=None, help='Database to train the analyzer on')
+    parser.add_argument('--socket', required=True, help='Path of the Unix socket')
+    parser.add_argument('--analyzer', default='linear',
+                        help='Analyzer (bayes1, bayes3, logistic, hashing, features, %s)' % ', '.join(sorted(COMBINERS)))
+    parser.add_argument('--max-batch-size', type=int, default=1000,
+                        help='Maximum number of messages classified together')
+    parser.add_argument('--max-delay-ms', type=float, default=5.0,
+                        help='How long the first request of a batch waits for more requests')
+    parser.add_argument('--half-life', type=float, default=None, metavar='DAYS',
+                        help='Decay the relation statistics with a half life of DAYS days')
+    parser.add_argument('--model', default=None, metavar='FILE',
+                        help='Start from a model saved by --save-model instead of training on db_file')
+    parser.add_argument('--save-model', default=None, metavar='FILE',
+                        help='Save the trained model to FILE')
+    options = parser.parse_args()
+    if (options.db_file is None) == (options.model is None):
+        parser.error('either db_file or --model is required')
+    if options.model is not None and (options.half_life is not None or options.save_model is not None):
+        parser.error('--model cannot be combined with --half-life or --save-model')
+
+    start = time.time()
+    if options.model is not None:
+        # Writable, so that updates can be folded in
+        (name, analyzer, parameters) = load_analyzer(options.model, writable=True)
+        print 'loaded %s trained on %s in %.3f sec' % (name, parameters['info'].get('db_file', '?'),
+                                                       time.time() - start)
+    else:
+        Model.load(options.db_file, columns=Model.ANALYZED_COLUMNS)
+        analyzer = algo.get_analyzer(options.analyzer, half_life=options.half_life)
+        train(analyzer, Model.email_messages)
+        print 'trained %s on %d messages in %.3f sec' % (options.analyzer, len(Model.email_messages),
+                                                         time.time() - start)
+        Model.email_messages = list()
+        if options.save_model is not None:
+            save_analyzer(analyzer, options.analyzer, options.save_model, db_file=options.db_file)
+
+    service = ScoringService(analyzer, options.max_batch_size, options.max_delay_ms / 1000.0)
+    service.start()
+    server = ScoringServer(options.socket, service)
+    print 'listening on %s' % options.socket
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import copy
+import multiprocessing
+from analyzer_relation import RelationAnalyzer
+from analyzer_content import ContentAnalyzer, FeatureContentAnalyzer
+from analyzer_combined import COMBINERS
+from evaluator import Evaluator
+
+
+# Analyzers that only need a base analyzer. The value is (base, analyze_to, analyze_cc).
+BASE_ANALYZERS = {
+    'bayes1': ('relation', False, False),
+    'bayes3': ('relation', True, True),
+    'logistic': ('content', None, None),
+    'features': ('features', None, None),
+}
+
+# State inherited by forked pool workers so that messages and trained models are not pickled
+# for every task.
+_worker_state = dict()
+
+
+def _train(base):
+    if base == 'relation':
+        analyzer = RelationAnalyzer()
+    elif base == 'features':
+        analyzer = FeatureContentAnalyzer()
+    else:
+        analyzer = ContentAnalyzer()
+    analyzer.analyze(_worker_state['email_messages'])
+    return analyzer
+
+
+def _classify(name):
+    (base, analyze_to, analyze_cc) = BASE_ANALYZERS[name]
+    # A shallow copy shares the trained table / model but not the flags
+    analyzer = copy.copy(_worker_state[base])
+    if base == 'relation':
+        analyzer.analyze_to = analyze_to
+        analyzer.analyze_cc = analyze_cc
+    return name, analyzer.classify(_worker_state['email_messages'])
+
+
+def _evaluate(args):
+    (name, scores) = args
+    return name, _worker_state['evaluator'].evaluate(_worker_state['email_messages'], scores)
+
+
+class SharedModelRunner:
+    """
+    Evaluate several analyzers on the same messages while training each base analyzer
+    (RelationAnalyzer, ContentAnalyzer) only once. bayes1 and bayes3 share one relation table.
+    The combined analyzers reuse the bayes3 and logistic score vectors instead of retraining
+    and reclassifying. Training, classification and evaluation are fanned out over a process
+    pool. Workers are forked after the shared state is set up so they inherit it.
+    """
+    def __init__(self, email_messages, processes=None, evaluator=None):
+        self.email_messages = email_messages
+        self.processes = processes
+        if evaluator is None:
+            evaluator = Evaluator()
+        self.evaluator = evaluator
+
+    @staticmethod
+    def required_scores(names):
+        """
+        Return the names of base analyzers whose scores are needed to evaluate names.
+        """
+        required = list()
+        for name in names:
+            if name in BASE_ANALYZERS:
+                needed = [name]
+            elif name in COMBINERS:
+                # All combined analyzers combine the bayes3 and logistic scores
+                needed = ['bayes3', 'logistic']
+            else:
+                raise ValueError('unknown analyzer type %s' % name)
+            for base_name in needed:
+                if base_name not in required:
+                    required.append(base_name)
+        return required
+
+    def _map(self, func, args):
+        if self.processes == 1 or len(args) <= 1:
+            return map(func, args)
+        pool = multiprocessing.Pool(processes=self.processes)
+        try:
+            return pool.map(func, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def train(self, bases):
+        _worker_state.clear()
+        _worker_state['email_messages'] = self.email_messages
+        _worker_state['evaluator'] = self.evaluator
+        for (base, analyzer) in zip(bases, self._map(_train, bases)):
+            _worker_state[base] = analyzer
+
+    def run(self, names):
+        """
+        Returns a list of (name, EvaluatorResult) in the order of names.
+        """
+        score_names = SharedModelRunner.required_scores(names)
+        bases = list()
+        for score_name in score_names:
+            base = BASE_ANALYZERS[score_name][0]
+            if base not in bases:
+                bases.append(base)
+        self.train(bases)
+
+        scores = dict(self._map(_classify, score_names))
+        for name in names:
+            if name in COMBINERS:
+                analyzer = COMBINERS[name](_worker_state.get('relation', None),
+                                           _worker_state.get('content', None))
+                if analyzer.needs_fit():
+                    analyzer.fit_combiner(self.email_messages, scores['bayes3'], scores['logistic'])
+                scores[name] = analyzer.combine_scores(scores['bayes3'], scores['logistic'])
+
+        results = dict(self._map(_evaluate, [(name, scores[name]) for name in names]))
+        return [(name, results[name]) for name in names]
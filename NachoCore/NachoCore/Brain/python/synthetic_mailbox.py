@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sqlite3
+import numpy
+
+
+class SyntheticMailbox:
+    """
+    Generates a device-like SQLite database with McEmailMessage, McEmailAddress and
+    McMapEmailAddressEntry (the message <-> address links, as in the current device schema)
+    filled with synthetic messages, so that the analyzers can be benchmarked without a real
+    mailbox.
+
+    Correspondents are drawn from a Zipf distribution with exponent zipf_s, so a few addresses
+    send most of the messages. Subject words are drawn from a Zipf distribution over a vocabulary
+    of vocabulary_size words. Every address and every word has a random interest. The log-odds
+    of a message being read are the log-odds of read_rate plus the interest of its sender and
+    the mean interest of its subject words, so both the relation and the content analyzers have
+    something to learn. A read message is replied to with probability reply_rate / read_rate.
+    """
+    # Interval of DateReceived in .NET ticks (100 ns) between two consecutive messages, on average
+    TICKS_PER_MESSAGE = 36000000000
+    FIRST_TICKS = 635000000000000000
+
+    def __init__(self, num_messages, num_addresses=None, zipf_s=1.2, vocabulary_size=5000,
+                 read_rate=0.6, reply_rate=0.1, seed=0):
+        assert 0.0 < read_rate < 1.0 and 0.0 <= reply_rate <= read_rate
+        if num_addresses is None:
+            num_addresses = max(100, num_messages // 20)
+        self.num_messages = num_messages
+        self.num_addresses = num_addresses
+        self.zipf_s = zipf_s
+        self.vocabulary_size = vocabulary_size
+        self.read_rate = read_rate
+        self.reply_rate = reply_rate
+        self.seed = seed
+
+    def name(self):
+        """
+        A file name that identifies the parameters, for caching generated databases.
+        """
+        return 'synthetic_%d_%d_%g_%d_%g_%g_%d.db' % \
+               (self.num_messages, self.num_addresses, self.zipf_s, self.vocabulary_size,
+                self.read_rate, self.reply_rate, self.seed)
+
+    @staticmethod
+    def _zipf_probabilities(n, s):
+        p = 1.0 / numpy.arange(1, n + 1, dtype=numpy.float64) ** s
+        return p / p.sum()
+
+    def _addresses(self):
+        addresses = ['user%d@domain%d.example.com' % (n, n % 211) for n in xrange(self.num_addresses)]
+        names = ['User %d' % n for n in xrange(self.num_addresses)]
+        return addresses, names
+
+    def _subjects(self, rng):
+        """
+        Return the subjects and the mean interest of their words.
+        """
+        vocabulary = ['w%d' % n for n in xrange(self.vocabulary_size)]
+        word_interest = rng.normal(0.0, 1.0, self.vocabulary_size)
+        num_words = rng.randint(1, 9, self.num_messages)
+        # About 3% of the messages have no subject
+        num_words[rng.random_sample(self.num_messages) < 0.03] = 0
+        words = rng.choice(self.vocabulary_size, num_words.sum(),
+                           p=SyntheticMailbox._zipf_probabilities(self.vocabulary_size, 1.0))
+        offsets = numpy.concatenate(([0], numpy.cumsum(num_words)))
+        interest = numpy.zeros(self.num_messages)
+        has_words = num_words > 0
+        interest[has_words] = numpy.add.reduceat(word_interest[words], offsets[:-1][has_words]) / \
+            num_words[has_words]
+        is_reply = rng.random_sample(self.num_messages) < 0.3
+        subjects = list()
+        for n in xrange(self.num_messages):
+            if num_words[n] == 0:
+                subjects.append(None)
+                continue
+            subject = ' '.join([vocabulary[w] for w in words[offsets[n]:offsets[n + 1]]])
+            if is_reply[n]:
+                subject = 'Re: ' + subject
+            subjects.append(subject)
+        return subjects, interest
+
+    def generate(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        rng = numpy.random.RandomState(self.seed)
+        (addresses, names) = self._addresses()
+        popularity = SyntheticMailbox._zipf_probabilities(self.num_addresses, self.zipf_s)
+        address_interest = rng.normal(0.0, 1.5, self.num_addresses)
+
+        senders = rng.choice(self.num_addresses, self.num_messages, p=popularity)
+        num_to = rng.poisson(0.5, self.num_messages)
+        num_cc = rng.poisson(0.3, self.num_messages)
+        recipients = rng.choice(self.num_addresses, (num_to + num_cc).sum(), p=popularity)
+        recipient_offsets = numpy.concatenate(([0], numpy.cumsum(num_to + num_cc)))
+        (subjects, subject_interest) = self._subjects(rng)
+
+        base = numpy.log(self.read_rate / (1.0 - self.read_rate))
+        p_read = 1.0 / (1.0 + numpy.exp(-(base + address_interest[senders] + subject_interest)))
+        is_read = rng.random_sample(self.num_messages) < p_read
+        is_replied = is_read & (rng.random_sample(self.num_messages) < self.reply_rate / self.read_rate)
+        # 1 = reply to sender, 2 = reply all
+        last_verb = numpy.where(is_replied, rng.randint(1, 3, self.num_messages), 0)
+        date_received = SyntheticMailbox.FIRST_TICKS + numpy.cumsum(
+            rng.exponential(SyntheticMailbox.TICKS_PER_MESSAGE, self.num_messages).astype(numpy.int64))
+
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('CREATE TABLE McEmailMessage (Id INTEGER PRIMARY KEY, "From" TEXT, "To" TEXT, '
+                               'Cc TEXT, Subject TEXT, IsRead INTEGER, LastVerbExecuted INTEGER, '
+                               'DateReceived INTEGER, Score REAL, ScoreVersion INTEGER, '
+                               'TimeVarianceType INTEGER, TimeVarianceState INTEGER)')
+            connection.execute('CREATE TABLE McEmailAddress (Id INTEGER PRIMARY KEY, CanonicalEmailAddress TEXT)')
+            connection.execute('CREATE TABLE McMapEmailAddressEntry (Id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'AccountId INTEGER, AddressType INTEGER, EmailAddressId INTEGER, ObjectId INTEGER)')
+            connection.executemany('INSERT INTO McEmailAddress (Id, CanonicalEmailAddress) VALUES (?, ?)',
+                                   [(n + 1, address) for (n, address) in enumerate(addresses)])
+
+            def messages():
+                for n in xrange(self.num_messages):
+                    start = recipient_offsets[n]
+                    to = recipients[start:start + num_to[n]]
+                    cc = recipients[start + num_to[n]:recipient_offsets[n + 1]]
+                    sender = senders[n]
+                    yield (n + 1, '"%s" <%s>' % (names[sender], addresses[sender]),
+                           ', '.join([addresses[a] for a in to]) or None,
+                           ', '.join([addresses[a] for a in cc]) or None,
+                           subjects[n], int(is_read[n]), int(last_verb[n]), int(date_received[n]), 0.0, 0, 0, 0)
+
+            def map_entries():
+                # AddressType is EmailMessageAddressType: 1 = From, 4 = To, 5 = Cc
+                for n in xrange(self.num_messages):
+                    start = recipient_offsets[n]
+                    yield (1, 1, int(senders[n]) + 1, n + 1)
+                    for a in recipients[start:start + num_to[n]]:
+                        yield (1, 4, int(a) + 1, n + 1)
+                    for a in recipients[start + num_to[n]:recipient_offsets[n + 1]]:
+                        yield (1, 5, int(a) + 1, n + 1)
+
+            connection.executemany('INSERT INTO McEmailMessage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   messages())
+            connection.executemany('INSERT INTO McMapEmailAddressEntry (AccountId, AddressType, EmailAddressId, '
+                                   'ObjectId) VALUES (?, ?, ?, ?)', map_entries())
+            # The indexes of the [Indexed] columns, named as sqlite-net names them
+            for column in ('AccountId', 'AddressType', 'EmailAddressId', 'ObjectId'):
+                connection.execute('CREATE INDEX McMapEmailAddressEntry_%s ON McMapEmailAddressEntry (%s)' %
+                                   (column, column))
+            connection.commit()
+        finally:
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic device database for benchmarking')
+    parser.add_argument('db_file', help='SQLite database file to create (overwritten if it exists)')
+    parser.add_argument('--messages', '-n', type=int, default=10000, help='Number of messages')
+    parser.add_argument('--addresses', type=int, default=None,
+                        help='Number of distinct addresses (default: # of messages / 20, at least 100)')
+    parser.add_argument('--zipf', type=float, default=1.2, help='Zipf exponent of address popularity')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='Number of distinct subject words')
+    parser.add_argument('--read-rate', type=float, default=0.6, help='Base probability of a message being read')
+    parser.add_argument('--reply-rate', type=float, default=0.1, help='Approximate fraction of replied messages')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    options = parser.parse_args()
+
+    mailbox = SyntheticMailbox(options.messages, num_addresses=options.addresses, zipf_s=options.zipf,
+                               vocabulary_size=options.vocabulary, read_rate=options.read_rate,
+                               reply_rate=options.reply_rate, seed=options.seed)
+    mailbox.generate(options.db_file)
+
+
+if __name__ == '__main__':
+    main()